@@ -1,6 +1,106 @@
+import numpy as np
+
+
 def lateralise_atlas(
     atlas, hemispheres, left_hemisphere_value=2, right_hemisphere_value=1
 ):
     atlas_left = atlas[hemispheres == left_hemisphere_value]
     atlas_right = atlas[hemispheres == right_hemisphere_value]
     return atlas_left, atlas_right
+
+
+def count_lateralised_structures(
+    atlas,
+    hemispheres,
+    mask=None,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
+):
+    """
+    Counts the voxels of each (non-zero) atlas value in each hemisphere, in
+    a single pass. Each (atlas value, hemisphere) pair is encoded as a single
+    integer, and counted with np.bincount.
+    :param atlas: Atlas (annotations) array
+    :param hemispheres: Hemispheres array (same shape as the atlas)
+    :param mask: Optional boolean array. If given, only voxels within the
+    mask are counted.
+    :param left_hemisphere_value: Value of the left hemisphere
+    :param right_hemisphere_value: Value of the right hemisphere
+    :return: Sorted array of the atlas values, and arrays of the number of
+    voxels of each in the left and right hemispheres
+    """
+    if mask is not None:
+        atlas = atlas[mask]
+        hemispheres = hemispheres[mask]
+    atlas = np.asarray(atlas).ravel()
+    hemispheres = np.asarray(hemispheres).ravel()
+
+    left = hemispheres == left_hemisphere_value
+    keep = (atlas != 0) & (left | (hemispheres == right_hemisphere_value))
+    atlas_values, inverse = np.unique(atlas[keep], return_inverse=True)
+    counts = np.bincount(
+        2 * inverse.ravel() + left[keep], minlength=2 * len(atlas_values)
+    ).reshape(-1, 2)
+    return atlas_values, counts[:, 1], counts[:, 0]
+
+
+def get_bounding_box(data):
+    """
+    Finds the bounding box of the non-zero voxels of an array
+    :param data: Array (e.g. a segmented region)
+    :return: Tuple of slices (one per axis), or None if the array is empty
+    """
+    if hasattr(data, "get_bounding_box"):
+        # e.g. ChunkedLabels, which only needs to search the painted chunks
+        return data.get_bounding_box()
+    data = np.asarray(data)
+    bounding_box = []
+    for axis in range(data.ndim):
+        other_axes = tuple(i for i in range(data.ndim) if i != axis)
+        nonzero = np.flatnonzero(data.any(axis=other_axes))
+        if len(nonzero) == 0:
+            return None
+        bounding_box.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(bounding_box)
+
+
+def pad_bounding_box(bounding_box, shape, padding=1, step_size=1):
+    """
+    Pads a bounding box, without extending it beyond the array
+    :param bounding_box: Tuple of slices (one per axis)
+    :param shape: Shape of the array
+    :param padding: Number of voxels to pad each side by
+    :param step_size: If greater than 1, the start of each axis is moved
+    down to a multiple of the step size, so that the cropped array is sampled
+    on the same grid as the whole array (e.g. by marching cubes)
+    :return: Tuple of slices
+    """
+    return tuple(
+        slice(
+            (max(axis.start - padding, 0) // step_size) * step_size,
+            min(axis.stop + padding, size),
+        )
+        for axis, size in zip(bounding_box, shape)
+    )
+
+
+def offset_region_properties(table, offset):
+    """
+    Offsets the coordinates in a table of region properties (as
+    skimage.measure.regionprops_table) calculated on a cropped array, so that
+    they are relative to the whole array. Only the "bbox" and "centroid"
+    properties are offset (e.g. "area" doesn't depend on the position).
+    :param table: Dict (or pandas dataframe) of the region properties
+    :param offset: Start of the crop along each axis
+    :return: Table of the offset region properties
+    """
+    n_axes = len(offset)
+    for axis, axis_offset in enumerate(offset):
+        for column in [
+            f"bbox-{axis}",
+            f"bbox-{axis + n_axes}",
+            f"centroid-{axis}",
+        ]:
+            if column in table:
+                table[column] = table[column] + axis_offset
+    return table
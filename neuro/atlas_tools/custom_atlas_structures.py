@@ -1,13 +1,14 @@
-import pandas as pd
 import numpy as np
 from brainio import brainio
 from skimage.filters import gaussian
 
+from neuro.structures.IO import load_structures_as_df
+from neuro.structures.structures_tree import get_structure_tree
 from neuro.visualise import brainrender_tools
 
 
 def load_atlas_structures_csv(path_to_structures_csv):
-    df = pd.read_csv(path_to_structures_csv)
+    df = load_structures_as_df(path_to_structures_csv)
     return df
 
 
@@ -19,40 +20,29 @@ def get_atlas_ids(df, parent_key):
 def create_hierarchy_paths(df):
     """
     creates paths of id hierarchy to match custom atlas to allen atlas
-    :param df:
+    :param df: structures dataframe (or StructureTree)
     :return:
     """
+    tree = get_structure_tree(df)
     all_paths = {}
-    all_ids = df["id"]
-    all_ids = all_ids[all_ids.notnull()]
-    for id in all_ids:
-        path = get_structure_parents(df, id)
+    for id in tree.id_values:
+        path = get_structure_parents(tree, id)
         path = get_path_string_standard_fmt(path)
         all_paths.setdefault(id, path)
     return all_paths
 
 
-def get_structure_parents(df, k, parent=None, all_parents=None, root_id=997):
+def get_structure_parents(df, k, root_id=997):
     """
     gets all parent structures of the given id
 
-    :param df:
+    :param df: structures dataframe (or StructureTree)
     :param k:
-    :param parent:
-    :param all_parents:
     :param root_id:
     :return:
     """
-    if parent is None:
-        all_parents = []
-        parent = df[df["id"] == k]["parent_id"].values[0]
-        all_parents.append(parent)
-
-    if int(parent) != root_id:
-        parent = df[df["id"] == parent]["parent_id"].values[0]
-        all_parents.append(parent)
-        return get_structure_parents(df, k, parent, all_parents)
-    return all_parents[::-1]
+    tree = get_structure_tree(df)
+    return tree.get_ancestors(k, root_id=root_id)
 
 
 def get_path_string_standard_fmt(all_parent_ids):
@@ -69,13 +59,8 @@ def add_to_df(df, df_dict):
 
 
 def get_all_structure_children(df, k):
-    all_ids = df["id"]
-    all_ids = all_ids[all_ids.notnull()]
-    all_children = []
-    for id in all_ids:
-        all_parents = get_structure_parents(df, id)
-        if k in all_parents:
-            all_children.append(id)
+    tree = get_structure_tree(df)
+    all_children = tree.get_descendants(k)
     if len(all_children) == 0:
         all_children.append(k)
     return all_children
@@ -88,6 +73,7 @@ def render_all_subregions(
     structures_csv_path,
     smooth_threshold=0.4,
     smooth_sigma=10,
+    mesh_format="obj",
 ):
     """
     renders all children structures of a given id
@@ -96,6 +82,8 @@ def render_all_subregions(
     :param out_dir:
     :param atlas_path:
     :param structures_csv_path:
+    :param mesh_format: Format of the mesh files (see
+    neuro.visualise.surfaces.MESH_FORMATS)
     :return:
     """
     df = load_atlas_structures_csv(structures_csv_path)
@@ -107,7 +95,9 @@ def render_all_subregions(
             region_mask, threshold=smooth_threshold, sigma=smooth_sigma
         )
         brainrender_tools.volume_to_vector_array_to_obj_file(
-            smoothed_region, f"{out_dir}/{idx}.obj"
+            smoothed_region,
+            f"{out_dir}/{idx}.{mesh_format}",
+            mesh_format=mesh_format,
         )
 
 
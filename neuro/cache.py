@@ -0,0 +1,194 @@
+"""
+Helpers for caching derived data (e.g. parsed files) alongside their source
+files, or (for small values) in a metadata cache in the user's home
+directory. Caches are keyed on the size and modification time of the source
+(or the listing of a source directory), so they are invalidated whenever the
+source changes.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+from pathlib import Path
+import numpy as np
+
+SIGNATURE_KEY = "_signature"
+
+
+def file_signature(file_path):
+    """
+    Returns a signature of a file, that changes whenever the file does
+    :param file_path: Path to the file
+    :return: np.array of the file size and modification time (ns)
+    """
+    stat = os.stat(str(file_path))
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def get_sidecar_path(file_path, suffix=".cache.npz"):
+    """
+    Returns the path of the cache file for a given source file
+    (e.g. cells.xml -> cells.xml.cache.npz)
+    :param file_path: Path to the source file
+    :param suffix: Suffix added to the source file name
+    :return: Path to the cache file
+    """
+    file_path = Path(file_path)
+    return file_path.parent / (file_path.name + suffix)
+
+
+def get_writable_cache_path(file_path, suffix=".cache.npz"):
+    """
+    Returns the sidecar cache path for a source file if its directory is
+    writable, otherwise a path in the metadata cache directory (e.g. for
+    files installed with a package)
+    :param file_path: Path to the source file
+    :param suffix: Suffix added to the source file name
+    :return: Path to the cache file
+    """
+    file_path = Path(file_path)
+    if os.access(str(file_path.parent), os.W_OK):
+        return get_sidecar_path(file_path, suffix=suffix)
+    path_hash = hashlib.sha1(str(file_path.resolve()).encode("utf-8"))
+    return get_metadata_cache_directory() / (
+        f"{path_hash.hexdigest()[:16]}-{file_path.name}{suffix}"
+    )
+
+
+def load_npz_cache(source_path, cache_path=None):
+    """
+    Loads the arrays cached for a source file, if the cache exists and is
+    up to date.
+    :param source_path: Path to the source file
+    :param cache_path: Path to the cache file. Defaults to the sidecar path
+    :return: Dict of arrays, or None if there is no valid cache
+    """
+    if cache_path is None:
+        cache_path = get_sidecar_path(source_path)
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return None
+
+    try:
+        with np.load(str(cache_path), allow_pickle=False) as cache:
+            if not np.array_equal(
+                cache[SIGNATURE_KEY], file_signature(source_path)
+            ):
+                logging.debug(f"Cache: {cache_path} is out of date")
+                return None
+            return {
+                key: cache[key] for key in cache.files if key != SIGNATURE_KEY
+            }
+    except (OSError, ValueError, KeyError):
+        logging.debug(f"Cache: {cache_path} could not be read")
+        return None
+
+
+def save_npz_cache(source_path, arrays, cache_path=None):
+    """
+    Caches a dict of arrays for a source file. If the cache cannot be
+    written (e.g. a read-only directory), this is logged and ignored.
+    :param source_path: Path to the source file
+    :param arrays: Dict of np.arrays to cache
+    :param cache_path: Path to the cache file. Defaults to the sidecar path
+    """
+    if cache_path is None:
+        cache_path = get_sidecar_path(source_path)
+    cache_path = Path(cache_path)
+    # write to a temporary file first, so a partial cache is never read
+    tmp_path = cache_path.parent / (cache_path.name + ".tmp.npz")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            str(tmp_path),
+            **arrays,
+            **{SIGNATURE_KEY: file_signature(source_path)},
+        )
+        os.replace(str(tmp_path), str(cache_path))
+    except OSError as err:
+        logging.debug(f"Could not write cache: {cache_path}, {err}")
+
+
+def get_metadata_cache_directory():
+    """
+    Returns the directory of the metadata cache (small values derived from
+    large files, e.g. image shapes). Defaults to ~/.neuro, but can be set with
+    the NEURO_CACHE_DIR environment variable.
+    :return: Path to the cache directory
+    """
+    return Path(os.environ.get("NEURO_CACHE_DIR", Path.home() / ".neuro"))
+
+
+def path_signature(path):
+    """
+    Returns a signature of a file or directory, that changes whenever the
+    file, or the directory listing, does
+    :param path: Path to a file or directory
+    :return: Signature string
+    """
+    path = Path(path)
+    stat = os.stat(str(path))
+    if not path.is_dir():
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    listing = hashlib.sha1()
+    for name in sorted(os.listdir(str(path))):
+        listing.update(name.encode("utf-8", "surrogateescape") + b"\0")
+    return f"{stat.st_mtime_ns}-{listing.hexdigest()}"
+
+
+def _get_metadata_cache_file(name):
+    return get_metadata_cache_directory() / f"{name}.json"
+
+
+def _read_metadata_cache(name):
+    cache_file = _get_metadata_cache_file(name)
+    try:
+        with open(str(cache_file), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_metadata_cache(name, path):
+    """
+    Loads a value cached for a file or directory, if it is up to date
+    :param name: Name of the cache (e.g. "raw_image_shape")
+    :param path: Path to the file or directory the value was derived from
+    :return: The cached value, or None if there is no valid cache
+    """
+    path = Path(path).resolve()
+    entry = _read_metadata_cache(name).get(str(path))
+    if entry is None:
+        return None
+    try:
+        if entry["signature"] != path_signature(path):
+            logging.debug(f"Cache: {name} of {path} is out of date")
+            return None
+    except OSError:
+        return None
+    return entry["value"]
+
+
+def save_metadata_cache(name, path, value):
+    """
+    Caches a (json serialisable) value for a file or directory. If the cache
+    cannot be written, this is logged and ignored.
+    :param name: Name of the cache (e.g. "raw_image_shape")
+    :param path: Path to the file or directory the value was derived from
+    :param value: Value to cache
+    """
+    path = Path(path).resolve()
+    cache_file = _get_metadata_cache_file(name)
+    tmp_file = cache_file.parent / f"{cache_file.name}.{os.getpid()}.tmp"
+    try:
+        cache = _read_metadata_cache(name)
+        cache[str(path)] = {"signature": path_signature(path), "value": value}
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(tmp_file), "w") as f:
+            json.dump(cache, f, indent=1)
+        os.replace(str(tmp_file), str(cache_file))
+    except OSError as err:
+        logging.debug(f"Could not write cache: {cache_file}, {err}")
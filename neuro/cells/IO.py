@@ -0,0 +1,124 @@
+"""
+Streaming reader for cellfinder cell files. Cell positions and types are
+returned as arrays (rather than lists of Cell objects), and are cached in a
+binary file alongside the cell file, so that subsequent loads are almost
+instantaneous.
+"""
+
+import logging
+from xml.etree import ElementTree
+
+import numpy as np
+import imlib.IO.cells as cells_io
+from imlib.IO.cells import MissingCellsError
+
+from neuro.cache import load_npz_cache, save_npz_cache
+
+MARKER_TAGS = {"MarkerX": 0, "MarkerY": 1, "MarkerZ": 2}
+
+
+def iter_cells_xml(xml_file_path, chunk_size=1000000):
+    """
+    Incrementally parses a cellfinder xml file, without building the full
+    element tree (or a Cell object per cell)
+    :param xml_file_path: Path to the xml file
+    :param chunk_size: Maximum number of cells per chunk
+    :return: Generator of (positions, types) arrays. Positions are integer
+    (x, y, z) voxel coordinates, one row per cell.
+    """
+    positions = np.empty((chunk_size, 3), dtype=np.float64)
+    types = np.empty(chunk_size, dtype=np.int64)
+    n_cells = 0
+
+    cell_type = None
+    marker_type = None
+    for event, element in ElementTree.iterparse(
+        str(xml_file_path), events=("start", "end")
+    ):
+        if event == "start":
+            if element.tag == "Marker_Type":
+                marker_type = element
+                cell_type = None
+            elif element.tag == "Marker":
+                if marker_type is None:
+                    raise ValueError(
+                        f"Marker outside of a Marker_Type in file "
+                        f"{xml_file_path}"
+                    )
+                if cell_type is None:
+                    raise ValueError(
+                        f"Marker_Type with no Type in file {xml_file_path}"
+                    )
+                # any missing positions are filled in by _clean_positions
+                positions[n_cells] = np.nan
+            continue
+
+        if element.tag in MARKER_TAGS:
+            positions[n_cells, MARKER_TAGS[element.tag]] = float(element.text)
+        elif element.tag == "Type" and marker_type is not None:
+            cell_type = int(element.text)
+        elif element.tag == "Marker":
+            types[n_cells] = cell_type
+            n_cells += 1
+            # free the memory used by the cells that have been read
+            marker_type.clear()
+            if n_cells == chunk_size:
+                yield _clean_positions(positions), types.copy()
+                n_cells = 0
+
+    if n_cells:
+        yield _clean_positions(positions[:n_cells]), types[:n_cells].copy()
+
+
+def _clean_positions(positions):
+    # as imlib.cells.cells.Cell, missing positions default to 1, and
+    # positions are truncated to integers
+    positions = np.where(np.isnan(positions), 1, positions)
+    return positions.astype(np.int64)
+
+
+def read_cells_xml(xml_file_path, chunk_size=1000000):
+    """
+    Reads all the cells in a cellfinder xml file
+    :param xml_file_path: Path to the xml file
+    :param chunk_size: Number of cells to parse at once
+    :return: Tuple of positions (n x 3 array of x, y, z) and types (n array)
+    """
+    chunks = list(iter_cells_xml(xml_file_path, chunk_size=chunk_size))
+    if not chunks:
+        raise MissingCellsError(f"No cells found in file {xml_file_path}")
+    positions = np.concatenate([chunk[0] for chunk in chunks])
+    types = np.concatenate([chunk[1] for chunk in chunks])
+    return positions, types
+
+
+def load_cell_arrays(cells_file, use_cache=True):
+    """
+    Loads the positions and types of all the cells in a cells file. For xml
+    files, the results are cached alongside the file (as
+    "<cells_file>.cache.npz"), and the cache is used as long as the cells file
+    is unchanged.
+    :param cells_file: Any supported cell file (e.g. xml)
+    :param use_cache: Read from (and write to) the cache
+    :return: Tuple of positions (n x 3 array of x, y, z) and types (n array)
+    """
+    cells_file = str(cells_file)
+    if not cells_file.endswith(".xml"):
+        cells = cells_io.get_cells(cells_file)
+        positions = np.array(
+            [[cell.x, cell.y, cell.z] for cell in cells], dtype=np.int64
+        ).reshape(-1, 3)
+        types = np.array([cell.type for cell in cells], dtype=np.int64)
+        return positions, types
+
+    if use_cache:
+        cache = load_npz_cache(cells_file)
+        if cache is not None:
+            logging.debug(f"Loading cells from cache of: {cells_file}")
+            return cache["positions"], cache["types"]
+
+    logging.debug(f"Loading cells from: {cells_file}")
+    positions, types = read_cells_xml(cells_file)
+    if use_cache:
+        save_npz_cache(cells_file, {"positions": positions, "types": types})
+    return positions, types
@@ -0,0 +1,378 @@
+"""
+Counts cells per atlas structure (and hemisphere), using the atlas
+registered to the sample (e.g. by amap). The structure of every cell is
+found by indexing into the (memory-mapped) registered atlas, and the counts
+are aggregated with np.bincount, so that tens of millions of cells can be
+processed in seconds.
+"""
+
+import logging
+import argparse
+
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from imlib.cells.cells import Cell
+from imlib.general.numerical import check_positive_float
+from imlib.general.system import ensure_directory_exists
+
+from neuro.atlas_tools.misc import get_atlas_pixel_sizes, get_voxel_volume
+from neuro.atlas_tools.paths import Paths
+from neuro.cells.IO import load_cell_arrays
+from neuro.structures.IO import load_structures_as_df
+from neuro.structures.rollup import roll_up
+
+LEFT_HEMISPHERE_VALUE = 2
+RIGHT_HEMISPHERE_VALUE = 1
+HEMISPHERES = {LEFT_HEMISPHERE_VALUE: "left", RIGHT_HEMISPHERE_VALUE: "right"}
+
+
+def load_image_memmap(image_path):
+    """
+    Loads a nifti image, memory-mapped if it is uncompressed
+    :param image_path: Path to the nifti image
+    :return: Image array (np.memmap if possible)
+    """
+    return np.asanyarray(nib.load(str(image_path)).dataobj)
+
+
+def get_atlas_voxels(positions, scale, atlas_shape):
+    """
+    Converts cell positions (raw image voxels) to atlas voxel indices
+    :param positions: Array of cell positions (x, y, z columns)
+    :param scale: Scaling (per axis) from raw image voxels to atlas voxels
+    :param atlas_shape: Shape of the atlas
+    :return: Array of atlas voxel indices, and a boolean array of whether
+    each cell lies within the atlas
+    """
+    voxels = np.floor(np.asarray(positions) * np.asarray(scale)).astype(
+        np.int64
+    )
+    inside = ((voxels >= 0) & (voxels < np.asarray(atlas_shape))).all(axis=1)
+    return voxels, inside
+
+
+def get_cell_structures(positions, atlas, hemispheres, scale):
+    """
+    Looks up the atlas structure id (and hemisphere) of every cell
+    :param positions: Array of cell positions in raw image voxels (x, y, z
+    columns)
+    :param atlas: Registered atlas (e.g. a memmap)
+    :param hemispheres: Registered hemispheres atlas (e.g. a memmap)
+    :param scale: Scaling (per axis) from raw image voxels to atlas voxels
+    :return: Arrays of the structure id and hemisphere value of each cell
+    (both 0 for cells outside the atlas)
+    """
+    voxels, inside = get_atlas_voxels(positions, scale, atlas.shape)
+    structure_ids = np.zeros(len(voxels), dtype=np.int64)
+    hemisphere_values = np.zeros(len(voxels), dtype=np.int64)
+    index = tuple(voxels[inside].T)
+    structure_ids[inside] = atlas[index]
+    hemisphere_values[inside] = hemispheres[index]
+    return structure_ids, hemisphere_values
+
+
+def count_by_structure(structure_ids, hemisphere_values, weights=None):
+    """
+    Counts the number of times each (structure id, hemisphere) pair occurs
+    :param structure_ids: Array of structure ids
+    :param hemisphere_values: Array of hemisphere values
+    :param weights: Optional weights (e.g. voxel counts) for each pair
+    :return: pd.Series of counts, indexed by (structure_id, hemisphere)
+    """
+    structure_ids = np.asarray(structure_ids, dtype=np.int64).ravel()
+    hemisphere_values = np.asarray(hemisphere_values, dtype=np.int64).ravel()
+    # combine into a single key, so only one unique and bincount is needed
+    n_hemispheres = int(hemisphere_values.max(initial=0)) + 1
+    keys = structure_ids * n_hemispheres + hemisphere_values
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=weights)
+    index = pd.MultiIndex.from_arrays(
+        [unique_keys // n_hemispheres, unique_keys % n_hemispheres],
+        names=["structure_id", "hemisphere"],
+    )
+    return pd.Series(counts, index=index)
+
+
+def get_structure_voxel_counts(atlas, hemispheres, slab_size=32):
+    """
+    Counts the number of voxels of each structure in each hemisphere. The
+    atlas is processed in slabs, so it need not fit in memory.
+    :param atlas: Registered atlas (e.g. a memmap)
+    :param hemispheres: Registered hemispheres atlas (e.g. a memmap)
+    :param slab_size: Number of planes (along the last axis) per slab
+    :return: pd.Series of voxel counts, indexed by (structure_id, hemisphere)
+    """
+    slab_counts = []
+    for start in range(0, atlas.shape[-1], slab_size):
+        slab = (Ellipsis, slice(start, start + slab_size))
+        slab_counts.append(
+            count_by_structure(
+                np.asarray(atlas[slab]), np.asarray(hemispheres[slab])
+            )
+        )
+    counts = pd.concat(slab_counts)
+    return counts.groupby(level=counts.index.names).sum()
+
+
+def summarise_cell_counts(
+    cell_counts, voxel_counts, voxel_volume_mm3, structures_df=None
+):
+    """
+    Builds a table of the cell counts, volume and density (cells/mm³) of each
+    structure, in each hemisphere
+    :param cell_counts: pd.Series from count_by_structure
+    :param voxel_counts: pd.Series from get_structure_voxel_counts
+    :param voxel_volume_mm3: Volume of a single atlas voxel (mm³)
+    :param structures_df: Optional structures reference dataframe (to add
+    the structure names)
+    :return: pd.DataFrame with one row per structure
+    """
+    table = pd.DataFrame(
+        {"cell_count": cell_counts, "volume_mm3": voxel_counts}
+    ).fillna(0)
+    table["volume_mm3"] = table["volume_mm3"] * voxel_volume_mm3
+    # outside of the brain
+    table = table.drop(0, level="structure_id", errors="ignore")
+    table = table[
+        table.index.get_level_values("hemisphere").isin(list(HEMISPHERES))
+    ]
+
+    table = table.unstack("hemisphere", fill_value=0)
+    summary = pd.DataFrame(index=table.index)
+    for value, hemisphere in HEMISPHERES.items():
+        for column in ("cell_count", "volume_mm3"):
+            if (column, value) in table.columns:
+                summary[f"{hemisphere}_{column}"] = table[(column, value)]
+            else:
+                summary[f"{hemisphere}_{column}"] = 0
+    for column in ("cell_count", "volume_mm3"):
+        summary[f"total_{column}"] = (
+            summary[f"left_{column}"] + summary[f"right_{column}"]
+        )
+    for prefix in ("left", "right", "total"):
+        column = f"{prefix}_cell_count"
+        summary[column] = summary[column].astype(np.int64)
+    add_densities(summary)
+
+    summary.index.name = "structure_id"
+    summary = summary.reset_index()
+    if structures_df is not None:
+        names = structures_df.set_index("id")["name"]
+        summary.insert(1, "structure_name", summary["structure_id"].map(names))
+    return summary
+
+
+def add_densities(summary):
+    """
+    Adds (or recalculates) the cells/mm³ columns of a summary table
+    :param summary: pd.DataFrame with cell count and volume columns
+    """
+    for prefix in ("left", "right", "total"):
+        # structures with no volume (in a hemisphere) have no density
+        volume = summary[f"{prefix}_volume_mm3"].replace(0, np.nan)
+        summary[f"{prefix}_cells_per_mm3"] = (
+            summary[f"{prefix}_cell_count"] / volume
+        )
+
+
+def roll_up_summary(summary, structures_df):
+    """
+    Adds the cell counts and volumes of each structure to all of its parent
+    structures, and recalculates the densities
+    :param summary: pd.DataFrame from summarise_cell_counts
+    :param structures_df: Structures reference dataframe
+    :return: pd.DataFrame with one row per structure (including all the
+    parent structures), and depth and parent structure columns
+    """
+    value_columns = [
+        f"{prefix}_{column}"
+        for prefix in ("left", "right", "total")
+        for column in ("cell_count", "volume_mm3")
+    ]
+    rolled_up = roll_up(summary, structures_df, value_columns=value_columns)
+    add_densities(rolled_up)
+    return rolled_up
+
+
+def count_cells_in_regions(
+    cells_file,
+    registration_directory,
+    x_pixel_um,
+    y_pixel_um,
+    z_pixel_um,
+    output_filename=None,
+    structures_file=None,
+    registration_config=None,
+    cells_only=True,
+    roll_up_hierarchy=False,
+):
+    """
+    Counts the cells in each atlas structure (and hemisphere), and calculates
+    the cell density.
+    :param cells_file: Cellfinder output cells file
+    :param registration_directory: Registration (amap) output directory,
+    containing "registered_atlas.nii" and "registered_hemispheres.nii"
+    :param x_pixel_um: Pixel spacing of the raw data in the first dimension
+    :param y_pixel_um: Pixel spacing of the raw data in the second dimension
+    :param z_pixel_um: Pixel spacing of the raw data in the third dimension
+    :param output_filename: Optional csv file to save the results to
+    :param structures_file: Optional structures reference csv file (to add
+    the structure names)
+    :param registration_config: Registration config file, defining the atlas
+    pixel sizes. Defaults to "config.conf" in the registration directory.
+    :param cells_only: Only count "cells", not artefacts
+    :param roll_up_hierarchy: Include the cells (and volume) of all the
+    descendants of each structure, and list all of the parent structures.
+    Requires the structures file.
+    :return: pd.DataFrame with one row per structure
+    """
+    if roll_up_hierarchy and structures_file is None:
+        raise ValueError(
+            "The structures file is required to roll up the structure "
+            "hierarchy"
+        )
+    paths = Paths(str(registration_directory))
+    if registration_config is None:
+        registration_config = Path(registration_directory, "config.conf")
+    atlas_pixel_sizes = get_atlas_pixel_sizes(registration_config)
+    scale = [
+        x_pixel_um / float(atlas_pixel_sizes["x"]),
+        y_pixel_um / float(atlas_pixel_sizes["y"]),
+        z_pixel_um / float(atlas_pixel_sizes["z"]),
+    ]
+    # um³ to mm³
+    voxel_volume_mm3 = get_voxel_volume(registration_config) / (1000 ** 3)
+
+    logging.debug("Loading cells")
+    positions, types = load_cell_arrays(cells_file)
+    if cells_only:
+        positions = positions[types == Cell.CELL]
+
+    atlas = load_image_memmap(paths.registered_atlas_path)
+    hemispheres = load_image_memmap(paths.hemispheres_atlas_path)
+
+    logging.debug(f"Finding the structure of {len(positions)} cells")
+    structure_ids, hemisphere_values = get_cell_structures(
+        positions, atlas, hemispheres, scale
+    )
+    n_outside = int((structure_ids == 0).sum())
+    if n_outside:
+        logging.debug(f"{n_outside} cells are outside of the brain")
+
+    structures_df = None
+    if structures_file is not None:
+        structures_df = load_structures_as_df(structures_file)
+
+    logging.debug("Calculating structure volumes")
+    summary = summarise_cell_counts(
+        count_by_structure(structure_ids, hemisphere_values),
+        get_structure_voxel_counts(atlas, hemispheres),
+        voxel_volume_mm3,
+        structures_df=structures_df,
+    )
+    if roll_up_hierarchy:
+        logging.debug("Rolling up the structure hierarchy")
+        summary = roll_up_summary(summary, structures_df)
+
+    if output_filename is not None:
+        ensure_directory_exists(Path(output_filename).parent)
+        summary.to_csv(output_filename, index=False)
+    return summary
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        dest="cells_file", type=str, help="Cellfinder output cell file"
+    )
+    parser.add_argument(
+        dest="registration_directory",
+        type=str,
+        help="Registration output directory",
+    )
+    parser.add_argument(
+        dest="output_filename",
+        type=str,
+        help="Output filename. Should end with '.csv'",
+    )
+    parser.add_argument(
+        "-x",
+        "--x-pixel-um",
+        dest="x_pixel_um",
+        type=check_positive_float,
+        help="Pixel spacing of the data in the first "
+        "dimension, specified in um.",
+        required=True,
+    )
+    parser.add_argument(
+        "-y",
+        "--y-pixel-um",
+        dest="y_pixel_um",
+        type=check_positive_float,
+        help="Pixel spacing of the data in the second "
+        "dimension, specified in um.",
+        required=True,
+    )
+    parser.add_argument(
+        "-z",
+        "--z-pixel-um",
+        dest="z_pixel_um",
+        type=check_positive_float,
+        help="Pixel spacing of the data in the third "
+        "dimension, specified in um.",
+        required=True,
+    )
+    parser.add_argument(
+        "--structures-file",
+        dest="structures_file",
+        type=str,
+        default=None,
+        help="Atlas structures csv file, to add the structure names",
+    )
+    parser.add_argument(
+        "--registration-config",
+        dest="registration_config",
+        type=str,
+        default=None,
+        help="Registration config file. Defaults to 'config.conf' in the "
+        "registration directory.",
+    )
+    parser.add_argument(
+        "--roll-up",
+        dest="roll_up_hierarchy",
+        action="store_true",
+        help="Include the cells of all the descendants of each structure "
+        "(and list all of the parent structures). Requires "
+        "'--structures-file'.",
+    )
+    parser.add_argument(
+        "--all-cells",
+        dest="cells_only",
+        action="store_false",
+        help="Count all cells, not only those classified as cells",
+    )
+    return parser
+
+
+def cli():
+    args = get_parser().parse_args()
+    count_cells_in_regions(
+        args.cells_file,
+        args.registration_directory,
+        args.x_pixel_um,
+        args.y_pixel_um,
+        args.z_pixel_um,
+        output_filename=args.output_filename,
+        structures_file=args.structures_file,
+        registration_config=args.registration_config,
+        cells_only=args.cells_only,
+        roll_up_hierarchy=args.roll_up_hierarchy,
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,4 +1,5 @@
 import pathlib
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -29,7 +30,17 @@ def save_brain(image, source_image_path, output_path):
 
 
 def get_transform_space_params(registration_config, destination_image):
-    atlas = brainio.load_nii(str(destination_image), as_array=False)
+    atlas_scale, transformation_matrix = _get_transform_space_params(
+        str(registration_config), str(destination_image)
+    )
+    return atlas_scale, transformation_matrix.copy()
+
+
+@lru_cache(maxsize=None)
+def _get_transform_space_params(registration_config, destination_image):
+    # the header is only loaded once per image (e.g. when saving many
+    # segmented regions)
+    atlas = brainio.load_nii(destination_image, as_array=False)
     atlas_scale = atlas.header.get_zooms()
     atlas_pixel_sizes = get_atlas_pixel_sizes(registration_config)
     transformation_matrix = np.eye(4)
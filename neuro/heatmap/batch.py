@@ -0,0 +1,481 @@
+"""
+Generate heatmaps for many brains (listed in a manifest file), in parallel.
+
+The raw image shape of each raw data directory is found once, and each
+target (downsampled) image used for masking is loaded once, and shared
+read-only between the worker processes as a memory-mapped file.
+"""
+
+import os
+import argparse
+import tempfile
+
+from pathlib import Path
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from brainio import brainio
+from imlib.general.numerical import check_positive_float, check_positive_int
+from imlib.general.system import ensure_directory_exists
+
+from neuro.heatmap.heatmap import HeatmapParams, get_raw_image_shape, run
+
+PATH_COLUMNS = [
+    "cells_file",
+    "output_filename",
+    "raw_image",
+    "downsampled_image",
+]
+PARAMETER_COLUMNS = [
+    "bin_size_um",
+    "x_pixel_um",
+    "y_pixel_um",
+    "z_pixel_um",
+    "heatmap_smooth",
+]
+
+# Approximate memory use per voxel of the target image for the in-memory
+# heatmap pipeline (uint16 counts, float64 smoothing and masking, and the
+# 16 bit conversion), not including the atlas itself.
+BYTES_PER_TARGET_VOXEL = 20
+# Approximate memory use per raw image space bin (int64 counts and the uint16
+# copy that is resized)
+BYTES_PER_RAW_BIN = 10
+
+
+def read_manifest(manifest_file, defaults):
+    """
+    Reads a manifest of brains to process. The manifest can be a csv file
+    (one row per brain) or a yaml file (a list of brains, or a dict with a
+    "brains" list). Each brain must define "cells_file", "output_filename",
+    "raw_image" and "downsampled_image", and can override any of
+    "bin_size_um", "x_pixel_um", "y_pixel_um", "z_pixel_um" and
+    "heatmap_smooth". Relative paths are relative to the manifest file.
+    :param manifest_file: Path to the manifest file
+    :param defaults: Dict of default parameters (for values that are not
+    given in the manifest)
+    :return: List of dicts, one per brain
+    """
+    manifest_file = Path(manifest_file)
+    if manifest_file.suffix in (".yml", ".yaml"):
+        import yaml
+
+        with open(manifest_file, "r") as f:
+            entries = yaml.safe_load(f)
+        if isinstance(entries, dict):
+            entries = entries["brains"]
+    else:
+        entries = pd.read_csv(manifest_file).to_dict("records")
+
+    brains = []
+    for idx, entry in enumerate(entries):
+        brain = dict(defaults)
+        for key, value in entry.items():
+            if not pd.isnull(value):
+                brain[key] = value
+
+        for key in PATH_COLUMNS:
+            if key not in brain:
+                raise ValueError(
+                    f"Brain {idx} in manifest: {manifest_file} has no "
+                    f"'{key}'"
+                )
+            path = Path(brain[key])
+            if not path.is_absolute():
+                path = manifest_file.parent / path
+            brain[key] = str(path)
+
+        for key in PARAMETER_COLUMNS:
+            if brain.get(key) is None:
+                raise ValueError(
+                    f"Brain {idx} in manifest: {manifest_file} has no "
+                    f"'{key}', and no default was given"
+                )
+            brain[key] = float(brain[key])
+        brains.append(brain)
+    return brains
+
+
+def get_raw_image_shapes(brains):
+    """
+    Finds the shape of each (unique) raw image
+    :param brains: List of brains (from read_manifest)
+    :return: Dict of raw image path: shape dict
+    """
+    shapes = {}
+    for brain in brains:
+        raw_image = brain["raw_image"]
+        if raw_image not in shapes:
+            print(f"Checking raw image size: {raw_image}")
+            shapes[raw_image] = get_raw_image_shape(raw_image)
+    return shapes
+
+
+def share_atlases(brains, directory):
+    """
+    Loads each (unique) target image once, and saves it as a .npy file, so
+    it can be memory-mapped (read-only) by every worker process
+    :param brains: List of brains (from read_manifest)
+    :param directory: Directory to save the shared arrays in
+    :return: Dict of target image path: shared array path
+    """
+    shared = {}
+    for brain in brains:
+        target_image = brain["downsampled_image"]
+        if target_image not in shared:
+            print(f"Loading target image: {target_image}")
+            shared_path = Path(directory) / f"atlas_{len(shared)}.npy"
+            np.save(
+                str(shared_path),
+                np.asanyarray(brainio.load_nii(target_image).dataobj),
+            )
+            shared[target_image] = str(shared_path)
+    return shared
+
+
+def estimate_memory(brain, raw_image_shape, chunked_processing, memory_budget):
+    """
+    Approximate peak memory use (in bytes) of generating a single heatmap
+    :param brain: Brain (from read_manifest)
+    :param raw_image_shape: Shape dict of the raw image
+    :param chunked_processing: Whether the chunked processing is used
+    :param memory_budget: Memory budget of the chunked processing (bytes)
+    :return: Estimated memory use in bytes
+    """
+    target_shape = brainio.load_nii(brain["downsampled_image"]).shape
+    target_voxels = np.prod(target_shape, dtype=np.float64)
+    raw_bins = 1.0
+    for axis in ("x", "y", "z"):
+        bin_size = int(brain["bin_size_um"] / brain[f"{axis}_pixel_um"])
+        raw_bins *= raw_image_shape[axis] / max(bin_size, 1)
+
+    if chunked_processing:
+        processing = memory_budget + 4 * target_voxels
+    else:
+        processing = BYTES_PER_TARGET_VOXEL * target_voxels
+    # cell positions and types (smaller than the xml they are read from)
+    cells = 0
+    if os.path.exists(brain["cells_file"]):
+        cells = os.path.getsize(brain["cells_file"])
+    return processing + BYTES_PER_RAW_BIN * raw_bins + cells
+
+
+def get_n_workers(memory_estimates, n_workers, max_memory):
+    """
+    Limits the number of worker processes, so that the (estimated) memory
+    use of the largest brains processed at once stays below max_memory
+    :param memory_estimates: List of estimated memory use per brain (bytes)
+    :param n_workers: Requested number of worker processes
+    :param max_memory: Memory cap (bytes), or None for no cap
+    :return: Number of worker processes to use
+    """
+    if max_memory is None:
+        return n_workers
+    largest = sorted(memory_estimates, reverse=True)
+    workers = 1
+    while (
+        workers < min(n_workers, len(largest))
+        and sum(largest[: workers + 1]) <= max_memory
+    ):
+        workers += 1
+    return workers
+
+
+def run_brain(brain, raw_image_shape, shared_atlas, options):
+    """
+    Generates the heatmap of a single brain (run in a worker process)
+    :param brain: Brain (from read_manifest)
+    :param raw_image_shape: Shape dict of the raw image
+    :param shared_atlas: Path to the shared target image array, or None
+    :param options: Dict of options passed to neuro.heatmap.heatmap.run
+    :return: Dict of the timing and status of the heatmap generation
+    """
+    start = timer()
+    result = {
+        "cells_file": brain["cells_file"],
+        "output_filename": brain["output_filename"],
+    }
+    try:
+        atlas = None
+        if shared_atlas is not None:
+            atlas = np.load(shared_atlas, mmap_mode="r")
+
+        params = HeatmapParams(
+            brain["raw_image"],
+            brain["downsampled_image"],
+            brain["bin_size_um"],
+            brain["x_pixel_um"],
+            brain["y_pixel_um"],
+            brain["z_pixel_um"],
+            brain["heatmap_smooth"],
+            raw_image_shape=raw_image_shape,
+            atlas_data=atlas,
+        )
+        run(
+            brain["cells_file"],
+            brain["output_filename"],
+            params.figure_image_shape,
+            params.raw_image_shape,
+            params.bin_size_raw_voxels,
+            params.transformation_matrix,
+            params.atlas_scale,
+            smoothing=params.smoothing_target_voxel,
+            atlas=atlas,
+            **options,
+        )
+        result["status"] = "success"
+        result["error"] = ""
+    except Exception as err:
+        result["status"] = "failed"
+        result["error"] = f"{type(err).__name__}: {err}"
+
+    result["time_s"] = timer() - start
+    return result
+
+
+def run_batch(
+    manifest_file,
+    timing_report,
+    defaults,
+    n_workers=1,
+    max_memory=None,
+    masking=True,
+    tmp_directory=None,
+    **options,
+):
+    """
+    Generates heatmaps for all the brains in a manifest, using a pool of
+    worker processes.
+    :param manifest_file: Path to the manifest file (see read_manifest)
+    :param timing_report: Path to save the (csv) timing report to
+    :param defaults: Dict of default parameters (see read_manifest)
+    :param n_workers: Maximum number of worker processes
+    :param max_memory: Approximate memory cap (bytes) for all the workers
+    combined. The number of workers is reduced to stay below this.
+    :param masking: Whether or not to mask the heatmaps
+    :param tmp_directory: Where to save the shared target images. Defaults to
+    the system temporary directory.
+    :param options: Other options passed to neuro.heatmap.heatmap.run
+    :return: pd.DataFrame of the timing report
+    """
+    batch_start = timer()
+    brains = read_manifest(manifest_file, defaults)
+    print(f"Generating heatmaps for {len(brains)} brains")
+
+    raw_image_shapes = get_raw_image_shapes(brains)
+    memory_estimates = [
+        estimate_memory(
+            brain,
+            raw_image_shapes[brain["raw_image"]],
+            options.get("chunked_processing", False),
+            options.get("memory_budget", 2e9),
+        )
+        for brain in brains
+    ]
+    n_workers = get_n_workers(memory_estimates, n_workers, max_memory)
+    print(f"Using {n_workers} worker processes")
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmp_directory) as shared_directory:
+        shared_atlases = {}
+        if masking:
+            shared_atlases = share_atlases(brains, shared_directory)
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(
+                    run_brain,
+                    brain,
+                    raw_image_shapes[brain["raw_image"]],
+                    shared_atlases.get(brain["downsampled_image"]),
+                    dict(mask=masking, **options),
+                )
+                for brain in brains
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(
+                    f"[{len(results)}/{len(brains)}] {result['status']}: "
+                    f"{result['cells_file']} ({result['time_s']:.1f}s)"
+                )
+                if result["error"]:
+                    print(result["error"])
+
+    report = pd.DataFrame(
+        results,
+        columns=[
+            "cells_file",
+            "output_filename",
+            "status",
+            "error",
+            "time_s",
+        ],
+    )
+    ensure_directory_exists(Path(timing_report).parent)
+    report.to_csv(timing_report, index=False)
+
+    n_failed = (report["status"] != "success").sum()
+    print(
+        f"Finished {len(brains)} brains ({n_failed} failed) in "
+        f"{timer() - batch_start:.1f}s. Timing report saved to: "
+        f"{timing_report}"
+    )
+    return report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        dest="manifest_file",
+        type=str,
+        help="Manifest (csv or yaml) of the brains to process. Each brain "
+        "must have a 'cells_file', 'output_filename', 'raw_image' and "
+        "'downsampled_image', and may override any of 'bin_size_um', "
+        "'x_pixel_um', 'y_pixel_um', 'z_pixel_um' and 'heatmap_smooth'.",
+    )
+    parser.add_argument(
+        "--timing-report",
+        dest="timing_report",
+        type=str,
+        default=None,
+        help="Path to save the timing report (csv) to. Defaults to "
+        "'heatmap_timings.csv' next to the manifest.",
+    )
+    parser.add_argument(
+        "--n-workers",
+        dest="n_workers",
+        type=check_positive_int,
+        default=1,
+        help="Maximum number of brains to process in parallel.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory_gb",
+        type=check_positive_float,
+        default=None,
+        help="Approximate memory cap (in GB) for all workers combined. The "
+        "number of workers is reduced to stay below this.",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        dest="tmp_directory",
+        type=str,
+        default=None,
+        help="Directory to store the shared target images in.",
+    )
+    parser.add_argument(
+        "--bin-size",
+        dest="bin_size_um",
+        type=check_positive_float,
+        default=100,
+        help="Default heatmap bin size (um of each edge of histogram cube)",
+    )
+    parser.add_argument(
+        "-x",
+        "--x-pixel-um",
+        dest="x_pixel_um",
+        type=check_positive_float,
+        default=None,
+        help="Default pixel spacing of the data in the first "
+        "dimension, specified in um.",
+    )
+    parser.add_argument(
+        "-y",
+        "--y-pixel-um",
+        dest="y_pixel_um",
+        type=check_positive_float,
+        default=None,
+        help="Default pixel spacing of the data in the second "
+        "dimension, specified in um.",
+    )
+    parser.add_argument(
+        "-z",
+        "--z-pixel-um",
+        dest="z_pixel_um",
+        type=check_positive_float,
+        default=None,
+        help="Default pixel spacing of the data in the third "
+        "dimension, specified in um.",
+    )
+    parser.add_argument(
+        "--heatmap-smoothing",
+        dest="heatmap_smooth",
+        type=check_positive_float,
+        default=100,
+        help="Default Gaussian smoothing sigma, in um.",
+    )
+    parser.add_argument(
+        "--no-mask-figs",
+        dest="mask_figures",
+        action="store_false",
+        help="Don't mask the figures (removing any areas outside the brain,"
+        "from e.g. smoothing)",
+    )
+    parser.add_argument(
+        "--target-space-binning",
+        dest="bin_in_target_space",
+        action="store_true",
+        help="Bin the cells directly into the target image space.",
+    )
+    parser.add_argument(
+        "--trilinear",
+        dest="trilinear",
+        action="store_true",
+        help="Bin the cells in target space, with trilinear splatting.",
+    )
+    parser.add_argument(
+        "--chunked",
+        dest="chunked_processing",
+        action="store_true",
+        help="Smooth, mask and save each heatmap block by block.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        dest="memory_budget_gb",
+        type=check_positive_float,
+        default=2,
+        help="Approximate peak memory usage (in GB) per brain when using "
+        "'--chunked'.",
+    )
+    return parser
+
+
+def cli():
+    args = get_parser().parse_args()
+    timing_report = args.timing_report
+    if timing_report is None:
+        timing_report = Path(args.manifest_file).parent / "heatmap_timings.csv"
+
+    max_memory = None
+    if args.max_memory_gb is not None:
+        max_memory = args.max_memory_gb * 1e9
+
+    defaults = {
+        "bin_size_um": args.bin_size_um,
+        "x_pixel_um": args.x_pixel_um,
+        "y_pixel_um": args.y_pixel_um,
+        "z_pixel_um": args.z_pixel_um,
+        "heatmap_smooth": args.heatmap_smooth,
+    }
+    run_batch(
+        args.manifest_file,
+        timing_report,
+        defaults,
+        n_workers=args.n_workers,
+        max_memory=max_memory,
+        masking=args.mask_figures,
+        tmp_directory=args.tmp_directory,
+        bin_in_target_space=args.bin_in_target_space,
+        trilinear=args.trilinear,
+        chunked_processing=args.chunked_processing,
+        memory_budget=args.memory_budget_gb * 1e9,
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,248 @@
+"""
+Fast binning of cell positions into 3D histograms, using integer division
+and np.bincount rather than np.histogramdd. Cells can be split into groups
+(e.g. cell type, or channel), and all the histograms built in one pass.
+"""
+
+import numpy as np
+
+
+def get_number_of_bins(image_shape, bin_sizes):
+    """
+    Returns the number of bins along each dimension, matching the bin
+    boundaries returned by imlib.image.binning.get_bins (i.e. the final,
+    partial bin is discarded)
+    :param image_shape: Size of the image (tuple/list)
+    :param bin_sizes: Bin sizes corresponding to the dimensions of
+    "image_shape" (tuple/list)
+    :return: Tuple of the number of bins in each dimension
+    """
+    return tuple(
+        max(len(range(0, int(size), int(bin_size))) - 1, 0)
+        for size, bin_size in zip(image_shape, bin_sizes)
+    )
+
+
+def bin_cells(cells_array, image_shape, bin_sizes, groups=None, n_groups=1):
+    """
+    Generates a 3D histogram of cell positions. The output is identical to
+    np.histogramdd(cells_array, bins=get_bins(image_shape, bin_sizes)), but
+    the bin of each cell is found by integer division, and the histogram is
+    accumulated with np.bincount.
+
+    As with np.histogramdd, cells outside the bin boundaries are ignored, and
+    cells lying exactly on the final bin edge are added to the final bin.
+    :param cells_array: Array of cell positions (one row per cell)
+    :param image_shape: Size of the image the cells are defined in
+    :param bin_sizes: Size of the bins (in the same units as the cell
+    positions) in each dimension
+    :param groups: Optional array of the group (0 to n_groups - 1) of each
+    cell. If given, one histogram is generated per group.
+    :param n_groups: Number of groups
+    :return: Array of cell counts (int64). If groups is given, the first
+    dimension is the group.
+    """
+    cells_array = np.asarray(cells_array)
+    n_bins = get_number_of_bins(image_shape, bin_sizes)
+    output_shape = n_bins if groups is None else (n_groups,) + n_bins
+    if 0 in n_bins or len(cells_array) == 0:
+        return np.zeros(output_shape, dtype=np.int64)
+
+    linear_index = np.zeros(len(cells_array), dtype=np.int64)
+    valid = np.ones(len(cells_array), dtype=bool)
+    for dim, (num, bin_size) in enumerate(zip(n_bins, bin_sizes)):
+        positions = cells_array[:, dim]
+        last_edge = num * int(bin_size)
+        valid &= (positions >= 0) & (positions <= last_edge)
+
+        index = np.floor_divide(positions, int(bin_size))
+        # cells on the last edge are included in the final bin
+        index = np.minimum(index, num - 1).astype(np.int64)
+        linear_index *= num
+        linear_index += index
+
+    n_voxels = int(np.prod(n_bins))
+    if groups is not None:
+        # offset each group, so all the histograms are built at once
+        linear_index += np.asarray(groups, dtype=np.int64) * n_voxels
+
+    counts = np.bincount(linear_index[valid], minlength=n_voxels * n_groups)
+    return counts.reshape(output_shape)
+
+
+def get_scale(raw_image_shape, target_shape):
+    """
+    Returns the scaling from the raw image space to the target image space
+    :param raw_image_shape: Size of the raw image
+    :param target_shape: Size of the target image
+    :return: Array of scale factors, one per dimension
+    """
+    return np.asarray(target_shape, dtype=np.float64) / np.asarray(
+        raw_image_shape, dtype=np.float64
+    )
+
+
+def bin_cells_target_space(
+    cells_array,
+    raw_image_shape,
+    target_shape,
+    trilinear=False,
+    chunk_size=1000000,
+    groups=None,
+    n_groups=1,
+):
+    """
+    Generates a 3D histogram of cell positions directly at the resolution of
+    the target image, rather than binning in raw image space and resizing.
+    Cell positions (voxel indices in raw image space) are scaled by the ratio
+    of the target and raw image shapes.
+
+    The volume is accumulated in chunks of cells, so that no intermediate
+    array larger than the target image is created.
+    :param cells_array: Array of cell positions in raw image space (one row
+    per cell)
+    :param raw_image_shape: Size of the raw image
+    :param target_shape: Size of the target image
+    :param trilinear: If True, each cell is split between the eight nearest
+    target voxels (trilinear splatting), rather than added to the single
+    voxel it falls in
+    :param chunk_size: How many cells to process at once
+    :param groups: Optional array of the group (0 to n_groups - 1) of each
+    cell. If given, one histogram is generated per group.
+    :param n_groups: Number of groups
+    :return: Array of target image shape. uint32 cell counts, or float32
+    cell densities if trilinear=True. If groups is given, the first dimension
+    is the group.
+    """
+    cells_array = np.asarray(cells_array)
+    target_shape = tuple(int(size) for size in target_shape)
+    scale = get_scale(raw_image_shape, target_shape)
+    if groups is None:
+        groups = np.zeros(len(cells_array), dtype=np.int64)
+        output_shape = target_shape
+    else:
+        groups = np.asarray(groups, dtype=np.int64)
+        output_shape = (n_groups,) + target_shape
+
+    dtype = np.float32 if trilinear else np.uint32
+    heatmap_array = np.zeros((n_groups,) + target_shape, dtype=dtype)
+    add_to_volume = _splat_trilinear if trilinear else _add_nearest
+
+    for start in range(0, len(cells_array), chunk_size):
+        # scale the voxel centres, not their corners
+        positions = (
+            cells_array[start : start + chunk_size].astype(np.float64) + 0.5
+        ) * scale
+        add_to_volume(
+            heatmap_array, positions, groups[start : start + chunk_size]
+        )
+
+    return heatmap_array.reshape(output_shape)
+
+
+def _accumulate(volume, linear_index, weights=None):
+    """
+    Adds (optionally weighted) counts to a volume at the given linear
+    indices, without creating a full size intermediate array
+    """
+    unique_index, inverse = np.unique(linear_index, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=weights)
+    flat_volume = volume.reshape(-1)
+    flat_volume[unique_index] += totals.astype(volume.dtype)
+
+
+def _get_linear_index(volume, index, groups):
+    """
+    Returns the linear index (into a volume with the groups as the first
+    dimension) of the cells within the volume, and which cells these are
+    """
+    valid = ((index >= 0) & (index < volume.shape[1:])).all(axis=1)
+    linear_index = np.ravel_multi_index(
+        np.column_stack([groups[valid], index[valid]]).T, volume.shape
+    )
+    return linear_index, valid
+
+
+def _add_nearest(volume, positions, groups):
+    index = np.floor(positions).astype(np.int64)
+    linear_index, _ = _get_linear_index(volume, index, groups)
+    _accumulate(volume, linear_index)
+
+
+def _splat_trilinear(volume, positions, groups):
+    # position relative to the centres of the target voxels
+    positions = positions - 0.5
+    lower = np.floor(positions).astype(np.int64)
+    fraction = positions - lower
+
+    for corner in np.ndindex(2, 2, 2):
+        index = lower + corner
+        weights = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+        linear_index, valid = _get_linear_index(volume, index, groups)
+        _accumulate(volume, linear_index, weights=weights[valid])
+
+
+def is_multiple(bin_sizes, coarse_bin_sizes):
+    """
+    Returns whether each coarse bin size is an integer multiple of the
+    corresponding bin size (so the coarse histogram can be derived from the
+    finer one)
+    :param bin_sizes: Fine bin sizes
+    :param coarse_bin_sizes: Coarse bin sizes
+    :return: True if all the coarse bin sizes are multiples
+    """
+    return all(
+        int(coarse) % int(fine) == 0
+        for fine, coarse in zip(bin_sizes, coarse_bin_sizes)
+    )
+
+
+def rebin_cells(counts, cells_array, image_shape, bin_sizes, coarse_bin_sizes):
+    """
+    Derives a coarser histogram from one generated by bin_cells, by summing
+    blocks of bins. The output is identical to
+    bin_cells(cells_array, image_shape, coarse_bin_sizes).
+
+    Cells lying exactly on the final edge of the coarse histogram belong to
+    the final coarse bin, but (unless this is also the final edge of the fine
+    histogram) are counted in a fine bin outside of the coarse histogram.
+    These cells are added separately.
+    :param counts: Histogram from bin_cells(cells_array, image_shape,
+    bin_sizes)
+    :param cells_array: Array of cell positions (one row per cell)
+    :param image_shape: Size of the image the cells are defined in
+    :param bin_sizes: Bin sizes of "counts" in each dimension
+    :param coarse_bin_sizes: Bin sizes (integer multiples of "bin_sizes") of
+    the coarse histogram
+    :return: Array of cell counts (int64)
+    """
+    if not is_multiple(bin_sizes, coarse_bin_sizes):
+        raise ValueError(
+            f"Bin sizes: {coarse_bin_sizes} are not multiples of the bin "
+            f"sizes: {bin_sizes}"
+        )
+    cells_array = np.asarray(cells_array)
+    n_bins = get_number_of_bins(image_shape, coarse_bin_sizes)
+    factors = [
+        int(coarse) // int(fine)
+        for fine, coarse in zip(bin_sizes, coarse_bin_sizes)
+    ]
+
+    blocks = counts[tuple(slice(0, n * f) for n, f in zip(n_bins, factors))]
+    block_shape = []
+    for n, f in zip(n_bins, factors):
+        block_shape.extend([n, f])
+    coarse_counts = blocks.reshape(block_shape).sum(
+        axis=tuple(range(1, 2 * len(n_bins), 2)), dtype=np.int64
+    )
+
+    on_edge = np.zeros(len(cells_array), dtype=bool)
+    for dim, (n, f) in enumerate(zip(n_bins, factors)):
+        if n * f < counts.shape[dim]:
+            last_edge = n * int(coarse_bin_sizes[dim])
+            on_edge |= cells_array[:, dim] == last_edge
+    if on_edge.any():
+        coarse_counts += bin_cells(
+            cells_array[on_edge], image_shape, coarse_bin_sizes
+        )
+    return coarse_counts
@@ -0,0 +1,261 @@
+"""
+Out-of-core smoothing and masking of heatmaps. The volume is processed in
+float32 blocks (with a halo so that the smoothing is identical to that of
+the whole volume), each block is masked against a (memory-mapped) atlas, and
+the result is streamed to disk, so that the peak memory usage is bounded by
+a configurable budget.
+"""
+
+import logging
+import tempfile
+
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import dask.array as da
+from scipy.ndimage import gaussian_filter
+
+from neuro.heatmap.ome_zarr import is_ome_zarr, save_ome_zarr
+
+# Matches the default of skimage.filters.gaussian
+GAUSSIAN_TRUNCATE = 4.0
+
+# Approximate working memory per voxel of each block (including the halo).
+# The float32 block, its smoothed copy, the overlapping copy made by dask,
+# and the atlas block and mask.
+BYTES_PER_VOXEL = 16
+
+
+def get_halo(smoothing, truncate=GAUSSIAN_TRUNCATE):
+    """
+    Returns the size of the gaussian kernel radius (the halo needed around
+    each block)
+    :param smoothing: Gaussian sigma (in voxels), or None
+    :param truncate: Truncate the kernel at this many standard deviations
+    :return: Halo size (in voxels)
+    """
+    if not smoothing:
+        return 0
+    return int(truncate * float(smoothing) + 0.5)
+
+
+def get_chunk_shape(
+    shape, halo, memory_budget, n_workers=1, bytes_per_voxel=BYTES_PER_VOXEL
+):
+    """
+    Calculates a block shape such that each block (with its halo) can be
+    processed within the memory budget. The volume is split into slabs along
+    the last axis, and then along the other axes if a single slab is still
+    too large.
+    :param shape: Shape of the full volume
+    :param halo: Halo (in voxels) added to each side of each block
+    :param memory_budget: Memory budget in bytes (shared between all workers)
+    :param n_workers: Number of blocks processed at once
+    :param bytes_per_voxel: Working memory per voxel of each block
+    :return: Tuple of the block shape
+    """
+    budget_voxels = memory_budget / (bytes_per_voxel * n_workers)
+    chunk_shape = list(shape)
+    for axis in reversed(range(len(shape))):
+        other_axes = np.prod(
+            [
+                size + 2 * halo
+                for i, size in enumerate(chunk_shape)
+                if i != axis
+            ]
+        )
+        size = int(budget_voxels // other_axes) - 2 * halo
+        # blocks must be at least as large as the halo
+        chunk_shape[axis] = int(min(shape[axis], max(size, halo, 1)))
+        if size >= 1:
+            break
+
+    block_voxels = np.prod([size + 2 * halo for size in chunk_shape])
+    if block_voxels > budget_voxels:
+        logging.warning(
+            "Heatmap blocks ({}) are larger than the memory budget allows. "
+            "The memory budget may be exceeded.".format(tuple(chunk_shape))
+        )
+    return tuple(chunk_shape)
+
+
+def smooth_and_mask(
+    heatmap_array,
+    output_array,
+    smoothing=None,
+    atlas=None,
+    memory_budget=2e9,
+    n_workers=1,
+):
+    """
+    Smooths (gaussian) and masks a heatmap block by block (in float32), and
+    stores the result in "output_array" (e.g. a memory-mapped file).
+    :param heatmap_array: Unsmoothed heatmap (any array-like)
+    :param output_array: Array (same shape as heatmap_array) to store the
+    result in
+    :param smoothing: Gaussian sigma (in voxels), or None to not smooth
+    :param atlas: Atlas (any array-like, e.g. a memmap) to mask the heatmap.
+    Voxels where the atlas is 0 are set to 0. If None, no masking is applied.
+    :param memory_budget: Approximate peak memory usage (in bytes)
+    :param n_workers: How many blocks to process in parallel
+    """
+    halo = get_halo(smoothing)
+    chunk_shape = get_chunk_shape(
+        heatmap_array.shape, halo, memory_budget, n_workers=n_workers
+    )
+    logging.debug(
+        "Processing heatmap in blocks of {}, with a halo of {} voxels".format(
+            chunk_shape, halo
+        )
+    )
+    heatmap = da.from_array(heatmap_array, chunks=chunk_shape).astype(
+        np.float32
+    )
+    if halo > 0:
+        heatmap = heatmap.map_overlap(
+            gaussian_filter,
+            depth=halo,
+            boundary="nearest",
+            dtype=np.float32,
+            sigma=smoothing,
+            mode="nearest",
+            truncate=GAUSSIAN_TRUNCATE,
+        )
+    if atlas is not None:
+        mask = da.from_array(atlas, chunks=chunk_shape) > 0
+        heatmap = da.where(mask, heatmap, np.float32(0))
+
+    da.store(
+        heatmap,
+        output_array,
+        lock=False,
+        scheduler="threads",
+        num_workers=n_workers,
+    )
+
+
+def convert_to_16_bits(image, output_array, memory_budget=2e9, n_workers=1):
+    """
+    Block by block equivalent of
+    imlib.image.scale.scale_and_convert_to_16_bits
+    :param image: Input image (e.g. a memory-mapped file)
+    :param output_array: uint16 array to store the result in
+    :param memory_budget: Approximate peak memory usage (in bytes)
+    :param n_workers: How many blocks to process in parallel
+    """
+    chunk_shape = get_chunk_shape(
+        image.shape, 0, memory_budget, n_workers=n_workers
+    )
+    image = da.from_array(image, chunks=chunk_shape)
+    maximum = image.max().compute(scheduler="threads", num_workers=n_workers)
+    scaled = (image / maximum) * (2 ** 16 - 1)
+    da.store(
+        scaled.astype(np.uint16),
+        output_array,
+        lock=False,
+        scheduler="threads",
+        num_workers=n_workers,
+    )
+
+
+def run(
+    heatmap_array,
+    output_filename,
+    atlas_scale,
+    transformation_matrix,
+    smoothing=None,
+    mask=True,
+    atlas=None,
+    convert_16bit=True,
+    memory_budget=2e9,
+    n_workers=1,
+):
+    """
+    Smooths, masks, and converts a heatmap, and saves it as a nifti file,
+    without holding more than one block of the processed volume in memory.
+    Intermediate results are stored in temporary files in the output
+    directory.
+    :param heatmap_array: Unsmoothed heatmap. If 4D, the first dimension is
+    treated as separate heatmaps (e.g. cell types), each is processed (and
+    converted to 16 bit) independently, and they are saved as a 4D nifti,
+    with the heatmaps along the last dimension.
+    :param output_filename: File to save heatmap into
+    :param atlas_scale: Image scaling so that the resulting nifti can be
+    processed using other tools.
+    :param transformation_matrix: Transformation matrix so that the resulting
+    nifti can be processed using other tools.
+    :param smoothing: Smoothing kernel size, in the target image space
+    :param mask: Whether or not to mask the heatmap based on an atlas file
+    :param atlas: Atlas (e.g. a memmap) to mask the heatmap
+    :param convert_16bit: Convert final image to 16 bit
+    :param memory_budget: Approximate peak memory usage (in bytes)
+    :param n_workers: How many blocks to process in parallel
+    """
+    if not mask:
+        atlas = None
+
+    heatmaps = heatmap_array
+    if heatmap_array.ndim == 3:
+        heatmaps = heatmap_array[np.newaxis]
+    output_shape = heatmaps.shape[1:] + heatmaps.shape[:1]
+
+    output_filename = Path(output_filename)
+    with tempfile.TemporaryDirectory(dir=output_filename.parent) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        processed = np.memmap(
+            tmp_dir / "processed.dat",
+            dtype=np.float32,
+            mode="w+",
+            shape=output_shape,
+        )
+        logging.debug("Smoothing and masking heatmap in blocks")
+        for idx, heatmap in enumerate(heatmaps):
+            smooth_and_mask(
+                heatmap,
+                processed[..., idx],
+                smoothing=smoothing,
+                atlas=atlas,
+                memory_budget=memory_budget,
+                n_workers=n_workers,
+            )
+
+        if convert_16bit:
+            logging.debug("Converting to 16 bit")
+            converted = np.memmap(
+                tmp_dir / "converted.dat",
+                dtype=np.uint16,
+                mode="w+",
+                shape=output_shape,
+            )
+            for idx in range(len(heatmaps)):
+                convert_to_16_bits(
+                    processed[..., idx],
+                    converted[..., idx],
+                    memory_budget=memory_budget,
+                    n_workers=n_workers,
+                )
+            del processed
+            processed = converted
+            del converted
+
+        if heatmap_array.ndim == 3:
+            processed = processed[..., 0]
+
+        logging.debug("Saving heatmap image")
+        if is_ome_zarr(output_filename):
+            # the pyramid is written slab by slab
+            save_ome_zarr(
+                processed,
+                output_filename,
+                atlas_scale[:3],
+                affine=transformation_matrix,
+            )
+        else:
+            # nibabel writes the (memory-mapped) data to disk slice by slice
+            image = nib.Nifti1Image(processed, transformation_matrix)
+            image.header.set_zooms(
+                tuple(atlas_scale) + (1,) * (processed.ndim - len(atlas_scale))
+            )
+            nib.save(image, str(output_filename))
+            del image
+        del processed
@@ -10,15 +10,25 @@ from pathlib import Path
 import numpy as np
 from skimage.filters import gaussian
 from brainio import brainio
-from imlib.cells.utils import get_cell_location_array
+from imlib.cells.cells import Cell
 from imlib.image.scale import scale_and_convert_to_16_bits
-from imlib.image.binning import get_bins
 from imlib.image.shape import convert_shape_dict_to_array_shape
 from imlib.image.masking import mask_image_threshold
 from imlib.general.numerical import check_positive_float
 from imlib.general.system import ensure_directory_exists
 from imlib.image.size import resize_array
 
+from neuro.cache import load_metadata_cache, save_metadata_cache
+from neuro.cells.IO import load_cell_arrays
+from neuro.heatmap import chunked, incremental
+from neuro.heatmap.binning import (
+    bin_cells,
+    bin_cells_target_space,
+    is_multiple,
+    rebin_cells,
+)
+from neuro.heatmap.ome_zarr import is_ome_zarr, save_ome_zarr
+
 
 def run(
     cells_file,
@@ -33,11 +43,21 @@ def run(
     atlas=None,
     cells_only=True,
     convert_16bit=True,
+    bin_in_target_space=False,
+    trilinear=False,
+    chunked_processing=False,
+    memory_budget=2e9,
+    group_by_type=False,
+    output_4d=False,
+    save_counts=False,
 ):
     """
 
-    :param cells_file: Cellfinder output cells file.
-    :param output_filename: File to save heatmap into
+    :param cells_file: Cellfinder output cells file, or a list of cell files
+    (e.g. one per channel), in which case one heatmap is generated per file.
+    :param output_filename: File to save heatmap into. If more than one
+    heatmap is generated (and output_4d is False), the name of each group is
+    added to the file name, e.g. heatmap_cells.nii.
     :param target_size: Size of the final heatmap
     :param raw_image_shape: Size of the raw data (coordinate space of the
     cells)
@@ -52,7 +72,24 @@ def run(
     :param atlas: Atlas file to mask the heatmap
     :param cells_only: Only use "cells", not artefacts
     :param convert_16bit: Convert final image to 16 bit
-
+    :param bin_in_target_space: Bin the cells directly into the target image
+    space (one bin per target voxel), rather than binning in raw image space
+    and resizing. "raw_image_bin_sizes" is then ignored.
+    :param trilinear: When binning in target space, split each cell between
+    the eight nearest target voxels (trilinear splatting)
+    :param chunked_processing: Smooth, mask and save the heatmap block by
+    block (in float32), to limit the peak memory usage
+    :param memory_budget: Approximate peak memory usage (in bytes) of the
+    chunked processing
+    :param group_by_type: Generate separate heatmaps of cells and non-cells
+    ("cells_only" is then ignored)
+    :param output_4d: Save all the heatmaps in a single 4D nifti file (with
+    the heatmaps along the last dimension), rather than one file per heatmap.
+    Each heatmap is converted to 16 bit independently.
+    :param save_counts: Save the unsmoothed cell counts (and the smoothed
+    heatmap) next to the output, so that the heatmap can be updated
+    incrementally (see neuro.heatmap.incremental). Not supported with
+    chunked processing, or more than one heatmap.
 
     """
 
@@ -61,17 +98,301 @@ def run(
     raw_image_shape = convert_shape_dict_to_array_shape(
         raw_image_shape, type="fiji"
     )
+    grouped = group_by_type or isinstance(cells_file, (list, tuple))
+    if save_counts and (grouped or chunked_processing):
+        raise ValueError(
+            "Saving the cell counts is not supported with chunked "
+            "processing, or with more than one heatmap"
+        )
+    if grouped:
+        cells_array, groups, group_names = get_grouped_cell_location_array(
+            cells_file, group_by_type=group_by_type, cells_only=cells_only
+        )
+    else:
+        cells_array = get_cell_location_array(
+            cells_file, cells_only=cells_only
+        )
+        groups = None
+        group_names = [None]
+
+    if bin_in_target_space or trilinear:
+        logging.debug("Generating heatmap (3D histogram) in target space")
+        heatmap_arrays = bin_cells_target_space(
+            cells_array,
+            raw_image_shape,
+            target_size,
+            trilinear=trilinear,
+            groups=groups,
+            n_groups=len(group_names),
+        )
+        counts = heatmap_arrays
+    else:
+        logging.debug("Generating heatmap (3D histogram)")
+        heatmap_arrays = bin_cells(
+            cells_array,
+            raw_image_shape,
+            raw_image_bin_sizes,
+            groups=groups,
+            n_groups=len(group_names),
+        )
+        counts = heatmap_arrays
+        # otherwise resized array is too big to fit into RAM
+        heatmap_arrays = heatmap_arrays.astype(np.uint16)
+
+        logging.debug("Resizing heatmap to the size of the target image")
+        if grouped:
+            heatmap_arrays = np.stack(
+                [resize_array(array, target_size) for array in heatmap_arrays]
+            )
+        else:
+            heatmap_arrays = resize_array(heatmap_arrays, target_size)
+    del cells_array
+
+    logging.debug("Ensuring output directory exists")
+    ensure_directory_exists(Path(output_filename).parent)
+
+    if not grouped:
+        heatmap_arrays = heatmap_arrays[np.newaxis]
+    elif output_4d:
+        logging.debug(
+            "Saving heatmaps of: {} to a single image".format(
+                ", ".join(group_names)
+            )
+        )
+
+    if chunked_processing and output_4d:
+        chunked.run(
+            heatmap_arrays,
+            output_filename,
+            atlas_scale,
+            transformation_matrix,
+            smoothing=smoothing,
+            mask=mask,
+            atlas=atlas,
+            convert_16bit=convert_16bit,
+            memory_budget=memory_budget,
+        )
+        return
+
+    processed_arrays = []
+    for group_name, heatmap_array in zip(group_names, heatmap_arrays):
+        filename = output_filename
+        if grouped and not output_4d:
+            filename = get_group_filename(output_filename, group_name)
+
+        if chunked_processing:
+            chunked.run(
+                heatmap_array,
+                filename,
+                atlas_scale,
+                transformation_matrix,
+                smoothing=smoothing,
+                mask=mask,
+                atlas=atlas,
+                convert_16bit=convert_16bit,
+                memory_budget=memory_budget,
+            )
+            continue
+
+        heatmap_array = process_heatmap(
+            heatmap_array,
+            smoothing=smoothing,
+            mask=mask,
+            atlas=atlas,
+            convert_16bit=False,
+        )
+        if save_counts:
+            incremental.save_state(
+                filename,
+                counts,
+                heatmap_array,
+                atlas if mask else None,
+                {
+                    "raw_image_shape": [int(size) for size in raw_image_shape],
+                    "bin_sizes": [int(size) for size in raw_image_bin_sizes],
+                    "bin_in_target_space": bin_in_target_space,
+                    "trilinear": trilinear,
+                    "cells_only": cells_only,
+                    "smoothing": smoothing,
+                    "mask": mask,
+                    "convert_16bit": convert_16bit,
+                    "atlas_scale": [float(scale) for scale in atlas_scale],
+                    "transformation_matrix": np.asarray(
+                        transformation_matrix
+                    ).tolist(),
+                },
+            )
+        if convert_16bit:
+            logging.debug("Converting to 16 bit")
+            heatmap_array = scale_and_convert_to_16_bits(heatmap_array)
+
+        if output_4d:
+            processed_arrays.append(heatmap_array)
+        else:
+            save_heatmap(
+                heatmap_array, filename, atlas_scale, transformation_matrix
+            )
+
+    if output_4d and not chunked_processing:
+        save_heatmap(
+            np.stack(processed_arrays, axis=-1),
+            output_filename,
+            atlas_scale,
+            transformation_matrix,
+        )
+
+
+def run_sweep(
+    cells_file,
+    output_filename,
+    target_size,
+    raw_image_shape,
+    raw_image_bin_sizes,
+    transformation_matrix,
+    atlas_scale,
+    smoothings,
+    mask=True,
+    atlas=None,
+    cells_only=True,
+    convert_16bit=True,
+    bin_in_target_space=False,
+    trilinear=False,
+    chunked_processing=False,
+    memory_budget=2e9,
+):
+    """
+    Generates a heatmap for every combination of bin size and smoothing. The
+    cells are loaded and binned once, at the finest bin size. Coarser bin
+    sizes are derived by summing blocks of bins (if they are multiples of the
+    finest bin size), and each resized heatmap is smoothed with every sigma.
+    The output filenames have the bin size and smoothing added, e.g.
+    heatmap_bin100_smooth50.nii
+
+    :param cells_file: Cellfinder output cells file.
+    :param output_filename: File to save heatmap into
+    :param target_size: Size of the final heatmap
+    :param raw_image_shape: Size of the raw data (coordinate space of the
+    cells)
+    :param raw_image_bin_sizes: Dict of the name of each bin size
+    (e.g. "100") to a list/tuple of the sizes of the bins in the raw data
+    space
+    :param transformation_matrix: Transformation matrix so that the resulting
+    nifti can be processed using other tools.
+    :param atlas_scale: Image scaling so that the resulting nifti can be
+    processed using other tools.
+    :param smoothings: Dict of the name of each smoothing (e.g. "50") to the
+    smoothing kernel size, in the target image space (or None)
+    :param mask: Whether or not to mask the heatmap based on an atlas file
+    :param atlas: Atlas file to mask the heatmap
+    :param cells_only: Only use "cells", not artefacts
+    :param convert_16bit: Convert final image to 16 bit
+    :param bin_in_target_space: Bin the cells directly into the target image
+    space (so only the smoothing is varied)
+    :param trilinear: When binning in target space, split each cell between
+    the eight nearest target voxels (trilinear splatting)
+    :param chunked_processing: Smooth, mask and save the heatmap block by
+    block (in float32), to limit the peak memory usage
+    :param memory_budget: Approximate peak memory usage (in bytes) of the
+    chunked processing
+    """
+    target_size = convert_shape_dict_to_array_shape(target_size, type="fiji")
+    raw_image_shape = convert_shape_dict_to_array_shape(
+        raw_image_shape, type="fiji"
+    )
     cells_array = get_cell_location_array(cells_file, cells_only=cells_only)
-    bins = get_bins(raw_image_shape, raw_image_bin_sizes)
 
-    logging.debug("Generating heatmap (3D histogram)")
-    heatmap_array, _ = np.histogramdd(cells_array, bins=bins)
-    # otherwise resized array is too big to fit into RAM
-    heatmap_array = heatmap_array.astype(np.uint16)
+    logging.debug("Ensuring output directory exists")
+    ensure_directory_exists(Path(output_filename).parent)
 
-    logging.debug("Resizing heatmap to the size of the target image")
-    heatmap_array = resize_array(heatmap_array, target_size)
+    if bin_in_target_space or trilinear:
+        logging.debug("Generating heatmap (3D histogram) in target space")
+        bin_names = [None]
+    else:
+        bin_names = list(raw_image_bin_sizes)
+        fine_name = min(
+            bin_names, key=lambda name: np.prod(raw_image_bin_sizes[name])
+        )
+        fine_bin_sizes = raw_image_bin_sizes[fine_name]
+        logging.debug(
+            f"Generating base heatmap (3D histogram) with a bin size of: "
+            f"{fine_name}"
+        )
+        fine_counts = bin_cells(cells_array, raw_image_shape, fine_bin_sizes)
+
+    for bin_name in bin_names:
+        if bin_name is None:
+            heatmap_array = bin_cells_target_space(
+                cells_array, raw_image_shape, target_size, trilinear=trilinear
+            )
+        else:
+            bin_sizes = raw_image_bin_sizes[bin_name]
+            if is_multiple(fine_bin_sizes, bin_sizes):
+                logging.debug(
+                    f"Deriving heatmap with a bin size of: {bin_name}"
+                )
+                heatmap_array = rebin_cells(
+                    fine_counts,
+                    cells_array,
+                    raw_image_shape,
+                    fine_bin_sizes,
+                    bin_sizes,
+                )
+            else:
+                logging.debug(
+                    f"Bin size: {bin_name} is not a multiple of: {fine_name}, "
+                    f"generating heatmap (3D histogram)"
+                )
+                heatmap_array = bin_cells(
+                    cells_array, raw_image_shape, bin_sizes
+                )
+            heatmap_array = resize_array(
+                heatmap_array.astype(np.uint16), target_size
+            )
+
+        for smoothing_name, smoothing in smoothings.items():
+            name = f"smooth{smoothing_name}"
+            if bin_name is not None:
+                name = f"bin{bin_name}_{name}"
+            filename = get_group_filename(output_filename, name)
+
+            if chunked_processing:
+                chunked.run(
+                    heatmap_array,
+                    filename,
+                    atlas_scale,
+                    transformation_matrix,
+                    smoothing=smoothing,
+                    mask=mask,
+                    atlas=atlas,
+                    convert_16bit=convert_16bit,
+                    memory_budget=memory_budget,
+                )
+                continue
+
+            processed = process_heatmap(
+                heatmap_array,
+                smoothing=smoothing,
+                mask=mask,
+                atlas=atlas,
+                convert_16bit=convert_16bit,
+            )
+            save_heatmap(
+                processed, filename, atlas_scale, transformation_matrix
+            )
 
+
+def process_heatmap(
+    heatmap_array, smoothing=10, mask=True, atlas=None, convert_16bit=True
+):
+    """
+    Smooths, masks and converts a single heatmap
+    :param heatmap_array: Unsmoothed heatmap
+    :param smoothing: Smoothing kernel size, in the target image space
+    :param mask: Whether or not to mask the heatmap based on an atlas file
+    :param atlas: Atlas file to mask the heatmap
+    :param convert_16bit: Convert final image to 16 bit
+    :return: Processed heatmap
+    """
     if smoothing is not None:
         logging.debug(
             "Applying Gaussian smoothing with a kernel sigma of: "
@@ -81,24 +402,157 @@ def run(
 
     if mask:
         logging.debug("Masking image based on registered atlas")
-        # copy, otherwise it's modified, which affects later figure generation
-        heatmap_array = mask_image_threshold(heatmap_array, np.copy(atlas))
-        del atlas
+        # the atlas is copied (not modified) when the mask is made
+        heatmap_array = mask_image_threshold(heatmap_array, atlas)
 
     if convert_16bit:
         logging.debug("Converting to 16 bit")
         heatmap_array = scale_and_convert_to_16_bits(heatmap_array)
+    return heatmap_array
 
-    logging.debug("Ensuring output directory exists")
-    ensure_directory_exists(Path(output_filename).parent)
 
-    logging.debug("Saving heatmap image")
-    brainio.to_nii(
-        heatmap_array,
-        output_filename,
-        scale=atlas_scale,
-        affine_transform=transformation_matrix,
+def save_heatmap(
+    heatmap_array, output_filename, atlas_scale, transformation_matrix
+):
+    """
+    Saves a heatmap as a nifti file, or if the filename ends in ".zarr", as a
+    multiscale OME-Zarr
+    :param heatmap_array: Heatmap (3D, or 4D with the heatmaps along the last
+    dimension)
+    :param output_filename: File to save heatmap into
+    :param atlas_scale: Image scaling so that the resulting nifti can be
+    processed using other tools.
+    :param transformation_matrix: Transformation matrix so that the resulting
+    nifti can be processed using other tools.
+    """
+    logging.debug(f"Saving heatmap image: {output_filename}")
+    if is_ome_zarr(output_filename):
+        save_ome_zarr(
+            heatmap_array,
+            output_filename,
+            atlas_scale[:3],
+            affine=transformation_matrix,
+        )
+    else:
+        scale = tuple(atlas_scale)
+        scale += (1,) * (heatmap_array.ndim - len(scale))
+        brainio.to_nii(
+            heatmap_array,
+            output_filename,
+            scale=scale,
+            affine_transform=transformation_matrix,
+        )
+
+
+def get_group_filename(output_filename, group_name):
+    """
+    Adds the name of a group of cells to an output filename,
+    e.g. heatmap.nii -> heatmap_cells.nii
+    :param output_filename: Output filename
+    :param group_name: Name of the group
+    :return: Output filename of the group
+    """
+    output_filename = Path(output_filename)
+    name = output_filename.name
+    suffix = "".join(output_filename.suffixes)
+    stem = name[: len(name) - len(suffix)]
+    return str(output_filename.parent / f"{stem}_{group_name}{suffix}")
+
+
+def get_cell_location_array(cells_file, cells_only=False):
+    """
+    Loads a cell file (from the binary cache, if possible), and returns an
+    array with 3 columns of x, y, z positions
+    :param cells_file: Any supported cell file, e.g. xml
+    :param cells_only: If only cells (rather than unknown or artifacts)
+    should be included
+    :return: Array of cell positions, with x, y, z columns
+    """
+    logging.debug("Loading cells")
+    positions, types = load_cell_arrays(cells_file)
+    is_cell = types == Cell.CELL
+    logging.debug(
+        "{} cells, and {} non-cells".format(
+            is_cell.sum(), (types == Cell.NO_CELL).sum()
+        )
     )
+    if cells_only:
+        logging.debug("Removing non cells")
+        positions = positions[is_cell]
+    return positions
+
+
+def get_grouped_cell_location_array(
+    cells_files, group_by_type=False, cells_only=False
+):
+    """
+    Loads one or more cell files, and returns the positions of all the cells,
+    and the group each belongs to. Each file is a separate group (named after
+    the file), and if group_by_type is True, cells and non-cells are also
+    separate groups.
+    :param cells_files: Cell file, or list of cell files
+    :param group_by_type: Separate cells and non-cells
+    :param cells_only: If only cells should be included (ignored if
+    group_by_type is True)
+    :return: Array of cell positions (x, y, z columns), array of the group
+    index of each cell, and list of the group names
+    """
+    if not isinstance(cells_files, (list, tuple)):
+        cells_files = [cells_files]
+    file_names = [Path(cells_file).stem for cells_file in cells_files]
+    if len(set(file_names)) < len(file_names):
+        file_names = [f"{name}{idx}" for idx, name in enumerate(file_names)]
+
+    all_positions = []
+    all_groups = []
+    group_names = []
+    for file_name, cells_file in zip(file_names, cells_files):
+        logging.debug(f"Loading cells: {cells_file}")
+        positions, types = load_cell_arrays(cells_file)
+        is_cell = types == Cell.CELL
+        if group_by_type:
+            groups = len(group_names) + np.where(is_cell, 0, 1)
+            type_names = ["cells", "non_cells"]
+            if len(cells_files) > 1:
+                type_names = [f"{file_name}_{name}" for name in type_names]
+            group_names.extend(type_names)
+        else:
+            if cells_only:
+                positions = positions[is_cell]
+            groups = np.full(len(positions), len(group_names))
+            group_names.append(file_name)
+        all_positions.append(positions)
+        all_groups.append(groups)
+
+    logging.debug(f"Cell groups: {group_names}")
+    return (
+        np.concatenate(all_positions),
+        np.concatenate(all_groups).astype(np.int64),
+        group_names,
+    )
+
+
+def get_raw_image_shape(raw_image, use_cache=True):
+    """
+    Returns the shape of the raw image. As finding this requires listing
+    (and sorting) every plane, the shape is cached, keyed on the directory
+    listing (or the file, if a text file of paths is given).
+    :param raw_image: Path to the raw data
+    :param use_cache: Whether to use (and update) the cache
+    :return: Dict of the image shape
+    """
+    if use_cache:
+        raw_image_shape = load_metadata_cache("raw_image_shape", raw_image)
+        if raw_image_shape is not None:
+            logging.debug(f"Raw image size (cached): {raw_image_shape}")
+            return raw_image_shape
+
+    logging.debug("Checking raw image size")
+    raw_image_shape = brainio.get_size_image_from_file_paths(raw_image)
+    logging.debug(f"Raw image size: {raw_image_shape}")
+    if use_cache:
+        save_metadata_cache("raw_image_shape", raw_image, raw_image_shape)
+    return raw_image_shape
 
 
 def get_parser():
@@ -106,12 +560,17 @@ def get_parser():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        dest="cells_file", type=str, help="Cellfinder output cell file",
+        dest="cells_file",
+        type=str,
+        nargs="+",
+        help="Cellfinder output cell file. If more than one file is given "
+        "(e.g. one per channel), a heatmap is generated for each.",
     )
     parser.add_argument(
         dest="output_filename",
         type=str,
-        help="Output filename. Should end with '.nii'",
+        help="Output filename. Should end with '.nii', or '.zarr' to save a "
+        "multiscale OME-Zarr (requires zarr).",
     )
 
     parser.add_argument(
@@ -125,8 +584,11 @@ def get_parser():
         "--bin-size",
         dest="bin_size_um",
         type=check_positive_float,
-        default=100,
-        help="Heatmap bin size (um of each edge of histogram cube)",
+        nargs="+",
+        default=[100],
+        help="Heatmap bin size (um of each edge of histogram cube). If more "
+        "than one bin size (or smoothing) is given, a heatmap is generated "
+        "for each combination.",
     )
     parser.add_argument(
         "-x",
@@ -159,8 +621,10 @@ def get_parser():
         "--heatmap-smoothing",
         dest="heatmap_smooth",
         type=check_positive_float,
-        default=100,
-        help="Gaussian smoothing sigma, in um.",
+        nargs="+",
+        default=[100],
+        help="Gaussian smoothing sigma, in um. If more than one sigma (or bin "
+        "size) is given, a heatmap is generated for each combination.",
     )
     parser.add_argument(
         "--no-mask-figs",
@@ -169,12 +633,65 @@ def get_parser():
         help="Don't mask the figures (removing any areas outside the brain,"
         "from e.g. smoothing)",
     )
+    parser.add_argument(
+        "--target-space-binning",
+        dest="bin_in_target_space",
+        action="store_true",
+        help="Bin the cells directly into the target image space (one bin "
+        "per voxel), rather than binning in raw space and resizing. "
+        "Uses less memory, and '--bin-size' is ignored.",
+    )
+    parser.add_argument(
+        "--trilinear",
+        dest="trilinear",
+        action="store_true",
+        help="Bin the cells in target space, splitting each cell between the "
+        "eight nearest voxels (trilinear splatting).",
+    )
+    parser.add_argument(
+        "--chunked",
+        dest="chunked_processing",
+        action="store_true",
+        help="Smooth, mask and save the heatmap block by block, to reduce "
+        "memory usage for large target images.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        dest="memory_budget_gb",
+        type=check_positive_float,
+        default=2,
+        help="Approximate peak memory usage (in GB) when using '--chunked'.",
+    )
+    parser.add_argument(
+        "--save-counts",
+        dest="save_counts",
+        action="store_true",
+        help="Save the cell counts next to the heatmap, so that it can be "
+        "updated quickly (with 'heatmap_update') when cells change.",
+    )
+    parser.add_argument(
+        "--group-by-type",
+        dest="group_by_type",
+        action="store_true",
+        help="Generate separate heatmaps of cells and non-cells.",
+    )
+    parser.add_argument(
+        "--4d",
+        dest="output_4d",
+        action="store_true",
+        help="Save all the heatmaps (when using multiple cell files, or "
+        "'--group-by-type') in a single 4D image, rather than one image "
+        "per heatmap.",
+    )
 
     return parser
 
 
 class HeatmapParams:
     # assumes an isotropic target space
+    # raw_image_shape and atlas_data can be passed if already known (e.g. when
+    # processing many brains), to avoid rescanning or reloading the images.
+    # Otherwise, the atlas is only memory-mapped when it is first used.
     def __init__(
         self,
         raw_image,
@@ -184,6 +701,8 @@ class HeatmapParams:
         y_pixel_um,
         z_pixel_um,
         smoothing_target_space,
+        raw_image_shape=None,
+        atlas_data=None,
     ):
         self._input_image = raw_image
         self._target_image = downsampled_image
@@ -195,26 +714,29 @@ class HeatmapParams:
         self._downsampled_image = None
 
         self.figure_image_shape = None
-        self.raw_image_shape = None
+        self.raw_image_shape = raw_image_shape
+        self._atlas_data = atlas_data
         self.bin_size_raw_voxels = None
         self.atlas_scale = None
         self.transformation_matrix = None
         self.smoothing_target_voxel = None
 
-        self._get_raw_image_shape()
+        if self.raw_image_shape is None:
+            self._get_raw_image_shape()
         self._get_figure_image_shape()
-        self._get_atlas_data()
         self._get_atlas_scale()
         self._get_transformation_matrix()
         self._get_binning()
         self._get_smoothing()
 
+    @property
+    def atlas_data(self):
+        if self._atlas_data is None:
+            self._get_atlas_data()
+        return self._atlas_data
+
     def _get_raw_image_shape(self):
-        logging.debug("Checking raw image size")
-        self.raw_image_shape = brainio.get_size_image_from_file_paths(
-            self._input_image
-        )
-        logging.debug(f"Raw image size: {self.raw_image_shape}")
+        self.raw_image_shape = get_raw_image_shape(self._input_image)
 
     def _get_figure_image_shape(self):
         logging.debug(
@@ -229,18 +751,24 @@ class HeatmapParams:
         logging.debug("Target image size: {}".format(self.figure_image_shape))
 
     def _get_binning(self):
+        self.bin_size_raw_voxels = self.get_bin_size_raw_voxels(self._bin_um)
+
+    def get_bin_size_raw_voxels(self, bin_size_um):
         logging.debug("Calculating bin size in raw image space voxels")
-        bin_raw_x = int(self._bin_um / self._x_pixel_um)
-        bin_raw_y = int(self._bin_um / self._y_pixel_um)
-        bin_raw_z = int(self._bin_um / self._z_pixel_um)
-        self.bin_size_raw_voxels = [bin_raw_x, bin_raw_y, bin_raw_z]
+        bin_raw_x = int(bin_size_um / self._x_pixel_um)
+        bin_raw_y = int(bin_size_um / self._y_pixel_um)
+        bin_raw_z = int(bin_size_um / self._z_pixel_um)
         logging.debug(
             f"Bin size in raw image space is x:{bin_raw_x}, "
             f"y:{bin_raw_y}, z:{bin_raw_z}."
         )
+        return [bin_raw_x, bin_raw_y, bin_raw_z]
 
     def _get_atlas_data(self):
-        self.atlas_data = brainio.load_nii(self._target_image, as_array=True)
+        # reuses the header that is already loaded, and memory-maps the data
+        # (if the image is uncompressed)
+        logging.debug("Loading atlas data")
+        self._atlas_data = np.asanyarray(self._downsampled_image.dataobj)
 
     def _get_atlas_scale(self):
         self.atlas_scale = self._downsampled_image.header.get_zooms()
@@ -249,15 +777,18 @@ class HeatmapParams:
         self.transformation_matrix = self._downsampled_image.affine
 
     def _get_smoothing(self):
+        self.smoothing_target_voxel = self.get_smoothing_target_voxel(
+            self._smooth_um
+        )
+
+    def get_smoothing_target_voxel(self, smoothing_um):
         logging.debug(
             "Calculating smoothing in target image volume. Assumes "
             "an isotropic target image"
         )
-        if self._smooth_um is not 0:
+        if smoothing_um != 0:
             # 1000 is to scale to um
-            self.smoothing_target_voxel = int(
-                self._smooth_um / (self.atlas_scale[0] * 1000)
-            )
+            return int(smoothing_um / (self.atlas_scale[0] * 1000))
 
 
 def main(
@@ -271,17 +802,62 @@ def main(
     z_pixel_um,
     heatmap_smooth,
     masking,
+    bin_in_target_space=False,
+    trilinear=False,
+    chunked_processing=False,
+    memory_budget_gb=2,
+    group_by_type=False,
+    output_4d=False,
+    save_counts=False,
 ):
+    # more than one bin size or smoothing runs a parameter sweep
+    bin_sizes_um = bin_size_um
+    if not isinstance(bin_sizes_um, (list, tuple)):
+        bin_sizes_um = [bin_sizes_um]
+    smoothings_um = heatmap_smooth
+    if not isinstance(smoothings_um, (list, tuple)):
+        smoothings_um = [smoothings_um]
+
     params = HeatmapParams(
         raw_image,
         downsampled_image,
-        bin_size_um,
+        bin_sizes_um[0],
         x_pixel_um,
         y_pixel_um,
         z_pixel_um,
-        heatmap_smooth,
+        smoothings_um[0],
     )
 
+    if len(bin_sizes_um) > 1 or len(smoothings_um) > 1:
+        if group_by_type or output_4d or isinstance(cells_file, (list, tuple)):
+            raise ValueError(
+                "A sweep of bin sizes or smoothing can only be run on a "
+                "single cell file, without grouping"
+            )
+        run_sweep(
+            cells_file,
+            output_filename,
+            params.figure_image_shape,
+            params.raw_image_shape,
+            {
+                f"{size:g}": params.get_bin_size_raw_voxels(size)
+                for size in bin_sizes_um
+            },
+            params.transformation_matrix,
+            params.atlas_scale,
+            {
+                f"{sigma:g}": params.get_smoothing_target_voxel(sigma)
+                for sigma in smoothings_um
+            },
+            mask=masking,
+            atlas=params.atlas_data if masking else None,
+            bin_in_target_space=bin_in_target_space,
+            trilinear=trilinear,
+            chunked_processing=chunked_processing,
+            memory_budget=memory_budget_gb * 1e9,
+        )
+        return
+
     run(
         cells_file,
         output_filename,
@@ -292,14 +868,24 @@ def main(
         params.atlas_scale,
         smoothing=params.smoothing_target_voxel,
         mask=masking,
-        atlas=params.atlas_data,
+        atlas=params.atlas_data if masking else None,
+        bin_in_target_space=bin_in_target_space,
+        trilinear=trilinear,
+        chunked_processing=chunked_processing,
+        memory_budget=memory_budget_gb * 1e9,
+        group_by_type=group_by_type,
+        output_4d=output_4d,
+        save_counts=save_counts,
     )
 
 
 def cli():
     args = get_parser().parse_args()
+    cells_file = args.cells_file
+    if len(cells_file) == 1:
+        cells_file = cells_file[0]
     main(
-        args.cells_file,
+        cells_file,
         args.output_filename,
         args.raw_image,
         args.downsampled_image,
@@ -309,6 +895,13 @@ def cli():
         args.z_pixel_um,
         args.heatmap_smooth,
         args.mask_figures,
+        bin_in_target_space=args.bin_in_target_space,
+        trilinear=args.trilinear,
+        chunked_processing=args.chunked_processing,
+        memory_budget_gb=args.memory_budget_gb,
+        group_by_type=args.group_by_type,
+        output_4d=args.output_4d,
+        save_counts=args.save_counts,
     )
 
 
@@ -0,0 +1,287 @@
+"""
+Incremental heatmap updates. When a heatmap is generated with
+"save_counts=True", the unsmoothed cell counts and the smoothed (and masked)
+heatmap are saved next to the output. When cells are then added, removed or
+reclassified, only the bins that change are updated, and only the affected
+region (plus the smoothing kernel halo) is smoothed again. The result is
+identical to regenerating the heatmap from scratch.
+"""
+
+import json
+import logging
+import argparse
+
+from pathlib import Path
+import numpy as np
+from scipy.ndimage import zoom
+from imlib.image.masking import mask_image_threshold
+from imlib.image.scale import scale_and_convert_to_16_bits
+
+from neuro.heatmap.binning import bin_cells, bin_cells_target_space
+from neuro.heatmap.chunked import get_halo
+
+STATE_SUFFIXES = {
+    "counts": ".counts.npy",
+    "processed": ".processed.npy",
+    "mask": ".mask.npy",
+    "metadata": ".state.json",
+}
+
+
+def get_state_paths(output_filename):
+    """
+    Returns the paths of the files saved alongside a heatmap to allow
+    incremental updates (e.g. heatmap.nii -> heatmap.nii.counts.npy)
+    :param output_filename: Heatmap file
+    :return: Dict of the state file paths
+    """
+    output_filename = Path(output_filename)
+    return {
+        key: output_filename.parent / (output_filename.name + suffix)
+        for key, suffix in STATE_SUFFIXES.items()
+    }
+
+
+def has_state(output_filename):
+    """
+    Returns whether a heatmap can be updated incrementally
+    :param output_filename: Heatmap file
+    :return: True if all the state files exist
+    """
+    return all(
+        path.exists() for path in get_state_paths(output_filename).values()
+    )
+
+
+def save_state(output_filename, counts, processed, mask, metadata):
+    """
+    Saves the state needed to update a heatmap incrementally
+    :param output_filename: Heatmap file
+    :param counts: Unsmoothed cell counts (in raw or target space)
+    :param processed: Heatmap after smoothing and masking, before conversion
+    to 16 bit
+    :param mask: Atlas mask (or None if not masked)
+    :param metadata: Dict of the heatmap parameters (json serialisable)
+    """
+    paths = get_state_paths(output_filename)
+    logging.debug(f"Saving heatmap state to: {paths['counts']}")
+    np.save(str(paths["counts"]), counts)
+    np.save(str(paths["processed"]), processed)
+    if mask is None:
+        mask = np.ones(processed.shape, dtype=bool)
+    np.save(str(paths["mask"]), np.asarray(mask) > 0)
+    with open(str(paths["metadata"]), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def get_resize_index(input_shape, target_shape):
+    """
+    Returns, for each axis, the input index of each output voxel of a
+    nearest neighbour resize (imlib.image.size.resize_array with order=0),
+    so that any region of the resized image can be computed by indexing
+    :param input_shape: Shape of the array being resized
+    :param target_shape: Shape of the resized array
+    :return: List of index arrays, one per axis
+    """
+    return [
+        zoom(
+            np.arange(size, dtype=np.float64),
+            float(target) / float(size),
+            order=0,
+        ).astype(np.int64)
+        for size, target in zip(input_shape, target_shape)
+    ]
+
+
+def get_changed_region(delta, resize_index=None):
+    """
+    Returns the bounding box (in target space) of the voxels affected by a
+    change in cell counts
+    :param delta: Change in cell counts
+    :param resize_index: If the counts are in raw image space, the output of
+    get_resize_index
+    :return: List of (start, stop) per axis, or None if nothing changed
+    """
+    changed = np.nonzero(delta)
+    if len(changed[0]) == 0:
+        return None
+    box = []
+    for axis, index in enumerate(changed):
+        start, stop = index.min(), index.max()
+        if resize_index is not None:
+            # resize indices are sorted, so find the target voxels that
+            # were resized from the changed bins
+            start = np.searchsorted(resize_index[axis], start, side="left")
+            stop = np.searchsorted(resize_index[axis], stop, side="right") - 1
+        box.append((int(start), int(stop) + 1))
+    return box
+
+
+def pad_region(box, padding, shape):
+    return [
+        (max(start - padding, 0), min(stop + padding, size))
+        for (start, stop), size in zip(box, shape)
+    ]
+
+
+def bin_cell_changes(cells_array, metadata, counts_shape):
+    """
+    Bins cells in the same way as the original heatmap
+    """
+    cells_array = np.asarray(cells_array).reshape(-1, 3)
+    if metadata["bin_in_target_space"] or metadata["trilinear"]:
+        return bin_cells_target_space(
+            cells_array,
+            metadata["raw_image_shape"],
+            counts_shape,
+            trilinear=metadata["trilinear"],
+        )
+    return bin_cells(
+        cells_array, metadata["raw_image_shape"], metadata["bin_sizes"]
+    )
+
+
+def update_heatmap(
+    output_filename, cells_file=None, added_cells=None, removed_cells=None
+):
+    """
+    Updates a heatmap (generated with "save_counts=True") after cells have
+    been added, removed or reclassified. Either the new cells file, or the
+    changes (cell positions in raw image space, x, y, z columns) can be
+    given. Only the affected region is smoothed again.
+    :param output_filename: Heatmap file
+    :param cells_file: Updated cells file. All cells are binned, and compared
+    to the saved counts.
+    :param added_cells: Array of cells added (or reclassified as cells)
+    :param removed_cells: Array of cells removed (or reclassified as
+    non-cells)
+    :return: Bounding box (list of (start, stop) per axis) of the region
+    that was updated, or None if nothing changed
+    """
+    # avoid a circular import
+    from neuro.heatmap.heatmap import (
+        get_cell_location_array,
+        process_heatmap,
+        save_heatmap,
+    )
+
+    paths = get_state_paths(output_filename)
+    if not has_state(output_filename):
+        raise FileNotFoundError(
+            f"No saved counts for heatmap: {output_filename}. Please "
+            f"regenerate the heatmap with '--save-counts'."
+        )
+    with open(str(paths["metadata"]), "r") as f:
+        metadata = json.load(f)
+    counts = np.load(str(paths["counts"]), mmap_mode="r+")
+    processed = np.load(str(paths["processed"]), mmap_mode="r+")
+    mask = np.load(str(paths["mask"]), mmap_mode="r")
+
+    # counts may be unsigned
+    signed_dtype = np.result_type(counts.dtype, np.int64)
+    if cells_file is not None:
+        cells_array = get_cell_location_array(
+            cells_file, cells_only=metadata["cells_only"]
+        )
+        new_counts = bin_cell_changes(cells_array, metadata, counts.shape)
+        delta = new_counts.astype(signed_dtype) - counts
+    else:
+        delta = np.zeros(counts.shape, dtype=signed_dtype)
+        if added_cells is not None:
+            delta = delta + bin_cell_changes(
+                added_cells, metadata, counts.shape
+            )
+        if removed_cells is not None:
+            delta = delta - bin_cell_changes(
+                removed_cells, metadata, counts.shape
+            )
+
+    resize_index = None
+    if not (metadata["bin_in_target_space"] or metadata["trilinear"]):
+        resize_index = get_resize_index(counts.shape, processed.shape)
+    box = get_changed_region(delta, resize_index=resize_index)
+    if box is None:
+        logging.debug("No change in cell counts")
+        return None
+
+    if cells_file is not None:
+        counts[...] = new_counts
+    else:
+        counts[...] = (counts + delta).astype(counts.dtype)
+    counts.flush()
+
+    # the smoothed region, and the input needed to calculate it exactly
+    halo = get_halo(metadata["smoothing"])
+    region = pad_region(box, halo, processed.shape)
+    input_region = pad_region(box, 2 * halo, processed.shape)
+    logging.debug(f"Updating heatmap region: {region}")
+
+    if resize_index is None:
+        heatmap_array = counts[tuple(slice(*axis) for axis in input_region)]
+        heatmap_array = np.asarray(heatmap_array)
+    else:
+        index = [
+            resize_index[axis][start:stop]
+            for axis, (start, stop) in enumerate(input_region)
+        ]
+        # as in heatmap.run
+        heatmap_array = counts[np.ix_(*index)].astype(np.uint16)
+
+    heatmap_array = process_heatmap(
+        heatmap_array,
+        smoothing=metadata["smoothing"],
+        mask=False,
+        convert_16bit=False,
+    )
+    heatmap_array = heatmap_array[
+        tuple(
+            slice(start - input_start, stop - input_start)
+            for (start, stop), (input_start, _) in zip(region, input_region)
+        )
+    ]
+    region_slice = tuple(slice(*axis) for axis in region)
+    if metadata["mask"]:
+        heatmap_array = mask_image_threshold(heatmap_array, mask[region_slice])
+    processed[region_slice] = heatmap_array
+    processed.flush()
+
+    heatmap_array = processed
+    if metadata["convert_16bit"]:
+        heatmap_array = scale_and_convert_to_16_bits(np.asarray(processed))
+    save_heatmap(
+        heatmap_array,
+        output_filename,
+        metadata["atlas_scale"],
+        np.array(metadata["transformation_matrix"]),
+    )
+    return region
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        dest="cells_file",
+        type=str,
+        help="Updated cellfinder output cell file",
+    )
+    parser.add_argument(
+        dest="output_filename",
+        type=str,
+        help="Heatmap to update (generated with '--save-counts')",
+    )
+    return parser
+
+
+def cli():
+    args = get_parser().parse_args()
+    region = update_heatmap(args.output_filename, cells_file=args.cells_file)
+    if region is None:
+        print("No change in cell counts, heatmap not updated")
+    else:
+        print(f"Updated heatmap region: {region}")
+
+
+if __name__ == "__main__":
+    cli()
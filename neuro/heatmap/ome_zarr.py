@@ -0,0 +1,204 @@
+"""
+Saving heatmaps as chunked, compressed, multiscale OME-Zarr
+(https://ngff.openmicroscopy.org/0.4/), so that they can be displayed
+without reading the whole volume. Requires zarr (pip install zarr).
+"""
+
+import logging
+
+from pathlib import Path
+import numpy as np
+import dask.array as da
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+OME_ZARR_SUFFIX = ".zarr"
+NGFF_VERSION = "0.4"
+CHUNK_SIZE = 64
+
+
+def is_ome_zarr(path):
+    """
+    Returns whether a path is an OME-Zarr (based on the suffix)
+    :param path: File path
+    :return: True if the path ends in .zarr
+    """
+    return Path(path).suffix == OME_ZARR_SUFFIX
+
+
+def check_zarr_installed():
+    if zarr is None:
+        raise ImportError(
+            "Saving or loading OME-Zarr heatmaps requires zarr. "
+            "Please install it, e.g. 'pip install zarr'"
+        )
+
+
+def get_pyramid_shapes(shape, chunk_size=CHUNK_SIZE):
+    """
+    Returns the shape of each level of the resolution pyramid. Each level is
+    half the size of the previous level (rounded up), until the whole image
+    fits in a single chunk.
+    :param shape: Shape of the full resolution image (spatial dimensions)
+    :param chunk_size: Chunk size along each dimension
+    :return: List of shapes (tuples), starting at full resolution
+    """
+    shapes = [tuple(int(size) for size in shape)]
+    while max(shapes[-1]) > chunk_size:
+        shapes.append(tuple((size + 1) // 2 for size in shapes[-1]))
+    return shapes
+
+
+def downsample_mean(image):
+    """
+    Downsamples the first three dimensions of an image by two, by averaging
+    each 2x2x2 block. Odd sized dimensions are padded by repeating the last
+    plane.
+    :param image: Image (at least 3D)
+    :return: Downsampled image (same dtype as the input)
+    """
+    pad = [(0, size % 2) for size in image.shape[:3]]
+    pad += [(0, 0)] * (image.ndim - 3)
+    if any(after for _, after in pad):
+        image = np.pad(image, pad, mode="edge")
+
+    block_shape = []
+    for size in image.shape[:3]:
+        block_shape.extend([size // 2, 2])
+    block_shape.extend(image.shape[3:])
+    mean = image.reshape(block_shape).mean(axis=(1, 3, 5))
+    if np.issubdtype(image.dtype, np.integer):
+        mean = np.round(mean)
+    return mean.astype(image.dtype)
+
+
+def save_ome_zarr(
+    image,
+    output_path,
+    scale,
+    affine=None,
+    chunk_size=CHUNK_SIZE,
+    compression_level=5,
+):
+    """
+    Saves an image (e.g. a heatmap) as a multiscale OME-Zarr. The image is
+    written, and the pyramid built, one slab of chunks at a time, so a
+    memory-mapped image is never fully loaded into memory.
+    :param image: Image in x, y, z (nifti) order, optionally with the
+    channels (e.g. cell types) as a fourth dimension. Stored as (c), z, y, x.
+    :param output_path: Path to save the OME-Zarr (directory) to
+    :param scale: Voxel size (x, y, z) in mm
+    :param affine: Optional nifti affine transform, stored in the metadata
+    :param chunk_size: Chunk size along each spatial dimension
+    :param compression_level: Blosc (zstd) compression level
+    """
+    check_zarr_installed()
+    logging.debug(f"Saving multiscale OME-Zarr: {output_path}")
+    # as (c), z, y, x
+    axes_order = tuple(reversed(range(3)))
+    if image.ndim == 4:
+        axes_order = (3,) + axes_order
+    n_channels = image.shape[3] if image.ndim == 4 else None
+
+    compressor = Blosc(
+        cname="zstd", clevel=compression_level, shuffle=Blosc.BITSHUFFLE
+    )
+    root = zarr.open_group(str(output_path), mode="w")
+    shapes = get_pyramid_shapes(image.shape[:3], chunk_size=chunk_size)
+    levels = []
+    for idx, shape in enumerate(shapes):
+        zyx_shape = tuple(reversed(shape))
+        chunks = (chunk_size,) * 3
+        if n_channels is not None:
+            zyx_shape = (n_channels,) + zyx_shape
+            chunks = (1,) + chunks
+        levels.append(
+            root.create_dataset(
+                str(idx),
+                shape=zyx_shape,
+                chunks=chunks,
+                dtype=image.dtype,
+                compressor=compressor,
+            )
+        )
+
+    # write the full resolution image, and then build each level from the
+    # previous one, one z slab at a time (slabs are whole chunks, and an
+    # even number of planes)
+    slab_size = 2 * chunk_size
+    for start in range(0, image.shape[2], slab_size):
+        slab = np.asarray(image[:, :, start : start + slab_size])
+        _write_slab(levels[0], slab, start, axes_order)
+
+    z_axis = axes_order.index(2)
+    for previous, level in zip(levels[:-1], levels[1:]):
+        for start in range(0, previous.shape[z_axis], slab_size):
+            index = [slice(None)] * previous.ndim
+            index[z_axis] = slice(start, start + slab_size)
+            slab = previous[tuple(index)].transpose(np.argsort(axes_order))
+            _write_slab(level, downsample_mean(slab), start // 2, axes_order)
+
+    datasets = [
+        {
+            "path": str(idx),
+            "coordinateTransformations": [
+                {
+                    "type": "scale",
+                    "scale": ([1.0] if n_channels is not None else [])
+                    + [float(size) * 2 ** idx for size in reversed(scale)],
+                }
+            ],
+        }
+        for idx in range(len(levels))
+    ]
+    axes = [
+        {"name": name, "type": "space", "unit": "millimeter"}
+        for name in ("z", "y", "x")
+    ]
+    if n_channels is not None:
+        axes = [{"name": "c", "type": "channel"}] + axes
+    root.attrs["multiscales"] = [
+        {
+            "version": NGFF_VERSION,
+            "name": Path(output_path).stem,
+            "axes": axes,
+            "datasets": datasets,
+            "type": "mean",
+        }
+    ]
+    if affine is not None:
+        root.attrs["nifti_affine"] = np.asarray(affine).tolist()
+
+
+def _write_slab(level, slab, start, axes_order):
+    """
+    Writes a slab (x, y, z, (c)) of the image to a pyramid level at a given
+    z position. The slab may be one plane larger than the level (if the
+    level was padded when downsampling).
+    """
+    slab = slab.transpose(axes_order)
+    z_axis = 1 if slab.ndim == 4 else 0
+    end = min(start + slab.shape[z_axis], level.shape[z_axis])
+    index = [slice(None)] * slab.ndim
+    index[z_axis] = slice(start, end)
+    source_index = [slice(None)] * slab.ndim
+    source_index[z_axis] = slice(0, end - start)
+    level[tuple(index)] = slab[tuple(source_index)]
+
+
+def load_ome_zarr(path):
+    """
+    Lazily loads each level of a multiscale OME-Zarr (e.g. for display as
+    a multiscale image layer in napari)
+    :param path: Path to the OME-Zarr
+    :return: List of dask arrays, starting at full resolution (in the order
+    they are stored, i.e. (c), z, y, x)
+    """
+    check_zarr_installed()
+    root = zarr.open_group(str(path), mode="r")
+    datasets = root.attrs["multiscales"][0]["datasets"]
+    return [da.from_zarr(root[dataset["path"]]) for dataset in datasets]
@@ -6,11 +6,14 @@ caudal, ventral left point. The default is also for 10um voxel spacing.
 """
 
 import argparse
-import imlib.IO.cells as cells_io
+import numpy as np
+import pandas as pd
 from imlib.general.numerical import check_positive_float, check_positive_int
 from imlib.general.system import ensure_directory_exists
 from pathlib import Path
 
+from neuro.cells.IO import load_cell_arrays
+
 
 def run(
     cells_file,
@@ -22,17 +25,19 @@ def run(
     key="df",
 ):
     print(f"Converting file: {cells_file}")
-    cells = cells_io.get_cells(cells_file)
-    for cell in cells:
-        cell.transform(
-            x_scale=pixel_size_x,
-            y_scale=pixel_size_y,
-            z_scale=pixel_size_z,
-            integer=True,
-        )
-
-    cells = cells_io.cells_to_dataframe(cells)
-    cells.columns = ["z", "y", "x", "type"]
+    positions, types = load_cell_arrays(cells_file)
+    positions = np.round(
+        positions * [pixel_size_x, pixel_size_y, pixel_size_z]
+    ).astype(np.int64)
+
+    cells = pd.DataFrame(
+        {
+            "z": positions[:, 0],
+            "y": positions[:, 1],
+            "x": positions[:, 2],
+            "type": types,
+        }
+    )
 
     cells["x"] = max_z - cells["x"]
 
@@ -7,7 +7,6 @@ from skimage.filters import threshold_otsu
 from skimage import measure
 
 from brainio import brainio
-from imlib.IO.surfaces import marching_cubes_to_obj
 from imlib.image.orient import reorient_image
 from imlib.image.objects import keep_n_largest_objects
 
@@ -15,6 +14,7 @@ from neuro.segmentation.injection_finder.registration import (
     get_registered_image,
 )
 from neuro.segmentation.injection_finder.parsers import extraction_parser
+from neuro.visualise.surfaces import get_mesh_format, save_mesh
 
 import neuro as package_for_log
 import logging
@@ -33,6 +33,7 @@ class Extractor:
         threshold_type="otsu",
         obj_path=None,
         overwrite_registration=False,
+        mesh_format=None,
     ):
         """
         Extractor processes a downsampled.nii image to extract the location of
@@ -51,9 +52,12 @@ class Extractor:
         for thresholding
         :param threshold_type: str, either ['otsu', 'percentile'],
         type of threshold used
-        :param obj_path: path to .obj file destination.
+        :param obj_path: path to mesh file destination.
         :param overwrite_registration: if false doesn't overwrite the
         registration step
+        :param mesh_format: str, format of the mesh file, one of
+        neuro.visualise.surfaces.MESH_FORMATS. If None, it is given by the
+        extension of obj_path (or is "obj", if obj_path is None)
         """
 
         # Get arguments
@@ -67,6 +71,7 @@ class Extractor:
         self.threshold_type = threshold_type
         self.obj_path = obj_path
         self.overwrite_registration = overwrite_registration
+        self.mesh_format = mesh_format
 
         # Run first with the image oriented for brainrender
         image = self.setup()
@@ -82,9 +87,14 @@ class Extractor:
             self.img_filepath.split(".")[0] + "_thresholded.nii"
         )
 
-        # Get path to obj file and check if it exists
+        # Get path to mesh file and check if it exists
         if self.obj_path is None:
-            self.obj_path = self.img_filepath.split(".")[0] + ".obj"
+            if self.mesh_format is None:
+                self.mesh_format = "obj"
+            self.obj_path = (
+                self.img_filepath.split(".")[0] + "." + self.mesh_format
+            )
+        self.mesh_format = get_mesh_format(self.obj_path, self.mesh_format)
 
         if os.path.isfile(self.obj_path) and not self.overwrite:
             self.logging.warning(
@@ -170,10 +180,13 @@ class Extractor:
         if voxel_size is not 1:
             verts = verts * voxel_size
 
-        # Save image to .obj
-        self.logging.info(" Saving .obj at {}".format(self.obj_path))
-        faces = faces + 1
-        marching_cubes_to_obj((verts, faces, normals, values), self.obj_path)
+        # Save mesh
+        self.logging.info(
+            " Saving .{} at {}".format(self.mesh_format, self.obj_path)
+        )
+        save_mesh(
+            verts, faces, normals, self.obj_path, mesh_format=self.mesh_format
+        )
 
 
 def main():
@@ -188,7 +201,8 @@ def main():
         outdir = args.output_directory
 
     if args.obj_path is None:
-        args.obj_path = Path(args.img_filepath).with_suffix(".obj")
+        mesh_format = args.mesh_format or "obj"
+        args.obj_path = Path(args.img_filepath).with_suffix("." + mesh_format)
     else:
         args.obj_path = Path(args.obj_path)
 
@@ -212,6 +226,7 @@ def main():
         threshold_type=args.threshold_type,
         obj_path=args.obj_path,
         overwrite_registration=args.overwrite_registration,
+        mesh_format=args.mesh_format,
     )
 
 
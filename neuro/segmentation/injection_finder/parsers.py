@@ -1,5 +1,7 @@
 import argparse
 
+from neuro.visualise.surfaces import MESH_FORMATS
+
 
 def extraction_parser():
     parser = argparse.ArgumentParser(
@@ -39,7 +41,19 @@ def extraction_parser():
         dest="obj_path",
         type=str,
         default=None,
-        help="Path to output .obj file. Will default to the image directory.",
+        help="Path to output mesh file. Will default to the image directory.",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--mesh-format",
+        dest="mesh_format",
+        type=str,
+        choices=MESH_FORMATS,
+        default=None,
+        help="Format of the output mesh file. Binary formats (ply, stl, glb) "
+        "are smaller and faster to load. Will default to the extension of "
+        "the output mesh file (which it must match), or 'obj'.",
     )
 
     parser.add_argument(
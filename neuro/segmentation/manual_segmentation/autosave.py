@@ -0,0 +1,76 @@
+"""
+Tracks which manual segmentation layers (regions and tracks) have changed
+since they were last saved, so that only those layers are saved again (e.g.
+by the periodic autosave).
+"""
+
+import hashlib
+
+import numpy as np
+
+AUTOSAVE_INTERVAL = 300
+
+
+def get_layer_fingerprint(layer):
+    """
+    Summarises the name and contents of a layer, so that changes can be
+    detected. Labels stored as ChunkedLabels are summarised by the hash of
+    each chunk (and only the chunks painted since the last call are hashed
+    again), other data by a hash of the whole array.
+    :param layer: napari layer (e.g. labels or points)
+    :return: Tuple of the layer name, data shape and content hash(es)
+    """
+    data = layer.data
+    if hasattr(data, "get_chunk_hashes"):
+        content = frozenset(data.get_chunk_hashes().items())
+    else:
+        data = np.ascontiguousarray(data)
+        content = hashlib.sha1(data.tobytes()).hexdigest()
+    return layer.name, tuple(data.shape), content
+
+
+class LayerChangeTracker:
+    """
+    Records the fingerprint (see get_layer_fingerprint) of each layer when
+    it is saved. Layers are found to have changed if their fingerprint
+    differs from the saved one (or if they have never been saved).
+    """
+
+    def __init__(self):
+        self._saved = {}
+        self._pending = {}
+
+    def get_changed(self, layers):
+        """
+        Finds the layers that have changed since they were last saved. Their
+        current fingerprints are kept until they are marked as saved (with
+        mark_saved), so any later changes are found next time.
+        :param layers: List of napari layers
+        :return: List of the changed layers
+        """
+        changed = []
+        for layer in layers:
+            fingerprint = get_layer_fingerprint(layer)
+            if self._saved.get(id(layer)) != fingerprint:
+                self._pending[id(layer)] = fingerprint
+                changed.append(layer)
+        return changed
+
+    def mark_saved(self, layers):
+        """
+        Marks layers (returned by get_changed) as saved
+        :param layers: List of napari layers
+        """
+        for layer in layers:
+            if id(layer) in self._pending:
+                self._saved[id(layer)] = self._pending.pop(id(layer))
+
+    def set_saved(self, layers):
+        """
+        Records the current state of layers as saved (e.g. when they are
+        loaded from file)
+        :param layers: List of napari layers
+        """
+        for layer in layers:
+            self._pending.pop(id(layer), None)
+            self._saved[id(layer)] = get_layer_fingerprint(layer)
@@ -0,0 +1,327 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from neuro.atlas_tools.array import (
+    count_lateralised_structures,
+    get_bounding_box,
+)
+from neuro.structures.structures_tree import StructureLookup
+
+SLAB_SIZE = 16
+LABEL_STATISTICS_COLUMNS = (
+    ["area"]
+    + [f"bbox-{idx}" for idx in range(6)]
+    + [f"centroid-{idx}" for idx in range(3)]
+)
+BRAIN_AREA_COLUMNS = [
+    "structure_name",
+    "left_volume_mm3",
+    "left_percentage_of_total",
+    "right_volume_mm3",
+    "right_percentage_of_total",
+    "total_volume_mm3",
+    "percentage_of_total",
+]
+
+
+def get_brain_area_volumes(
+    region,
+    annotations,
+    hemispheres,
+    structures_reference_df,
+    voxel_volume,
+    bounding_box=None,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
+):
+    """
+    Calculates the volume of each brain area (in each hemisphere) within a
+    segmented region. Only the bounding box of the region is analysed.
+    :param region: Segmented region (non-zero within the region), in the same
+    orientation as the annotations
+    :param annotations: Brain area annotations
+    :param hemispheres: Hemisphere annotations
+    :param structures_reference_df: Pandas dataframe with "id" and "name"
+    columns (or a StructureLookup)
+    :param voxel_volume: Volume of a single voxel (mm³)
+    :param bounding_box: Bounding box of the region, if already known
+    :param left_hemisphere_value: Value of the left hemisphere in the
+    hemisphere annotations
+    :param right_hemisphere_value: Value of the right hemisphere in the
+    hemisphere annotations
+    :return: Pandas dataframe with one row per brain area
+    """
+    if bounding_box is None:
+        bounding_box = get_bounding_box(region)
+    if bounding_box is None:
+        return pd.DataFrame(columns=BRAIN_AREA_COLUMNS)
+
+    atlas_values, left_counts, right_counts = count_lateralised_structures(
+        annotations[bounding_box],
+        hemispheres[bounding_box],
+        mask=np.asarray(region[bounding_box]) != 0,
+        left_hemisphere_value=left_hemisphere_value,
+        right_hemisphere_value=right_hemisphere_value,
+    )
+    return get_brain_area_table(
+        atlas_values,
+        left_counts,
+        right_counts,
+        structures_reference_df,
+        voxel_volume,
+    )
+
+
+def get_brain_area_table(
+    atlas_values,
+    left_counts,
+    right_counts,
+    structures_reference_df,
+    voxel_volume,
+):
+    """
+    Builds the table of brain area volumes of a region, from the number of
+    voxels of each brain area
+    :param atlas_values: Array of the atlas values (brain areas)
+    :param left_counts: Number of voxels of each in the left hemisphere
+    :param right_counts: Number of voxels of each in the right hemisphere
+    :param structures_reference_df: Pandas dataframe with "id" and "name"
+    columns (or a StructureLookup)
+    :param voxel_volume: Volume of a single voxel (mm³)
+    :return: Pandas dataframe with one row per brain area
+    """
+    total_voxels = left_counts.sum() + right_counts.sum()
+
+    if not isinstance(structures_reference_df, StructureLookup):
+        structures_reference_df = StructureLookup(structures_reference_df)
+    _, known = structures_reference_df.get_rows(atlas_values)
+    for atlas_value in atlas_values[~known]:
+        print(
+            "Value: {} is not in the atlas structure reference file. "
+            "Not calculating the volume".format(atlas_value)
+        )
+
+    # brain areas in the left hemisphere first, as in previous versions
+    order = np.lexsort((atlas_values, left_counts == 0))
+    order = order[known[order]]
+    left_counts = left_counts[order]
+    right_counts = right_counts[order]
+    left_volume = left_counts * voxel_volume
+    right_volume = right_counts * voxel_volume
+    left_percentage = 100 * (left_counts / total_voxels)
+    right_percentage = 100 * (right_counts / total_voxels)
+    return pd.DataFrame(
+        {
+            "structure_name": structures_reference_df.get_names(
+                atlas_values[order]
+            ),
+            "left_volume_mm3": left_volume,
+            "left_percentage_of_total": left_percentage,
+            "right_volume_mm3": right_volume,
+            "right_percentage_of_total": right_percentage,
+            "total_volume_mm3": left_volume + right_volume,
+            "percentage_of_total": left_percentage + right_percentage,
+        },
+        columns=BRAIN_AREA_COLUMNS,
+    )
+
+
+def get_label_statistics(labels, coordinates):
+    """
+    Calculates the number of voxels, and the extent and sum of the
+    coordinates, of each label value
+    :param labels: Array of label values (of non-zero voxels)
+    :param coordinates: List of arrays of the coordinates of the voxels (one
+    per axis)
+    :return: Pandas dataframe, indexed by label value, with "area", "min-i",
+    "max-i" (inclusive) and "sum-i" columns for each axis i
+    """
+    label_values, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.ravel()
+    statistics = {"area": np.bincount(inverse, minlength=len(label_values))}
+    for axis, axis_coordinates in enumerate(coordinates):
+        minimum = np.full(len(label_values), np.iinfo(np.int64).max)
+        maximum = np.full(len(label_values), -1, dtype=np.int64)
+        np.minimum.at(minimum, inverse, axis_coordinates)
+        np.maximum.at(maximum, inverse, axis_coordinates)
+        statistics[f"min-{axis}"] = minimum
+        statistics[f"max-{axis}"] = maximum
+        # coordinate sums are exact (as integers)
+        statistics[f"sum-{axis}"] = np.bincount(
+            inverse,
+            weights=axis_coordinates,
+            minlength=len(label_values),
+        ).astype(np.int64)
+    return pd.DataFrame(statistics, index=pd.Index(label_values, name="label"))
+
+
+def _analyse_slab(
+    regions,
+    bounding_boxes,
+    annotations,
+    hemispheres,
+    slab,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
+):
+    """
+    Analyses one slab (along the last axis) of each region
+    :return: List (one item per region) of the structure counts (or None if
+    there are no annotations) and label statistics, or None if the region
+    isn't in the slab
+    """
+    results = []
+    for region, bounding_box in zip(regions, bounding_boxes):
+        if bounding_box is None:
+            results.append(None)
+            continue
+        start = max(slab[0], bounding_box[-1].start)
+        stop = min(slab[1], bounding_box[-1].stop)
+        if start >= stop:
+            results.append(None)
+            continue
+        crop = bounding_box[:-1] + (slice(start, stop),)
+        labels = np.asarray(region[crop])
+        nonzero = np.nonzero(labels)
+
+        structure_counts = None
+        if annotations is not None:
+            structure_counts = count_lateralised_structures(
+                np.asarray(annotations[crop])[nonzero],
+                np.asarray(hemispheres[crop])[nonzero],
+                left_hemisphere_value=left_hemisphere_value,
+                right_hemisphere_value=right_hemisphere_value,
+            )
+        coordinates = [
+            axis_coordinates + axis_slice.start
+            for axis_coordinates, axis_slice in zip(nonzero, crop)
+        ]
+        label_statistics = get_label_statistics(labels[nonzero], coordinates)
+        results.append((structure_counts, label_statistics))
+    return results
+
+
+def _merge_structure_counts(structure_counts):
+    atlas_values = np.concatenate([counts[0] for counts in structure_counts])
+    left_counts = np.concatenate([counts[1] for counts in structure_counts])
+    right_counts = np.concatenate([counts[2] for counts in structure_counts])
+    atlas_values, inverse = np.unique(atlas_values, return_inverse=True)
+    inverse = inverse.ravel()
+    n_values = len(atlas_values)
+    left_counts = np.bincount(
+        inverse, weights=left_counts, minlength=n_values
+    ).astype(np.int64)
+    right_counts = np.bincount(
+        inverse, weights=right_counts, minlength=n_values
+    ).astype(np.int64)
+    return atlas_values, left_counts, right_counts
+
+
+def _merge_label_statistics(label_statistics):
+    statistics = pd.concat(label_statistics)
+    aggregations = {
+        column: column.split("-")[0] for column in statistics.columns
+    }
+    aggregations["area"] = "sum"
+    statistics = statistics.groupby(level="label").agg(aggregations)
+
+    # as skimage.measure.regionprops_table
+    table = {"area": statistics["area"].to_numpy()}
+    n_axes = (len(statistics.columns) - 1) // 3
+    for axis in range(n_axes):
+        table[f"bbox-{axis}"] = statistics[f"min-{axis}"].to_numpy()
+    for axis in range(n_axes):
+        table[f"bbox-{axis + n_axes}"] = (
+            statistics[f"max-{axis}"].to_numpy() + 1
+        )
+    for axis in range(n_axes):
+        table[f"centroid-{axis}"] = (
+            statistics[f"sum-{axis}"].to_numpy()
+            / statistics["area"].to_numpy()
+        )
+    return pd.DataFrame(table)
+
+
+def analyse_regions(
+    regions,
+    annotations=None,
+    hemispheres=None,
+    slab_size=SLAB_SIZE,
+    n_threads=None,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
+):
+    """
+    Analyses a number of segmented regions in a single pass through the
+    annotations (one slab, along the last axis, at a time, split across a
+    thread pool). For each region, the number of voxels of each brain area
+    in each hemisphere is counted, and the volume, bounding box and centroid
+    of each label value are calculated.
+    :param regions: List of segmented regions (non-zero within the region),
+    in the same orientation as the annotations
+    :param annotations: Brain area annotations. If None, the brain areas are
+    not counted.
+    :param hemispheres: Hemisphere annotations
+    :param slab_size: Number of planes in each slab
+    :param n_threads: Number of threads. Defaults to the number of CPUs.
+    :param left_hemisphere_value: Value of the left hemisphere in the
+    hemisphere annotations
+    :param right_hemisphere_value: Value of the right hemisphere in the
+    hemisphere annotations
+    :return: List with (for each region) a tuple of the brain area counts
+    (as count_lateralised_structures, or None if there are no annotations)
+    and a dataframe of the label statistics (as
+    skimage.measure.regionprops_table with "area", "bbox" and "centroid").
+    None for empty regions.
+    """
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    bounding_boxes = [get_bounding_box(region) for region in regions]
+    starts = [box[-1].start for box in bounding_boxes if box is not None]
+    stops = [box[-1].stop for box in bounding_boxes if box is not None]
+    if not starts:
+        return [None] * len(regions)
+
+    slabs = [
+        (start, start + slab_size)
+        for start in range(min(starts), max(stops), slab_size)
+    ]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        slab_results = list(
+            executor.map(
+                lambda slab: _analyse_slab(
+                    regions,
+                    bounding_boxes,
+                    annotations,
+                    hemispheres,
+                    slab,
+                    left_hemisphere_value=left_hemisphere_value,
+                    right_hemisphere_value=right_hemisphere_value,
+                ),
+                slabs,
+            )
+        )
+
+    results = []
+    for idx in range(len(regions)):
+        region_results = [
+            slab_result[idx]
+            for slab_result in slab_results
+            if slab_result[idx] is not None
+        ]
+        if not region_results:
+            results.append(None)
+            continue
+        structure_counts = None
+        if annotations is not None:
+            structure_counts = _merge_structure_counts(
+                [result[0] for result in region_results]
+            )
+        label_statistics = _merge_label_statistics(
+            [result[1] for result in region_results]
+        )
+        results.append((structure_counts, label_statistics))
+    return results
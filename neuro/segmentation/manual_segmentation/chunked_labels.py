@@ -0,0 +1,444 @@
+"""
+Compact storage for manually segmented regions. Each region layer is backed
+by a ChunkedLabels store, rather than a full-size array of the image dtype,
+so that only the parts of the image that have been painted use memory.
+"""
+
+import hashlib
+import itertools
+import operator
+
+import numpy as np
+
+from neuro.atlas_tools.array import get_bounding_box
+
+CHUNK_SIZE = 64
+
+
+def _get_axis_chunks(axis_key, chunk_size):
+    """
+    Splits the index of one axis by chunk
+    :param axis_key: Integer, or slice (with start, stop and step resolved)
+    :param chunk_size: Size of the chunks along this axis
+    :return: List of (chunk index, slice into the result, index into the
+    chunk)
+    """
+    if isinstance(axis_key, int):
+        axis_key = slice(axis_key, axis_key + 1, 1)
+    index = np.arange(axis_key.start, axis_key.stop, axis_key.step)
+    if len(index) == 0:
+        return []
+    chunk_ids = index // chunk_size
+    starts = np.append(0, np.flatnonzero(np.diff(chunk_ids)) + 1)
+    stops = np.append(starts[1:], len(index))
+
+    axis_chunks = []
+    for start, stop in zip(starts, stops):
+        chunk_id = int(chunk_ids[start])
+        local_index = index[start:stop] - chunk_id * chunk_size
+        if axis_key.step == 1:
+            local_index = slice(int(local_index[0]), int(local_index[-1]) + 1)
+        axis_chunks.append(
+            (chunk_id, slice(int(start), int(stop)), local_index)
+        )
+    return axis_chunks
+
+
+class LabelsRegion(np.ndarray):
+    """
+    Region of a ChunkedLabels store (the result of indexing it). As for a
+    view of a numpy array, setting values of the region also sets them in
+    the store (e.g. as napari does when painting with "preserve labels").
+    Copies, and arrays derived from the region, are independent.
+    """
+
+    def __array_finalize__(self, obj):
+        self._labels = None
+        self._key = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self._labels is not None:
+            self._labels[self._key] = self.view(np.ndarray)
+
+
+class ChunkedLabels:
+    """
+    Label image (e.g. manually segmented regions) stored as a dict of
+    fixed-size chunks. Only chunks that have been painted are allocated, and
+    everywhere else is zero. Supports the indexing (integers, slices and
+    boolean masks) and array attributes used by napari labels layers, so it
+    can be used as the data of a labels layer. Transposing (e.g. with
+    np.swapaxes) returns a view that shares the same chunks.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, chunk_shape=None):
+        """
+        :param shape: Shape of the label image
+        :param dtype: Data type of the labels
+        :param chunk_shape: Shape of each chunk. Defaults to CHUNK_SIZE along
+        each axis.
+        """
+        if chunk_shape is None:
+            chunk_shape = (CHUNK_SIZE,) * len(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_shape = tuple(int(size) for size in chunk_shape)
+        self.chunks = {}
+        self._shape = tuple(int(size) for size in shape)
+        self._axes = tuple(range(len(shape)))
+        # chunks written since their hashes were last calculated
+        self._modified = set()
+        self._hashes = {}
+
+    @classmethod
+    def from_array(cls, array, dtype=np.uint8, chunk_shape=None):
+        """
+        Copies an existing label image (e.g. loaded from file), one chunk at a
+        time, only keeping the chunks with any labels
+        :param array: Label image
+        :param dtype: Data type of the labels
+        :param chunk_shape: Shape of each chunk
+        :return: ChunkedLabels
+        """
+        labels = cls(array.shape, dtype=dtype, chunk_shape=chunk_shape)
+        limits = np.iinfo(labels.dtype)
+        for chunk_index in labels._get_chunk_grid():
+            block = np.asarray(array[labels._get_chunk_region(chunk_index)])
+            if block.any():
+                if block.min() < limits.min or block.max() > limits.max:
+                    raise ValueError(
+                        f"Label values must be between {limits.min} and "
+                        f"{limits.max} to be stored as {labels.dtype}"
+                    )
+                labels.chunks[chunk_index] = block.astype(labels.dtype)
+                labels._modified.add(chunk_index)
+        return labels
+
+    @property
+    def shape(self):
+        return tuple(self._shape[axis] for axis in self._axes)
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self._shape, dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the allocated chunks"""
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return (
+            f"ChunkedLabels(shape={self.shape}, dtype={self.dtype}, "
+            f"chunks={len(self.chunks)})"
+        )
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...].view(np.ndarray)
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def __eq__(self, other):
+        return np.asarray(self) == other
+
+    def __ne__(self, other):
+        return np.asarray(self) != other
+
+    def astype(self, dtype):
+        return np.asarray(self, dtype=dtype)
+
+    def copy(self):
+        """
+        Copies the labels (only the allocated chunks are copied)
+        :return: ChunkedLabels, in the same orientation
+        """
+        labels = object.__new__(ChunkedLabels)
+        labels.__dict__.update(self.__dict__)
+        labels.chunks = {
+            chunk_index: chunk.copy()
+            for chunk_index, chunk in list(self.chunks.items())
+        }
+        labels._modified = set(labels.chunks)
+        labels._hashes = {}
+        return labels
+
+    def get_chunk_hashes(self):
+        """
+        Calculates a hash of the contents of each chunk with any labels. Only
+        the chunks written since the last call are hashed again.
+        :return: Dict of chunk index: hash
+        """
+        for chunk_index in list(self._modified):
+            self._modified.discard(chunk_index)
+            chunk = self.chunks.get(chunk_index)
+            if chunk is not None and chunk.any():
+                self._hashes[chunk_index] = hashlib.sha1(
+                    chunk.tobytes()
+                ).hexdigest()
+            else:
+                self._hashes.pop(chunk_index, None)
+        return dict(self._hashes)
+
+    def any(self):
+        return any(chunk.any() for chunk in self.chunks.values())
+
+    def transpose(self, *axes):
+        if len(axes) == 1 and (axes[0] is None or not np.isscalar(axes[0])):
+            axes = axes[0]
+        if not axes:
+            axes = tuple(reversed(range(self.ndim)))
+        if sorted(axes) != list(range(self.ndim)):
+            raise ValueError(f"Invalid axes: {axes}")
+        view = object.__new__(ChunkedLabels)
+        view.__dict__.update(self.__dict__)
+        view._axes = tuple(self._axes[axis] for axis in axes)
+        return view
+
+    def swapaxes(self, axis1, axis2):
+        axes = list(range(self.ndim))
+        axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
+        return self.transpose(axes)
+
+    def get_bounding_box(self):
+        """
+        Finds the bounding box of the labels, only searching the allocated
+        chunks
+        :return: Tuple of slices (one per axis), or None if there are no
+        labels
+        """
+        starts = np.full(self.ndim, np.iinfo(np.int64).max)
+        stops = np.zeros(self.ndim, dtype=np.int64)
+        for chunk_index, chunk in self.chunks.items():
+            bounding_box = get_bounding_box(chunk)
+            if bounding_box is not None:
+                offset = np.multiply(chunk_index, self.chunk_shape)
+                starts = np.minimum(
+                    starts, offset + [axis.start for axis in bounding_box]
+                )
+                stops = np.maximum(
+                    stops, offset + [axis.stop for axis in bounding_box]
+                )
+        if (stops == 0).all():
+            return None
+        bounding_box = [
+            slice(int(start), int(stop)) for start, stop in zip(starts, stops)
+        ]
+        return tuple(bounding_box[axis] for axis in self._axes)
+
+    def __getitem__(self, key):
+        if isinstance(key, np.ndarray) and key.dtype == bool:
+            return np.asarray(self)[key]
+
+        # the region writes back with the original key, as normalised slices
+        # (e.g. slice(9, -1, -1)) can't be normalised again
+        region_key = key
+        key = self._normalise_key(key)
+        base_key, order = self._to_base_key(key)
+        result = np.zeros(self._get_result_shape(base_key), dtype=self.dtype)
+        for chunk_index, result_index, local_index in self._iter_chunks(
+            base_key
+        ):
+            chunk = self.chunks.get(chunk_index)
+            if chunk is not None:
+                result[result_index] = chunk[local_index]
+
+        # remove the integer indexed axes, then return to the view order
+        result = result.reshape(
+            [
+                size
+                for size, axis in zip(result.shape, base_key)
+                if isinstance(axis, slice)
+            ]
+        )
+        if result.ndim == 0:
+            return result[()]
+        region = result.transpose(order).view(LabelsRegion)
+        region._labels = self
+        region._key = region_key
+        return region
+
+    def __setitem__(self, key, value):
+        if isinstance(key, np.ndarray) and key.dtype == bool:
+            self._set_masked(key, value)
+            return
+
+        key = self._normalise_key(key)
+        base_key, order = self._to_base_key(key)
+        value = np.asarray(value, dtype=self.dtype)
+        if value.ndim > 0:
+            # to the base order, with the integer indexed axes restored
+            view_shape = [
+                len(range(axis.start, axis.stop, axis.step))
+                for axis in key
+                if isinstance(axis, slice)
+            ]
+            value = np.broadcast_to(value, view_shape)
+            value = value.transpose(np.argsort(order))
+            value = value.reshape(self._get_result_shape(base_key))
+
+        for chunk_index, result_index, local_index in self._iter_chunks(
+            base_key
+        ):
+            piece = value[result_index] if value.ndim > 0 else value
+            chunk = self.chunks.get(chunk_index)
+            if chunk is None:
+                if not piece.any():
+                    continue
+                chunk = self._allocate_chunk(chunk_index)
+            chunk[local_index] = piece
+            self._modified.add(chunk_index)
+
+    def _set_masked(self, mask, value):
+        if mask.shape != self.shape:
+            raise IndexError(
+                f"Boolean index of shape {mask.shape} does not match labels "
+                f"of shape {self.shape}"
+            )
+        inverse_axes = np.argsort(self._axes)
+        mask = mask.transpose(inverse_axes)
+        value = np.asarray(value, dtype=self.dtype)
+        if value.ndim > 0:
+            value = np.broadcast_to(value, self.shape).transpose(inverse_axes)
+
+        for chunk_index in self._get_chunk_grid():
+            region = self._get_chunk_region(chunk_index)
+            chunk_mask = mask[region]
+            if not chunk_mask.any():
+                continue
+            piece = value[region][chunk_mask] if value.ndim > 0 else value
+            chunk = self.chunks.get(chunk_index)
+            if chunk is None:
+                if not piece.any():
+                    continue
+                chunk = self._allocate_chunk(chunk_index)
+            chunk[chunk_mask] = piece
+            self._modified.add(chunk_index)
+
+    def _normalise_key(self, key):
+        """
+        Converts an index into a tuple of integers and slices (with start,
+        stop and step resolved), one per axis of the view
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(axis is Ellipsis for axis in key):
+            position = [axis is Ellipsis for axis in key].index(True)
+            n_missing = self.ndim - len(key) + 1
+            key = (
+                key[:position]
+                + (slice(None),) * n_missing
+                + key[position + 1 :]
+            )
+        if len(key) > self.ndim:
+            raise IndexError(
+                f"Too many indices for labels of dimension {self.ndim}"
+            )
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        normalised = []
+        for axis, size in zip(key, self.shape):
+            if isinstance(axis, slice):
+                normalised.append(slice(*axis.indices(size)))
+            else:
+                index = operator.index(axis)
+                if index < 0:
+                    index += size
+                if not 0 <= index < size:
+                    raise IndexError(
+                        f"Index {axis} is out of bounds for axis with size "
+                        f"{size}"
+                    )
+                normalised.append(index)
+        return tuple(normalised)
+
+    def _to_base_key(self, key):
+        """
+        Converts a (normalised) index of the view to an index of the stored
+        chunks
+        :return: Index of the chunks, and the transposition from the
+        (sliced) chunks to the (sliced) view
+        """
+        base_key = [None] * self.ndim
+        for axis, axis_key in zip(self._axes, key):
+            base_key[axis] = axis_key
+        sliced_axes = [
+            axis
+            for axis, axis_key in zip(self._axes, key)
+            if isinstance(axis_key, slice)
+        ]
+        order = np.argsort(np.argsort(sliced_axes))
+        return tuple(base_key), tuple(int(axis) for axis in order)
+
+    def _get_result_shape(self, base_key):
+        return tuple(
+            (
+                len(range(axis.start, axis.stop, axis.step))
+                if isinstance(axis, slice)
+                else 1
+            )
+            for axis in base_key
+        )
+
+    def _iter_chunks(self, base_key):
+        axis_chunks = [
+            _get_axis_chunks(axis_key, chunk_size)
+            for axis_key, chunk_size in zip(base_key, self.chunk_shape)
+        ]
+        # slices are only used within the chunks if no axis is stepped
+        stepped = any(
+            not isinstance(local_index, slice)
+            for chunks in axis_chunks
+            for _, _, local_index in chunks
+        )
+        for chunks in itertools.product(*axis_chunks):
+            chunk_index = tuple(chunk[0] for chunk in chunks)
+            result_index = tuple(chunk[1] for chunk in chunks)
+            local_index = [chunk[2] for chunk in chunks]
+            if stepped:
+                local_index = np.ix_(
+                    *[
+                        (
+                            np.arange(index.start, index.stop)
+                            if isinstance(index, slice)
+                            else index
+                        )
+                        for index in local_index
+                    ]
+                )
+            yield chunk_index, result_index, tuple(local_index)
+
+    def _get_chunk_grid(self):
+        return itertools.product(
+            *[
+                range(-(-size // chunk_size))
+                for size, chunk_size in zip(self._shape, self.chunk_shape)
+            ]
+        )
+
+    def _get_chunk_region(self, chunk_index):
+        return tuple(
+            slice(idx * chunk_size, min((idx + 1) * chunk_size, size))
+            for idx, chunk_size, size in zip(
+                chunk_index, self.chunk_shape, self._shape
+            )
+        )
+
+    def _allocate_chunk(self, chunk_index):
+        region = self._get_chunk_region(chunk_index)
+        chunk = np.zeros(
+            [axis.stop - axis.start for axis in region], dtype=self.dtype
+        )
+        self.chunks[chunk_index] = chunk
+        return chunk
@@ -6,9 +6,7 @@ from pathlib import Path
 from skimage.measure import regionprops_table
 from vedo import mesh, Spheres, Spline
 
-from imlib.pandas.misc import initialise_df
 from imlib.source.source_files import source_custom_config_amap
-from imlib.general.list import unique_elements_lists
 from imlib.general.system import ensure_directory_exists
 
 from neuro.generic_neuro_tools import save_brain
@@ -16,22 +14,44 @@ from neuro.visualise.brainrender_tools import (
     volume_to_vector_array_to_obj_file,
     load_regions_into_brainrender,
 )
-from neuro.atlas_tools.array import lateralise_atlas
+from neuro.atlas_tools.array import offset_region_properties
 from neuro.atlas_tools.misc import get_voxel_volume, get_atlas_pixel_sizes
-from neuro.structures.structures_tree import (
-    atlas_value_to_name,
-    UnknownAtlasValue,
+from neuro.segmentation.manual_segmentation.brain_areas import (
+    analyse_regions,
+    get_bounding_box,
+    get_brain_area_table,
+    get_brain_area_volumes,
 )
+from neuro.segmentation.manual_segmentation.chunked_labels import (
+    ChunkedLabels,
+)
+from neuro.structures.structures_tree import StructureLookup
+from neuro.visualise.surfaces import MESH_FORMATS
 from neuro.visualise.napari_tools.layers import (
     prepare_load_nii,
     add_new_label_layer,
 )
 
 
-def summarise_brain_regions(label_layers, filename):
+def summarise_brain_regions(label_layers, filename, n_threads=None):
+    regions = [np.swapaxes(layer.data, 2, 0) for layer in label_layers]
+    results = analyse_regions(regions, n_threads=n_threads)
+    save_brain_region_summary(label_layers, results, filename)
+
+
+def save_brain_region_summary(label_layers, results, filename):
+    """
+    Saves the volume, extent and center of each region
+    :param label_layers: napari labels layers (with segmented regions)
+    :param results: Output of analyse_regions for the label layers
+    :param filename: Output csv file
+    """
     summaries = []
-    for label_layer in label_layers:
-        summaries.append(summarise_single_brain_region(label_layer))
+    for label_layer, result in zip(label_layers, results):
+        if result is not None:
+            df = result[1]
+            df.insert(0, "Region", label_layer.name)
+            summaries.append(df)
 
     result = pd.concat(summaries)
 
@@ -66,20 +86,73 @@ def summarise_brain_regions(label_layers, filename):
     result.to_csv(filename, index=False)
 
 
+def analyse_brain_regions(
+    label_layers,
+    destination_directory,
+    annotations,
+    hemispheres,
+    structures_reference_df,
+    summary_csv_file=None,
+    extension=".csv",
+    n_threads=None,
+):
+    """
+    Calculates the volume of each brain area within each region (as
+    analyse_region_brain_areas), and optionally summarises the regions (as
+    summarise_brain_regions), analysing all the regions in a single pass.
+    :param label_layers: napari labels layers (with segmented regions)
+    :param destination_directory: Directory to save the brain area csv files
+    :param np.array annotations: numpy array of the brain area annotations
+    :param np.array hemispheres: numpy array of hemipshere annotations
+    :param structures_reference_df: Pandas dataframe with "id" column (matching
+    the values in "annotations" and a "name column" (or a StructureLookup)
+    :param summary_csv_file: If given, save the region summary to this file
+    :param n_threads: Number of threads. Defaults to the number of CPUs.
+    """
+    regions = [np.swapaxes(layer.data, 2, 0) for layer in label_layers]
+    results = analyse_regions(
+        regions, annotations, hemispheres, n_threads=n_threads
+    )
+
+    voxel_volume = get_voxel_volume(source_custom_config_amap())
+    voxel_volume_in_mm = voxel_volume / (1000 ** 3)
+    if not isinstance(structures_reference_df, StructureLookup):
+        structures_reference_df = StructureLookup(structures_reference_df)
+
+    for label_layer, result in zip(label_layers, results):
+        # empty regions are ignored
+        if result is not None:
+            df = get_brain_area_table(
+                *result[0], structures_reference_df, voxel_volume_in_mm
+            )
+            filename = destination_directory / (label_layer.name + extension)
+            df.to_csv(filename, index=False)
+
+    if summary_csv_file is not None:
+        save_brain_region_summary(label_layers, results, summary_csv_file)
+
+
 def summarise_single_brain_region(
     label_layer,
     ignore_empty=True,
     properties_to_fetch=["area", "bbox", "centroid",],
 ):
-    data = label_layer.data
-    if ignore_empty:
-        if data.sum() == 0:
-            return
-
     # swap data back to original orientation from napari orientation
-    data = np.swapaxes(data, 2, 0)
+    data = np.swapaxes(label_layer.data, 2, 0)
 
-    regions_table = regionprops_table(data, properties=properties_to_fetch)
+    bounding_box = get_bounding_box(data)
+    if bounding_box is None:
+        if ignore_empty:
+            return
+        bounding_box = tuple(slice(0, size) for size in data.shape)
+
+    # only the region is analysed, and the coordinates offset back
+    regions_table = regionprops_table(
+        np.asarray(data[bounding_box]), properties=properties_to_fetch
+    )
+    regions_table = offset_region_properties(
+        regions_table, [axis.start for axis in bounding_box]
+    )
     df = pd.DataFrame.from_dict(regions_table)
     df.insert(0, "Region", label_layer.name)
     return df
@@ -121,7 +194,8 @@ def add_existing_label_layers(
     memory=False,
 ):
     """
-    Loads an existing (nii) image as a napari labels layer
+    Loads an existing (nii) image as a napari labels layer. The labels are
+    copied into a ChunkedLabels store (as for new regions).
     :param viewer: Napari viewer instance
     :param label_file: Filename of the image to be loaded
     :param int selected_label: Label ID to be preselected
@@ -130,7 +204,9 @@ def add_existing_label_layers(
     :return label_layer: napari labels layer
     """
     label_file = Path(label_file)
-    labels = prepare_load_nii(label_file, memory=memory)
+    labels = ChunkedLabels.from_array(
+        prepare_load_nii(label_file, memory=memory)
+    )
     label_layer = viewer.add_labels(
         labels, num_colors=num_colors, name=label_file.stem
     )
@@ -144,33 +220,87 @@ def save_regions_to_file(
     destination_directory,
     template_image,
     ignore_empty=True,
-    obj_ext=".obj",
+    obj_ext=None,
     image_extension=".nii",
+    mesh_format="obj",
+    levels_of_detail=None,
 ):
     """
     Analysed the regions (to see what brain areas they are in) and saves
-    the segmented regions to file (both as .obj and .nii)
+    the segmented regions to file (both as a mesh, e.g. .obj, and .nii)
     :param label_layer: napari labels layer (with segmented regions)
     :param destination_directory: Where to save files to
     :param template_image: Existing image of size/shape of the
     destination images
     the values in "annotations" and a "name column"
     :param ignore_empty: If True, don't attempt to save empty images
-    :param obj_ext: File extension for the obj files
+    :param obj_ext: File extension for the mesh files. Defaults to the
+    mesh format, which it must match
     :param image_extension: File extension fo the image files
+    :param mesh_format: Format of the mesh files (one of
+    neuro.visualise.surfaces.MESH_FORMATS)
+    :param levels_of_detail: Fractions of the triangles to keep in coarser
+    meshes (see neuro.visualise.brainrender_tools.save_levels_of_detail).
+    If None, only the full mesh is saved.
     """
-    data = label_layer.data
-    if ignore_empty:
-        if data.sum() == 0:
-            return
+    save_region_data_to_file(
+        label_layer.data,
+        label_layer.name,
+        destination_directory,
+        template_image,
+        ignore_empty=ignore_empty,
+        obj_ext=obj_ext,
+        image_extension=image_extension,
+        mesh_format=mesh_format,
+        levels_of_detail=levels_of_detail,
+    )
+
 
+def save_region_data_to_file(
+    data,
+    name,
+    destination_directory,
+    template_image,
+    ignore_empty=True,
+    obj_ext=None,
+    image_extension=".nii",
+    mesh_format="obj",
+    levels_of_detail=None,
+):
+    """
+    Saves a segmented region to file (both as a mesh and .nii), as
+    save_regions_to_file, from the data of a labels layer
+    :param data: Labels layer data (in napari orientation)
+    :param name: Name of the region (used for the filenames)
+    :param destination_directory: Where to save files to
+    :param template_image: Existing image of size/shape of the
+    destination images
+    :param ignore_empty: If True, don't attempt to save empty images
+    :param obj_ext: File extension for the mesh files. Defaults to the
+    mesh format, which it must match
+    :param image_extension: File extension fo the image files
+    :param mesh_format: Format of the mesh files (one of
+    neuro.visualise.surfaces.MESH_FORMATS)
+    :param levels_of_detail: Fractions of the triangles to keep in coarser
+    meshes (see neuro.visualise.brainrender_tools.save_levels_of_detail).
+    If None, only the full mesh is saved.
+    """
     # swap data back to original orientation from napari orientation
     data = np.swapaxes(data, 2, 0)
-    name = label_layer.name
 
+    bounding_box = get_bounding_box(data)
+    if ignore_empty and bounding_box is None:
+        return
+
+    if obj_ext is None:
+        obj_ext = "." + mesh_format
     filename = destination_directory / (name + obj_ext)
     volume_to_vector_array_to_obj_file(
-        data, filename,
+        data,
+        filename,
+        bounding_box=bounding_box,
+        mesh_format=mesh_format,
+        levels_of_detail=levels_of_detail,
     )
 
     filename = destination_directory / (name + image_extension)
@@ -194,158 +324,33 @@ def analyse_region_brain_areas(
     :param np.array annotations: numpy array of the brain area annotations
     :param np.array hemispheres: numpy array of hemipshere annotations
     :param structures_reference_df: Pandas dataframe with "id" column (matching
-    the values in "annotations" and a "name column"
+    the values in "annotations" and a "name column" (or a StructureLookup)
     :param ignore_empty: If True, don't analyse empty regions
     """
 
-    data = label_layer.data
-    if ignore_empty:
-        if data.sum() == 0:
-            return
-
     # swap data back to original orientation from napari orientation
-    data = np.swapaxes(data, 2, 0)
+    data = np.swapaxes(label_layer.data, 2, 0)
     name = label_layer.name
 
-    masked_annotations = data.astype(bool) * annotations
-
-    # TODO: don't hardcode hemisphere value. Get from atlas config
-    annotations_left, annotations_right = lateralise_atlas(
-        masked_annotations,
-        hemispheres,
-        left_hemisphere_value=2,
-        right_hemisphere_value=1,
-    )
-
-    unique_vals_left, counts_left = np.unique(
-        annotations_left, return_counts=True
-    )
-    unique_vals_right, counts_right = np.unique(
-        annotations_right, return_counts=True
-    )
+    bounding_box = get_bounding_box(data)
+    if ignore_empty and bounding_box is None:
+        return
 
     voxel_volume = get_voxel_volume(source_custom_config_amap())
     voxel_volume_in_mm = voxel_volume / (1000 ** 3)
 
-    df = initialise_df(
-        "structure_name",
-        "left_volume_mm3",
-        "left_percentage_of_total",
-        "right_volume_mm3",
-        "right_percentage_of_total",
-        "total_volume_mm3",
-        "percentage_of_total",
-    )
-
-    sampled_structures = unique_elements_lists(
-        list(unique_vals_left) + list(unique_vals_right)
-    )
-    total_volume_region = get_total_volume_regions(
-        unique_vals_left, unique_vals_right, counts_left, counts_right
+    df = get_brain_area_volumes(
+        data,
+        annotations,
+        hemispheres,
+        structures_reference_df,
+        voxel_volume_in_mm,
+        bounding_box=bounding_box,
     )
-
-    for atlas_value in sampled_structures:
-        if atlas_value != 0:
-            try:
-                df = add_structure_volume_to_df(
-                    df,
-                    atlas_value,
-                    structures_reference_df,
-                    unique_vals_left,
-                    unique_vals_right,
-                    counts_left,
-                    counts_right,
-                    voxel_volume_in_mm,
-                    total_volume_voxels=total_volume_region,
-                )
-
-            except UnknownAtlasValue:
-                print(
-                    "Value: {} is not in the atlas structure reference file. "
-                    "Not calculating the volume".format(atlas_value)
-                )
     filename = destination_directory / (name + extension)
     df.to_csv(filename, index=False)
 
 
-def get_total_volume_regions(
-    unique_vals_left, unique_vals_right, counts_left, counts_right,
-):
-    zero_index_left = np.where(unique_vals_left == 0)[0][0]
-    counts_left = list(counts_left)
-    counts_left.pop(zero_index_left)
-
-    zero_index_right = np.where(unique_vals_right == 0)[0][0]
-    counts_right = list(counts_right)
-    counts_right.pop(zero_index_right)
-
-    return sum(counts_left + counts_right)
-
-
-def add_structure_volume_to_df(
-    df,
-    atlas_value,
-    structures_reference_df,
-    unique_vals_left,
-    unique_vals_right,
-    counts_left,
-    counts_right,
-    voxel_volume,
-    total_volume_voxels=None,
-):
-    name = atlas_value_to_name(atlas_value, structures_reference_df)
-
-    left_volume, left_percentage = get_volume_in_hemisphere(
-        atlas_value,
-        unique_vals_left,
-        counts_left,
-        total_volume_voxels,
-        voxel_volume,
-    )
-    right_volume, right_percentage = get_volume_in_hemisphere(
-        atlas_value,
-        unique_vals_right,
-        counts_right,
-        total_volume_voxels,
-        voxel_volume,
-    )
-    if total_volume_voxels is not None:
-        total_percentage = left_percentage + right_percentage
-    else:
-        total_percentage = 0
-
-    df = df.append(
-        {
-            "structure_name": name,
-            "left_volume_mm3": left_volume,
-            "left_percentage_of_total": left_percentage,
-            "right_volume_mm3": right_volume,
-            "right_percentage_of_total": right_percentage,
-            "total_volume_mm3": left_volume + right_volume,
-            "percentage_of_total": total_percentage,
-        },
-        ignore_index=True,
-    )
-    return df
-
-
-def get_volume_in_hemisphere(
-    atlas_value, unique_vals, counts, total_volume_voxels, voxel_volume
-):
-    try:
-        index = np.where(unique_vals == atlas_value)[0][0]
-        volume = counts[index] * voxel_volume
-        if total_volume_voxels is not None:
-            percentage = 100 * (counts[index] / total_volume_voxels)
-        else:
-            percentage = 0
-    except IndexError:
-        volume = 0
-        percentage = 0
-
-    return volume, percentage
-
-
 def convert_and_save_points(
     points_layers,
     output_directory,
@@ -569,11 +574,21 @@ def view_in_brainrender(
     shading="flat",
     region_to_add=[],
     region_alpha=0.3,
+    mesh_format=None,
+    level_of_detail=0,
 ):
-    obj_files = glob(str(regions_directory) + "/*.obj")
+    # regions saved in any mesh format, unless one is given
+    mesh_formats = MESH_FORMATS if mesh_format is None else [mesh_format]
+    obj_files = []
+    for mesh_format in mesh_formats:
+        obj_files.extend(glob(str(regions_directory) + "/*." + mesh_format))
     if obj_files:
         scene = load_regions_into_brainrender(
-            scene, obj_files, alpha=alpha, shading=shading
+            scene,
+            obj_files,
+            alpha=alpha,
+            shading=shading,
+            level_of_detail=level_of_detail,
         )
     try:
         scene = display_track_in_brainrender(
@@ -0,0 +1,203 @@
+"""
+Saves manually segmented regions in parallel, using a pool of worker
+processes (one region per task). Regions stored as ChunkedLabels are copied
+(only the painted chunks) and sent to the workers. Other label arrays are
+saved once as .npy files, and memory-mapped (read-only) by the workers.
+
+The workers are started with the "spawn" method, as saving runs in a thread
+of the (multi-threaded) GUI, and forking it could deadlock the workers.
+"""
+
+import os
+import sys
+import queue
+import tempfile
+import multiprocessing
+
+from pathlib import Path
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from neuro.atlas_tools.array import get_bounding_box
+from neuro.segmentation.manual_segmentation.chunked_labels import (
+    ChunkedLabels,
+)
+
+
+def share_region(data, directory, index):
+    """
+    Prepares the data of a labels layer to be sent to a worker process
+    :param data: Labels layer data
+    :param directory: Directory to save shared arrays in
+    :param index: Index of the region (used for the shared array filename)
+    :return: Copy of the data (ChunkedLabels) or the path of the shared array
+    """
+    if isinstance(data, ChunkedLabels):
+        # a snapshot, so the region can still be edited while it is saved
+        return data.copy()
+    shared_path = Path(directory) / f"region_{index}.npy"
+    np.save(str(shared_path), np.asarray(data))
+    return str(shared_path)
+
+
+def load_shared_region(shared):
+    """
+    Loads a region shared with share_region (in a worker process)
+    :param shared: Output of share_region
+    :return: Labels layer data
+    """
+    if isinstance(shared, ChunkedLabels):
+        return shared
+    return np.load(shared, mmap_mode="r")
+
+
+def _run_in_executor(function, tasks, n_workers, context):
+    # Python >= 3.7
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=context
+    ) as executor:
+        futures = [
+            executor.submit(function, *args, **kwargs)
+            for args, kwargs in tasks
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _run_in_pool(function, tasks, n_workers, context):
+    # Python 3.6, where ProcessPoolExecutor can't be given a start method
+    results = queue.Queue()
+    with context.Pool(n_workers) as pool:
+        for args, kwargs in tasks:
+            pool.apply_async(
+                function,
+                args,
+                kwargs,
+                callback=results.put,
+                error_callback=results.put,
+            )
+        for _ in range(len(tasks)):
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+
+
+def run_in_workers(function, tasks, n_workers):
+    """
+    Runs a function in a pool of (spawned) worker processes
+    :param function: Function to run (must be picklable)
+    :param tasks: List of (args, kwargs) to call the function with
+    :param n_workers: Number of worker processes
+    :return: Generator of the result of each call, as it is completed
+    """
+    context = multiprocessing.get_context("spawn")
+    if sys.version_info >= (3, 7):
+        return _run_in_executor(function, tasks, n_workers, context)
+    return _run_in_pool(function, tasks, n_workers, context)
+
+
+def save_region(
+    shared,
+    name,
+    destination_directory,
+    template_image,
+    mesh_format="obj",
+    levels_of_detail=None,
+):
+    """
+    Saves a single region to file (run in a worker process)
+    :param shared: Region data (from share_region)
+    :param name: Name of the region
+    :param destination_directory: Where to save files to
+    :param template_image: Existing image of size/shape of the
+    destination images
+    :param mesh_format: Format of the mesh files
+    :param levels_of_detail: Fractions of the triangles to keep in coarser
+    meshes (or None)
+    :return: Dict of the timing and status of the save
+    """
+    # only needed in the worker processes
+    from neuro.segmentation.manual_segmentation.man_seg_tools import (
+        save_region_data_to_file,
+    )
+
+    start = timer()
+    result = {"region": name}
+    try:
+        save_region_data_to_file(
+            load_shared_region(shared),
+            name,
+            Path(destination_directory),
+            template_image,
+            mesh_format=mesh_format,
+            levels_of_detail=levels_of_detail,
+        )
+        result["status"] = "success"
+        result["error"] = ""
+    except Exception as err:
+        result["status"] = "failed"
+        result["error"] = f"{type(err).__name__}: {err}"
+
+    result["time_s"] = timer() - start
+    return result
+
+
+def save_regions(
+    label_layers,
+    destination_directory,
+    template_image,
+    n_workers=None,
+    tmp_directory=None,
+    mesh_format="obj",
+    levels_of_detail=None,
+):
+    """
+    Saves the segmented regions to file (as save_regions_to_file), in
+    parallel. Empty regions are not saved.
+    :param label_layers: napari labels layers (with segmented regions)
+    :param destination_directory: Where to save files to
+    :param template_image: Existing image of size/shape of the
+    destination images
+    :param n_workers: Maximum number of worker processes. Defaults to the
+    number of CPUs.
+    :param tmp_directory: Where to save any shared arrays. Defaults to the
+    system temporary directory.
+    :param mesh_format: Format of the mesh files (one of
+    neuro.visualise.surfaces.MESH_FORMATS)
+    :param levels_of_detail: Fractions of the triangles to keep in coarser
+    meshes (see neuro.visualise.brainrender_tools.save_levels_of_detail).
+    If None, only the full mesh is saved.
+    :return: Generator of the result of save_region for each region, as it
+    is saved
+    """
+    label_layers = [
+        layer
+        for layer in label_layers
+        if get_bounding_box(layer.data) is not None
+    ]
+    if not label_layers:
+        return
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = min(n_workers, len(label_layers))
+
+    with tempfile.TemporaryDirectory(dir=tmp_directory) as shared_directory:
+        tasks = [
+            (
+                (
+                    share_region(layer.data, shared_directory, idx),
+                    layer.name,
+                    str(destination_directory),
+                    str(template_image),
+                ),
+                {
+                    "mesh_format": mesh_format,
+                    "levels_of_detail": levels_of_detail,
+                },
+            )
+            for idx, layer in enumerate(label_layers)
+        ]
+        yield from run_in_workers(save_region, tasks, n_workers)
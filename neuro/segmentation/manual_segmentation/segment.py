@@ -1,4 +1,5 @@
 import napari
+from neuro.segmentation.manual_segmentation.autosave import AUTOSAVE_INTERVAL
 from neuro.segmentation.manual_segmentation.widgets import General
 
 
@@ -23,6 +24,10 @@ def main(
     structure_alpha_default=0.8,
     shading_default="flat",
     region_to_add_default="",
+    autosave_interval=AUTOSAVE_INTERVAL,
+    mesh_format="obj",
+    levels_of_detail=None,
+    level_of_detail=0,
 ):
 
     print("Loading manual segmentation GUI.\n ")
@@ -51,6 +56,10 @@ def main(
             structure_alpha_default=structure_alpha_default,
             shading_default=shading_default,
             region_to_add_default=region_to_add_default,
+            autosave_interval=autosave_interval,
+            mesh_format=mesh_format,
+            levels_of_detail=levels_of_detail,
+            level_of_detail=level_of_detail,
         )
         viewer.window.add_dock_widget(general, name="General", area="right")
 
@@ -5,6 +5,7 @@ from glob import glob
 
 from brainrender.scene import Scene
 from neuro.structures.IO import load_structures_as_df
+from neuro.structures.structures_tree import get_structure_lookup
 from imlib.source.source_files import get_structures_path
 
 from neuro.segmentation.paths import Paths
@@ -21,6 +22,10 @@ from neuro.visualise.napari_tools.callbacks import (
     save_all,
 )
 
+from neuro.segmentation.manual_segmentation.autosave import (
+    AUTOSAVE_INTERVAL,
+    LayerChangeTracker,
+)
 from neuro.segmentation.manual_segmentation.man_seg_tools import (
     add_existing_region_segmentation,
     add_existing_track_layers,
@@ -75,6 +80,10 @@ class General(QWidget):
         shading_default="flat",
         region_to_add_default="",
         vtkplotter_shading_types=["flat", "giroud", "phong"],
+        autosave_interval=AUTOSAVE_INTERVAL,
+        mesh_format="obj",
+        levels_of_detail=None,
+        level_of_detail=0,
     ):
         super(General, self).__init__()
         self.point_size = point_size
@@ -109,6 +118,10 @@ class General(QWidget):
         self.num_colors = num_colors
         self.calculate_volumes_default = calculate_volumes_default
         self.summarise_volumes_default = summarise_volumes_default
+        self.mesh_format = mesh_format
+        # coarser meshes saved for each region, and the one to render
+        self.levels_of_detail = levels_of_detail
+        self.level_of_detail = level_of_detail
 
         # atlas variables
         self.region_labels = []
@@ -120,6 +133,14 @@ class General(QWidget):
         self.region_to_add_default = region_to_add_default
         self.vtkplotter_shading_types = vtkplotter_shading_types
 
+        # saving variables
+        # only layers that have changed since they were last saved are saved
+        self.change_tracker = LayerChangeTracker()
+        self.saving = False
+        self.autosave_interval = autosave_interval
+        self.autosave_timer = QtCore.QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+
         self.setup_layout()
 
     def setup_layout(self):
@@ -307,7 +328,7 @@ class General(QWidget):
 
             @self.region_labels.mouse_move_callbacks.append
             def display_region_name(layer, event):
-                display_brain_region_name(layer, self.structures_df)
+                display_brain_region_name(layer, self.structures)
 
             self.status_label.setText(f"Ready")
 
@@ -353,12 +374,16 @@ class General(QWidget):
         self.initialise_image_view()
 
         self.structures_df = load_structures_as_df(get_structures_path())
+        self.structures = get_structure_lookup(get_structures_path())
 
         self.load_button.setMinimumWidth(0)
         self.load_atlas_button.setVisible(True)
         self.save_button.setVisible(True)
         self.initialise_region_segmentation()
         self.initialise_track_tracing()
+        self.change_tracker.set_saved(self.label_layers + self.track_layers)
+        if self.autosave_interval > 0:
+            self.autosave_timer.start(int(self.autosave_interval * 1000))
         self.status_label.setText(f"Ready")
 
     def select_nii_file(self):
@@ -470,10 +495,23 @@ class General(QWidget):
             shading=str(self.shading.currentText()),
             region_to_add=str(self.region_to_render.currentText()),
             region_alpha=self.structure_alpha.value(),
+            mesh_format=self.mesh_format,
+            level_of_detail=self.level_of_detail,
         )
 
     def save(self):
+        if self.saving:
+            print("Already saving")
+            return
         print("Saving")
+        self.save_changed_layers()
+
+    def autosave(self):
+        if not self.saving:
+            self.save_changed_layers()
+
+    def save_changed_layers(self):
+        self.saving = True
         worker = save_all(
             self.viewer,
             self.paths.regions_directory,
@@ -485,5 +523,16 @@ class General(QWidget):
             self.y_scaling,
             self.z_scaling,
             track_file_extension=self.track_file_extension,
+            change_tracker=self.change_tracker,
+            mesh_format=self.mesh_format,
+            levels_of_detail=self.levels_of_detail,
         )
+        worker.yielded.connect(self.show_save_progress)
+        worker.finished.connect(self.finish_saving)
         worker.start()
+
+    def show_save_progress(self, message):
+        self.viewer.status = message
+
+    def finish_saving(self):
+        self.saving = False
@@ -1,5 +1,87 @@
+import logging
+
+import numpy as np
 import pandas as pd
 
+from neuro.cache import (
+    get_writable_cache_path,
+    load_npz_cache,
+    save_npz_cache,
+)
+
+TEXT_SEPARATOR = "\0"
+
+
+def load_structures_as_df(structures_file_path, use_cache=True):
+    """
+    Loads a structures csv file. The parsed columns are cached (as
+    "<structures_file>.cache.npz", or in the metadata cache directory if the
+    file's directory isn't writable), and the cache is used as long as the
+    csv file is unchanged.
+    :param structures_file_path: Structures csv file
+    :param use_cache: Read from (and write to) the cache
+    :return: Pandas dataframe of the structures
+    """
+    if not use_cache:
+        return read_structures_csv(structures_file_path)
+
+    cache_path = get_writable_cache_path(structures_file_path)
+    cache = load_npz_cache(structures_file_path, cache_path=cache_path)
+    if cache is not None:
+        logging.debug(f"Loading structures from cache of: {cache_path}")
+        return arrays_to_df(cache)
+
+    df = read_structures_csv(structures_file_path)
+    save_npz_cache(structures_file_path, df_to_arrays(df), cache_path)
+    return df
 
-def load_structures_as_df(structures_file_path):
+
+def read_structures_csv(structures_file_path):
     return pd.read_csv(structures_file_path, sep=",", header=0, quotechar='"')
+
+
+def df_to_arrays(df):
+    """
+    Converts a dataframe to a dict of arrays that can be saved (and loaded
+    quickly) without pickling. Each text column is saved as a single block
+    of (null separated) utf-8 text, with a mask of the missing values.
+    :param df: Pandas dataframe
+    :return: Dict of arrays
+    """
+    arrays = {
+        "columns": np.array(df.columns, dtype=str),
+        "dtypes": np.array([str(dtype) for dtype in df.dtypes], dtype=str),
+    }
+    for idx, column in enumerate(df.columns):
+        values = df[column]
+        if values.dtype.kind in "biuf":
+            arrays[f"values_{idx}"] = values.to_numpy()
+        else:
+            text = TEXT_SEPARATOR.join(values.fillna("").astype(str))
+            arrays[f"values_{idx}"] = np.frombuffer(
+                text.encode("utf-8"), dtype=np.uint8
+            )
+            arrays[f"missing_{idx}"] = values.isnull().to_numpy()
+    return arrays
+
+
+def arrays_to_df(arrays):
+    """
+    Converts the output of df_to_arrays back to a dataframe
+    :param arrays: Dict of arrays
+    :return: Pandas dataframe
+    """
+    columns = {}
+    for idx, (column, dtype) in enumerate(
+        zip(arrays["columns"], arrays["dtypes"])
+    ):
+        values = arrays[f"values_{idx}"]
+        if f"missing_{idx}" in arrays:
+            missing = arrays[f"missing_{idx}"]
+            text = values.tobytes().decode("utf-8")
+            values = np.empty(len(missing), dtype=object)
+            if len(missing):
+                values[:] = text.split(TEXT_SEPARATOR)
+            values[missing] = np.nan
+        columns[str(column)] = pd.Series(values).astype(str(dtype))
+    return pd.DataFrame(columns)
@@ -0,0 +1,126 @@
+"""
+Propagates per-structure statistics (e.g. cell counts, volumes) from the
+annotated structures to all of their ancestors in the structure hierarchy.
+The hierarchy (a StructureTree) is converted once into a sparse
+(structure x ancestor) matrix, so that all the structures are rolled up in a
+single matrix product.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from neuro.structures.structures_tree import (
+    UnknownAtlasValue,
+    get_structure_tree,
+)
+
+
+def get_ancestor_matrix(structures_reference_df):
+    """
+    Builds the ancestor relation of the structure hierarchy.
+    :param structures_reference_df: Pandas dataframe with an "id" column, and
+    a parent id or "structure_id_path" column (or a StructureTree)
+    :return: Tuple of:
+        - sorted array of the structure ids
+        - sparse (n x n) matrix, with [i, j] = 1 if structure j is structure
+          i or one of its ancestors (ordered as the sorted ids)
+        - array of the depth of each structure (the root is 0)
+        - array of the parent id of each structure (NaN for the root)
+    """
+    tree = get_structure_tree(structures_reference_df)
+    # the tree is in dataframe order
+    order = np.argsort(tree.ids)
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+
+    ancestor_rows = [
+        tree.get_ancestor_rows(i) + [tree.get_row(i)] for i in tree.ids
+    ]
+    lengths = np.array([len(rows) for rows in ancestor_rows])
+    columns = np.fromiter(
+        (row for rows in ancestor_rows for row in rows),
+        dtype=np.int64,
+        count=lengths.sum(),
+    )
+    rows = np.repeat(np.arange(len(order)), lengths)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows)), (position[rows], position[columns])),
+        shape=(len(order), len(order)),
+    )
+
+    parent_rows = tree.parent_rows[order]
+    parents = np.where(
+        parent_rows == -1, np.nan, tree.ids[parent_rows].astype(np.float64)
+    )
+    return tree.ids[order], matrix, tree.depth[order], parents
+
+
+def get_structure_index(ids, structure_ids):
+    """
+    Finds the position of structure ids in a sorted array of all the ids
+    :param ids: Sorted array of all the structure ids
+    :param structure_ids: Structure ids to look up
+    :return: Array of indices into ids
+    """
+    structure_ids = np.asarray(structure_ids, dtype=np.int64)
+    index = np.searchsorted(ids, structure_ids)
+    index = np.minimum(index, len(ids) - 1)
+    unknown = ids[index] != structure_ids
+    if unknown.any():
+        raise UnknownAtlasValue(np.unique(structure_ids[unknown]).tolist())
+    return index
+
+
+def roll_up(
+    table,
+    structures_reference_df,
+    value_columns=None,
+    id_column="structure_id",
+):
+    """
+    Sums per-structure values into every ancestor of each structure, so that
+    each structure's value includes all of its descendants.
+    :param table: Pandas dataframe with one row (or more) per structure
+    :param structures_reference_df: Pandas dataframe with "id", "name" and
+    parent id or "structure_id_path" columns
+    :param value_columns: Columns to sum. Defaults to all numeric columns
+    (other than the id column).
+    :param id_column: Column of the table with the structure ids
+    :return: Pandas dataframe with one row per structure that (or whose
+    descendants) appear in the table, with "structure_id",
+    "structure_name", "parent_structure_id" and "depth" columns, followed by
+    the summed values. Sorted by depth, then id.
+    """
+    if value_columns is None:
+        value_columns = [
+            column
+            for column in table.select_dtypes(include=np.number).columns
+            if column != id_column
+        ]
+    ids, matrix, depth, parents = get_ancestor_matrix(structures_reference_df)
+    index = get_structure_index(ids, table[id_column])
+
+    values = np.zeros((len(ids), len(value_columns)), dtype=np.float64)
+    np.add.at(values, index, table[value_columns].to_numpy(dtype=np.float64))
+    present = np.zeros(len(ids), dtype=np.float64)
+    present[index] = 1
+
+    rolled_up = matrix.T @ values
+    included = (matrix.T @ present) > 0
+
+    names = structures_reference_df.set_index("id")["name"]
+    result = pd.DataFrame(
+        {
+            "structure_id": ids[included],
+            "structure_name": names.reindex(ids[included]).to_numpy(),
+            "parent_structure_id": parents[included],
+            "depth": depth[included],
+        }
+    )
+    for idx, column in enumerate(value_columns):
+        result[column] = rolled_up[included, idx]
+        if np.issubdtype(table[column].dtype, np.integer):
+            result[column] = result[column].astype(table[column].dtype)
+    result = result.sort_values(["depth", "structure_id"])
+    return result.reset_index(drop=True)
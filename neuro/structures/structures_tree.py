@@ -1,3 +1,10 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from neuro.structures.IO import load_structures_as_df
+
+
 class CellCountMissingCellsException(Exception):
     pass
 
@@ -6,7 +13,13 @@ class UnknownAtlasValue(Exception):
     pass
 
 
+# structures lookups, by (structures file, modification time)
+_structure_lookups = {}
+
+
 def atlas_value_to_structure_id(atlas_value, structures_reference_df):
+    if isinstance(structures_reference_df, StructureLookup):
+        return structures_reference_df.get_structure_id_path(atlas_value)
     line = structures_reference_df[
         structures_reference_df["id"] == atlas_value
     ]
@@ -17,6 +30,8 @@ def atlas_value_to_structure_id(atlas_value, structures_reference_df):
 
 
 def atlas_value_to_name(atlas_value, structures_reference_df):
+    if isinstance(structures_reference_df, StructureLookup):
+        return structures_reference_df.get_name(atlas_value)
     line = structures_reference_df[
         structures_reference_df["id"] == atlas_value
     ]
@@ -24,3 +39,322 @@ def atlas_value_to_name(atlas_value, structures_reference_df):
         raise UnknownAtlasValue(atlas_value)
     name = line["name"]
     return str(name.values[0])
+
+
+class StructureLookup:
+    """
+    Lookup of structure names (and id paths) by atlas value, built once from
+    a structures dataframe. Single values are looked up in a dict (e.g. when
+    displaying the structure under the mouse), and arrays of values by
+    binary search of the sorted ids.
+
+    :param structures_df: Pandas dataframe with "id" and "name" columns, and
+    optionally a "structure_id_path" column
+    """
+
+    def __init__(self, structures_df):
+        structures_df = structures_df[structures_df["id"].notnull()]
+        ids = structures_df["id"].to_numpy().astype(np.int64)
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.names = structures_df["name"].to_numpy(dtype=object)[order]
+        self.structure_id_paths = None
+        if "structure_id_path" in structures_df:
+            self.structure_id_paths = structures_df[
+                "structure_id_path"
+            ].to_numpy()[order]
+        # as in atlas_value_to_name, the first row of duplicated ids is used
+        self._rows = {}
+        for row, structure_id in enumerate(self.ids):
+            self._rows.setdefault(int(structure_id), row)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, atlas_value):
+        return self._get_row(atlas_value) is not None
+
+    def _get_row(self, atlas_value):
+        try:
+            return self._rows.get(int(atlas_value))
+        except (TypeError, ValueError):
+            return None
+
+    def get_name(self, atlas_value):
+        """
+        :param atlas_value: Atlas (annotation) value
+        :return: Structure name
+        """
+        row = self._get_row(atlas_value)
+        if row is None:
+            raise UnknownAtlasValue(atlas_value)
+        return self.names[row]
+
+    def get_structure_id_path(self, atlas_value):
+        """
+        :param atlas_value: Atlas (annotation) value
+        :return: Structure id path (e.g. "/997/8/567/")
+        """
+        if self.structure_id_paths is None:
+            raise KeyError("Structures have no 'structure_id_path' column")
+        row = self._get_row(atlas_value)
+        if row is None:
+            raise UnknownAtlasValue(atlas_value)
+        return self.structure_id_paths[row]
+
+    def get_rows(self, atlas_values):
+        """
+        Finds the row of each atlas value in the (sorted) lookup arrays
+        :param atlas_values: Array of atlas values (any shape)
+        :return: Array of rows (same shape), and a boolean array of whether
+        each value is a known structure
+        """
+        atlas_values = np.asarray(atlas_values).astype(np.int64)
+        rows = np.searchsorted(self.ids, atlas_values)
+        rows = np.minimum(rows, len(self.ids) - 1)
+        known = self.ids[rows] == atlas_values
+        return rows, known
+
+    def get_names(self, atlas_values, unknown_name=None):
+        """
+        Looks up the names of an array of atlas values
+        :param atlas_values: Array of atlas values (any shape)
+        :param unknown_name: Name to give values that aren't in the
+        structures. If None, UnknownAtlasValue is raised.
+        :return: Array of structure names (same shape)
+        """
+        rows, known = self.get_rows(atlas_values)
+        if unknown_name is None and not known.all():
+            values = np.asarray(atlas_values)[~known]
+            raise UnknownAtlasValue(np.unique(values).tolist())
+        names = self.names[rows]
+        names[~known] = unknown_name
+        return names
+
+
+def get_structure_lookup(structures_file):
+    """
+    Returns a StructureLookup for a structures csv file. Lookups are cached
+    for the lifetime of the process, and rebuilt if the file changes.
+    :param structures_file: Structures csv file
+    :return: StructureLookup
+    """
+    structures_file = Path(structures_file).resolve()
+    key = (str(structures_file), structures_file.stat().st_mtime_ns)
+    if key not in _structure_lookups:
+        _structure_lookups[key] = StructureLookup(
+            load_structures_as_df(structures_file)
+        )
+    return _structure_lookups[key]
+
+
+class StructureTree:
+    """
+    Index of a structure hierarchy, built once from a structures dataframe,
+    so that parent, ancestor and descendant queries don't need to search
+    the dataframe. Structures are stored in the order of the dataframe, and
+    the descendants of each structure are a contiguous range of a depth
+    first (pre-order) traversal of the tree.
+
+    :param structures_df: Pandas dataframe with an "id" column, and either
+    a "parent_id" or "parent_structure_id" column, or a "structure_id_path"
+    column
+    """
+
+    def __init__(self, structures_df):
+        structures_df = structures_df[structures_df["id"].notnull()]
+        self.id_values = structures_df["id"].to_numpy()
+        self.ids = self.id_values.astype(np.int64)
+        self.parent_values = get_parent_values(structures_df)
+        self._rows = {
+            structure_id: row for row, structure_id in enumerate(self.ids)
+        }
+
+        # -1 if the parent isn't in the tree (i.e. the root)
+        self.parent_rows = np.array(
+            [
+                -1 if pd.isnull(parent) else self._rows.get(int(parent), -1)
+                for parent in self.parent_values
+            ],
+            dtype=np.int64,
+        )
+        self.roots = np.flatnonzero(self.parent_rows == -1)
+        self._children = [[] for _ in range(len(self.ids))]
+        for row, parent_row in enumerate(self.parent_rows):
+            if parent_row != -1:
+                self._children[parent_row].append(row)
+        self._traverse()
+
+    def _traverse(self):
+        """
+        Depth first traversal of the tree, to find the range of descendants
+        of each structure, the depth of each structure, and the (parent id)
+        path from the root of each structure
+        """
+        n_structures = len(self.ids)
+        self.order = np.empty(n_structures, dtype=np.int64)
+        self.start = np.empty(n_structures, dtype=np.int64)
+        self.end = np.empty(n_structures, dtype=np.int64)
+        self.depth = np.empty(n_structures, dtype=np.int64)
+        self._ancestor_rows = [None] * n_structures
+        self._parent_paths = [None] * n_structures
+
+        position = 0
+        for root in self.roots:
+            parent = self.parent_values[root]
+            self._ancestor_rows[root] = []
+            self._parent_paths[root] = [] if pd.isnull(parent) else [parent]
+            self.depth[root] = 0
+            # (row, entering) pairs, to record where each subtree ends
+            stack = [(root, True)]
+            while stack:
+                row, entering = stack.pop()
+                if not entering:
+                    self.end[row] = position
+                    continue
+                self.order[position] = row
+                self.start[row] = position
+                position += 1
+                stack.append((row, False))
+                ancestor_rows = self._ancestor_rows[row] + [row]
+                parent_path = self._parent_paths[row]
+                for child in reversed(self._children[row]):
+                    # ancestor rows are shared between siblings (and only
+                    # returned as copies)
+                    self._ancestor_rows[child] = ancestor_rows
+                    self._parent_paths[child] = parent_path + [
+                        self.parent_values[child]
+                    ]
+                    self.depth[child] = self.depth[row] + 1
+                    stack.append((child, True))
+        if position != n_structures:
+            raise ValueError("The structure hierarchy contains a cycle")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, structure_id):
+        return structure_id in self._rows
+
+    def get_row(self, structure_id):
+        """
+        :param structure_id: Structure id
+        :return: Position of the structure in the dataframe
+        """
+        try:
+            return self._rows[int(structure_id)]
+        except KeyError:
+            raise UnknownAtlasValue(structure_id)
+
+    def get_rows(self, structure_ids):
+        """
+        :param structure_ids: Iterable of structure ids
+        :return: Array of the positions of the structures in the dataframe
+        """
+        return np.array(
+            [self.get_row(structure_id) for structure_id in structure_ids],
+            dtype=np.int64,
+        )
+
+    def get_parent(self, structure_id):
+        """
+        :param structure_id: Structure id
+        :return: Parent structure id (as in the dataframe)
+        """
+        return self.parent_values[self.get_row(structure_id)]
+
+    def get_children(self, structure_id):
+        """
+        :param structure_id: Structure id
+        :return: List of the ids of the direct children of the structure
+        """
+        rows = self._children[self.get_row(structure_id)]
+        return [self.id_values[row] for row in rows]
+
+    def get_ancestors(self, structure_id, root_id=None):
+        """
+        Returns the parent ids of all the ancestors of a structure (i.e. the
+        path from the root, excluding the structure itself)
+        :param structure_id: Structure id
+        :param root_id: If given, only return the path from this structure
+        :return: List of ids (as in the parent column of the dataframe),
+        starting at the root
+        """
+        path = self._parent_paths[self.get_row(structure_id)]
+        if root_id is not None:
+            for idx, parent in enumerate(path):
+                if parent == root_id:
+                    return path[idx:]
+        return list(path)
+
+    def get_ancestor_rows(self, structure_id):
+        """
+        :param structure_id: Structure id
+        :return: List of the positions of the ancestors of the structure in
+        the dataframe, starting at the root
+        """
+        return list(self._ancestor_rows[self.get_row(structure_id)])
+
+    def get_descendants(self, structure_id):
+        """
+        :param structure_id: Structure id
+        :return: List of the ids of all the descendants of the structure
+        (excluding itself), in the order of the dataframe
+        """
+        row = self.get_row(structure_id)
+        rows = np.sort(self.order[self.start[row] + 1 : self.end[row]])
+        return [self.id_values[row] for row in rows]
+
+    def is_descendant(self, structure_id, ancestor_id):
+        """
+        :param structure_id: Structure id
+        :param ancestor_id: Possible ancestor structure id
+        :return: True if ancestor_id is an ancestor of structure_id
+        """
+        row = self.get_row(structure_id)
+        ancestor_row = self.get_row(ancestor_id)
+        return (
+            self.start[ancestor_row] < self.start[row] < self.end[ancestor_row]
+        )
+
+    def get_path_string(self, structure_id):
+        """
+        :param structure_id: Structure id
+        :return: Structure id path (e.g. "/997/8/567/")
+        """
+        rows = self.get_ancestor_rows(structure_id)
+        rows.append(self.get_row(structure_id))
+        return "/" + "".join(f"{self.ids[row]}/" for row in rows)
+
+
+def get_parent_values(structures_df):
+    """
+    Returns the parent id of each structure in a structures dataframe
+    :param structures_df: Pandas dataframe with a "parent_id",
+    "parent_structure_id" or "structure_id_path" column
+    :return: Array of parent ids (NaN if there is no parent)
+    """
+    for column in ("parent_id", "parent_structure_id"):
+        if column in structures_df:
+            return structures_df[column].to_numpy()
+    if "structure_id_path" in structures_df:
+        paths = (
+            structures_df["structure_id_path"].str.strip("/").str.split("/")
+        )
+        return np.array(
+            [float(path[-2]) if len(path) > 1 else np.nan for path in paths]
+        )
+    raise KeyError(
+        "Structures dataframe has no 'parent_id', 'parent_structure_id' or "
+        "'structure_id_path' column"
+    )
+
+
+def get_structure_tree(structures):
+    """
+    :param structures: Structures dataframe or StructureTree
+    :return: StructureTree
+    """
+    if isinstance(structures, StructureTree):
+        return structures
+    return StructureTree(structures)
@@ -1,7 +1,7 @@
 import napari
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from pathlib import Path
-from neuro.structures.IO import load_structures_as_df
+from neuro.structures.structures_tree import get_structure_lookup
 
 from neuro.atlas_tools.paths import Paths
 from imlib.source.source_files import get_structures_path
@@ -59,7 +59,7 @@ def main():
     print("Starting amap viewer")
     args = parser().parse_args()
 
-    structures_df = load_structures_as_df(get_structures_path())
+    structures = get_structure_lookup(get_structures_path())
 
     if not args.memory:
         print(
@@ -101,7 +101,7 @@ def main():
 
             @region_labels.mouse_move_callbacks.append
             def display_region_name(layer, event):
-                display_brain_region_name(layer, structures_df)
+                display_brain_region_name(layer, structures)
 
         else:
             raise FileNotFoundError(
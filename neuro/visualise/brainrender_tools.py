@@ -1,35 +1,27 @@
+import vtk
 import numpy as np
 from pathlib import Path
 from brainrender.scene import Scene
 from skimage import measure
+from vedo import Mesh
+from vtk.util.numpy_support import (
+    numpy_to_vtk,
+    numpy_to_vtkIdTypeArray,
+    vtk_to_numpy,
+)
 
 from imlib.general.pathlib import append_to_pathlib_stem
+from imlib.general.system import ensure_directory_exists
 from imlib.plotting.colors import get_random_vtkplotter_color
 
+from neuro.atlas_tools.array import get_bounding_box, pad_bounding_box
 from neuro.atlas_tools.custom_atlas_structures import (
     get_arbitrary_structure_mask_from_custom_atlas,
 )
+from neuro.visualise.surfaces import MESH_FORMATS, read_mesh, save_mesh
 
-
-def marching_cubes_to_obj(marching_cubes_out, output_file):
-    """
-    Saves the output of skimage.measure.marching_cubes as an .obj file
-    :param marching_cubes_out: tuple
-    :param output_file: str
-    """
-
-    verts, faces, normals, _ = marching_cubes_out
-    with open(output_file, "w") as f:
-        for item in verts:
-            f.write(f"v {item[0]} {item[1]} {item[2]}\n")
-        for item in normals:
-            f.write(f"vn {item[0]} {item[1]} {item[2]}\n")
-        for item in faces:
-            f.write(
-                f"f {item[0]}//{item[0]} {item[1]}//{item[1]} "
-                f"{item[2]}//{item[2]}\n"
-            )
-        f.close()
+# bisection steps when decimating a mesh to a maximum error
+MAX_ERROR_SEARCH_STEPS = 6
 
 
 def reorient_image(image, invert_axes=None, orientation="saggital"):
@@ -56,6 +48,50 @@ def reorient_image(image, invert_axes=None, orientation="saggital"):
     return image
 
 
+def reorient_bounding_box(
+    bounding_box,
+    shape,
+    invert_axes=None,
+    orientation="saggital",
+    inverse=False,
+):
+    """
+    Reorients a bounding box of an image, as reorient_image reorients the
+    image
+    :param bounding_box: Tuple of slices (one per axis)
+    :param shape: Shape of the image
+    :param invert_axes: tuple (Default value = None)
+    :param orientation:  (Default value = "saggital")
+    :param inverse: If True, the bounding box (and shape) are of the
+    reoriented image, and are returned to the original orientation
+    :return: Tuple of slices
+    """
+    bounding_box = list(bounding_box)
+    shape = list(shape)
+    transposition = None
+    if orientation != "saggital":
+        if orientation == "coronal":
+            transposition = (2, 1, 0)
+        elif orientation == "horizontal":
+            transposition = (1, 2, 0)
+
+    if inverse and transposition is not None:
+        transposition = np.argsort(transposition)
+        bounding_box = [bounding_box[axis] for axis in transposition]
+        shape = [shape[axis] for axis in transposition]
+
+    if invert_axes is not None:
+        for axis in invert_axes:
+            axis_slice = bounding_box[axis]
+            bounding_box[axis] = slice(
+                shape[axis] - axis_slice.stop, shape[axis] - axis_slice.start
+            )
+
+    if not inverse and transposition is not None:
+        bounding_box = [bounding_box[axis] for axis in transposition]
+    return tuple(bounding_box)
+
+
 def render_region_from_custom_atlas(
     output_dir,
     atlas_ids,
@@ -64,13 +100,14 @@ def render_region_from_custom_atlas(
     smoothing_threshold=0.4,
     sigma=10,
     voxel_size=10,
+    mesh_format="obj",
 ):
 
     all_regions = get_arbitrary_structure_mask_from_custom_atlas(
         atlas_ids, atlas_path, sigma, smoothing_threshold
     )
 
-    output_path = f"{output_dir}{structure_name}.obj"
+    output_path = f"{output_dir}{structure_name}.{mesh_format}"
     oriented_binary = reorient_image(
         all_regions, invert_axes=[2], orientation="coronal"
     )
@@ -82,8 +119,7 @@ def render_region_from_custom_atlas(
     if voxel_size != 1:
         verts = verts * voxel_size
 
-    faces = faces + 1
-    marching_cubes_to_obj((verts, faces, normals, values), output_path)
+    save_mesh(verts, faces, normals, output_path, mesh_format=mesh_format)
 
 
 def volume_to_vector_array_to_obj_file(
@@ -95,8 +131,64 @@ def volume_to_vector_array_to_obj_file(
     step_size=1,
     threshold=0,
     deal_with_regions_separately=False,
+    bounding_box=None,
+    mesh_format=None,
+    target_faces=None,
+    max_error=None,
+    smoothing_iterations=0,
+    levels_of_detail=None,
 ):
-
+    """
+    Reorients an image, and saves the surface of the (thresholded) image as
+    a mesh file (.obj by default)
+    :param bounding_box: Bounding box (tuple of slices) of the voxels above
+    the threshold, in the orientation of the image, if already known. Only
+    this region of the image is then read (e.g. from a ChunkedLabels store).
+    :param mesh_format: Format of the mesh file (see
+    neuro.visualise.surfaces.MESH_FORMATS). If None, the format is given by
+    the extension of output_path.
+    :param target_faces: See simplify_mesh
+    :param max_error: See simplify_mesh
+    :param smoothing_iterations: See simplify_mesh
+    :param levels_of_detail: See save_levels_of_detail
+    """
+    offset = None
+    if bounding_box is not None:
+        # padded, and aligned to the marching cubes grid, in the orientation
+        # of the atlas
+        full_image = tuple(slice(0, size) for size in image.shape)
+        oriented_shape = [
+            axis.stop
+            for axis in reorient_bounding_box(
+                full_image,
+                image.shape,
+                invert_axes=invert_axes,
+                orientation=orientation,
+            )
+        ]
+        bounding_box = pad_bounding_box(
+            reorient_bounding_box(
+                bounding_box,
+                image.shape,
+                invert_axes=invert_axes,
+                orientation=orientation,
+            ),
+            oriented_shape,
+            padding=step_size,
+            step_size=step_size,
+        )
+        offset = [axis.start for axis in bounding_box]
+        image = np.asarray(
+            image[
+                reorient_bounding_box(
+                    bounding_box,
+                    oriented_shape,
+                    invert_axes=invert_axes,
+                    orientation=orientation,
+                    inverse=True,
+                )
+            ]
+        )
     oriented_binary = reorient_image(
         image, invert_axes=invert_axes, orientation=orientation
     )
@@ -114,6 +206,12 @@ def volume_to_vector_array_to_obj_file(
                     voxel_size=voxel_size,
                     threshold=threshold,
                     step_size=step_size,
+                    offset=offset,
+                    mesh_format=mesh_format,
+                    target_faces=target_faces,
+                    max_error=max_error,
+                    smoothing_iterations=smoothing_iterations,
+                    levels_of_detail=levels_of_detail,
                 )
     else:
         extract_and_save_object(
@@ -122,20 +220,336 @@ def volume_to_vector_array_to_obj_file(
             voxel_size=voxel_size,
             threshold=threshold,
             step_size=step_size,
+            offset=offset,
+            mesh_format=mesh_format,
+            target_faces=target_faces,
+            max_error=max_error,
+            smoothing_iterations=smoothing_iterations,
+            levels_of_detail=levels_of_detail,
         )
 
 
 def extract_and_save_object(
-    image, output_file_name, voxel_size=10, threshold=0, step_size=1
+    image,
+    output_file_name,
+    voxel_size=10,
+    threshold=0,
+    step_size=1,
+    offset=None,
+    mesh_format=None,
+    target_faces=None,
+    max_error=None,
+    smoothing_iterations=0,
+    levels_of_detail=None,
 ):
+    """
+    Saves the surface of the (thresholded) image as a mesh file. Marching
+    cubes is only run on the bounding box of the voxels above the threshold
+    (padded, so that the surface is closed as for the whole image), and the
+    vertices are then offset back, so the result is the same as for the
+    whole image.
+    :param offset: If the image is a crop (aligned to the step size) of a
+    larger image, the start of the crop along each axis
+    :param mesh_format: Format of the mesh file (see
+    neuro.visualise.surfaces.MESH_FORMATS). If None, the format is given by
+    the extension of output_file_name.
+    :param target_faces: See simplify_mesh
+    :param max_error: See simplify_mesh
+    :param smoothing_iterations: See simplify_mesh
+    :param levels_of_detail: See save_levels_of_detail
+    """
+    bounding_box = get_bounding_box(image > threshold)
+    if bounding_box is not None:
+        bounding_box = pad_bounding_box(
+            bounding_box, image.shape, padding=step_size, step_size=step_size
+        )
+        image = image[bounding_box]
+        crop_offset = [axis.start for axis in bounding_box]
+        if offset is None:
+            offset = crop_offset
+        else:
+            offset = np.add(offset, crop_offset)
+
     verts, faces, normals, values = measure.marching_cubes_lewiner(
         image, threshold, step_size=step_size
     )
-    verts, faces = convert_obj_to_br(verts, faces, voxel_size=voxel_size)
-    marching_cubes_to_obj(
-        (verts, faces, normals, values), str(output_file_name)
+    if offset is not None:
+        verts = verts + np.array(offset, dtype=verts.dtype)
+    if voxel_size != 1:
+        verts = verts * voxel_size
+
+    if (
+        target_faces is not None
+        or max_error is not None
+        or smoothing_iterations > 0
+    ):
+        verts, faces, normals = simplify_mesh(
+            verts,
+            faces,
+            target_faces=target_faces,
+            max_error=max_error,
+            smoothing_iterations=smoothing_iterations,
+        )
+    if levels_of_detail:
+        save_levels_of_detail(
+            verts,
+            faces,
+            normals,
+            output_file_name,
+            levels_of_detail,
+            mesh_format=mesh_format,
+        )
+    else:
+        save_mesh(
+            verts, faces, normals, output_file_name, mesh_format=mesh_format
+        )
+
+
+def mesh_to_polydata(verts, faces):
+    """
+    Converts a triangle mesh to a vtkPolyData
+    :param verts: Vertex coordinates (N x 3)
+    :param faces: Vertex indices of each triangle (M x 3), starting at 0
+    :return: vtkPolyData
+    """
+    points = vtk.vtkPoints()
+    points.SetData(
+        numpy_to_vtk(np.asarray(verts, dtype=np.float32), deep=True)
+    )
+    # each cell is stored as the number of points, followed by their indices
+    faces = np.asarray(faces)
+    cells = np.empty((len(faces), 4), dtype=np.int64)
+    cells[:, 0] = 3
+    cells[:, 1:] = faces
+    polys = vtk.vtkCellArray()
+    polys.SetCells(
+        len(faces), numpy_to_vtkIdTypeArray(cells.ravel(), deep=True)
     )
 
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetPolys(polys)
+    return polydata
+
+
+def polydata_to_mesh(polydata):
+    """
+    Converts a vtkPolyData (of triangles) to a triangle mesh
+    :param polydata: vtkPolyData
+    :return: Tuple of the vertex coordinates (N x 3), the vertex indices of
+    each triangle (M x 3, starting at 0) and the normal of each vertex (N x 3)
+    """
+    normals_filter = vtk.vtkPolyDataNormals()
+    normals_filter.SetInputData(polydata)
+    normals_filter.ComputePointNormalsOn()
+    normals_filter.ComputeCellNormalsOff()
+    # keep the vertices shared between triangles
+    normals_filter.SplittingOff()
+    normals_filter.Update()
+    polydata = normals_filter.GetOutput()
+
+    if polydata.GetNumberOfPoints() == 0:
+        return (
+            np.zeros((0, 3), dtype=np.float32),
+            np.zeros((0, 3), dtype=np.int64),
+            np.zeros((0, 3), dtype=np.float32),
+        )
+    verts = vtk_to_numpy(polydata.GetPoints().GetData())
+    faces = vtk_to_numpy(polydata.GetPolys().GetData()).reshape(-1, 4)
+    normals = vtk_to_numpy(polydata.GetPointData().GetNormals())
+    return verts, faces[:, 1:].astype(np.int64), normals
+
+
+def simplify_mesh(
+    verts,
+    faces,
+    target_faces=None,
+    max_error=None,
+    smoothing_iterations=0,
+    relaxation_factor=0.1,
+):
+    """
+    Decimates and/or smooths a triangle mesh (e.g. from marching cubes), so
+    that it is faster to render
+    :param verts: Vertex coordinates (N x 3)
+    :param faces: Vertex indices of each triangle (M x 3), starting at 0
+    :param target_faces: Number of triangles to decimate the mesh to (by
+    quadric decimation). If None, the mesh is only decimated if max_error is
+    given.
+    :param max_error: Maximum distance (in the units of verts) of the
+    vertices of the original mesh from the decimated mesh. If given, the
+    mesh is decimated as far as possible (but to no fewer than target_faces
+    triangles) within this error.
+    :param smoothing_iterations: Number of iterations of Laplacian smoothing
+    (after any decimation). If 0, the mesh is not smoothed.
+    :param relaxation_factor: Laplacian smoothing relaxation factor
+    :return: Tuple of the vertex coordinates (N x 3), the vertex indices of
+    each triangle (M x 3, starting at 0) and the normal of each vertex (N x 3)
+    """
+    # marching cubes can duplicate vertices, and edges can only be collapsed
+    # (when decimating) between shared vertices
+    clean = vtk.vtkCleanPolyData()
+    clean.SetInputData(mesh_to_polydata(verts, faces))
+    clean.Update()
+    polydata = clean.GetOutput()
+    n_faces = polydata.GetNumberOfPolys()
+
+    if target_faces is None:
+        target_reduction = 1
+    else:
+        target_reduction = get_target_reduction(n_faces, target_faces)
+
+    if n_faces == 0:
+        pass
+    elif max_error is not None:
+        polydata = decimate_to_error(polydata, max_error, target_reduction)
+    elif target_faces is not None:
+        polydata = quadric_decimation(polydata, target_reduction)
+
+    if smoothing_iterations > 0:
+        smooth = vtk.vtkSmoothPolyDataFilter()
+        smooth.SetInputData(polydata)
+        smooth.SetNumberOfIterations(smoothing_iterations)
+        smooth.SetRelaxationFactor(relaxation_factor)
+        smooth.FeatureEdgeSmoothingOff()
+        smooth.BoundarySmoothingOn()
+        smooth.Update()
+        polydata = smooth.GetOutput()
+
+    return polydata_to_mesh(polydata)
+
+
+def quadric_decimation(polydata, target_reduction):
+    """
+    Decimates a mesh by quadric edge collapse
+    :param polydata: vtkPolyData
+    :param target_reduction: Fraction (from 0 to 1) of triangles to remove
+    :return: vtkPolyData
+    """
+    decimate = vtk.vtkQuadricDecimation()
+    decimate.SetInputData(polydata)
+    decimate.SetTargetReduction(target_reduction)
+    decimate.Update()
+    return decimate.GetOutput()
+
+
+def get_decimation_error(polydata, decimated):
+    """
+    Finds how far a decimated mesh is from the original
+    :param polydata: Original mesh (vtkPolyData)
+    :param decimated: Decimated mesh (vtkPolyData)
+    :return: Maximum distance of the original vertices from the decimated
+    mesh
+    """
+    if decimated.GetNumberOfPolys() == 0:
+        return np.inf
+    distance = vtk.vtkDistancePolyDataFilter()
+    distance.SetInputData(0, polydata)
+    distance.SetInputData(1, decimated)
+    distance.SignedDistanceOff()
+    distance.ComputeSecondDistanceOff()
+    distance.Update()
+    return vtk_to_numpy(
+        distance.GetOutput().GetPointData().GetArray("Distance")
+    ).max()
+
+
+def decimate_to_error(
+    polydata, max_error, max_reduction=1, n_steps=MAX_ERROR_SEARCH_STEPS
+):
+    """
+    Decimates a mesh (by quadric decimation) as far as possible, within an
+    error. The reduction is found by bisection (assuming that the error
+    increases with the reduction).
+    :param polydata: vtkPolyData
+    :param max_error: Maximum distance (see get_decimation_error)
+    :param max_reduction: Maximum fraction of triangles to remove
+    :param n_steps: Number of bisection steps
+    :return: vtkPolyData
+    """
+    decimated = quadric_decimation(polydata, max_reduction)
+    if get_decimation_error(polydata, decimated) <= max_error:
+        return decimated
+
+    best = polydata
+    low, high = 0, max_reduction
+    for _ in range(n_steps):
+        reduction = (low + high) / 2
+        decimated = quadric_decimation(polydata, reduction)
+        if get_decimation_error(polydata, decimated) <= max_error:
+            best = decimated
+            low = reduction
+        else:
+            high = reduction
+    return best
+
+
+def get_target_reduction(n_faces, target_faces):
+    """
+    Finds the fraction of triangles to remove, to decimate a mesh
+    :param n_faces: Number of triangles in the mesh
+    :param target_faces: Number of triangles to decimate the mesh to
+    :return: Fraction (from 0 to 1) of triangles to remove
+    """
+    if n_faces == 0:
+        return 0
+    return min(max(1 - target_faces / n_faces, 0), 1)
+
+
+def get_level_of_detail_path(mesh_file, level):
+    """
+    Finds the path of a mesh, at a level of detail saved by
+    save_levels_of_detail. Coarser levels are saved in subdirectories (e.g.
+    "lod1/region.obj"), so that only the full meshes are found when a
+    directory of regions is loaded.
+    :param mesh_file: Path of the full mesh (level 0)
+    :param level: Level of detail (0 for the full mesh)
+    :return: Path of the mesh at that level of detail
+    """
+    mesh_file = Path(mesh_file)
+    if level == 0:
+        return mesh_file
+    return mesh_file.parent / f"lod{level}" / mesh_file.name
+
+
+def save_levels_of_detail(
+    verts,
+    faces,
+    normals,
+    output_file_name,
+    levels_of_detail,
+    mesh_format=None,
+):
+    """
+    Saves a mesh at several levels of detail (see get_level_of_detail_path).
+    The full mesh is saved to output_file_name (level 0), and each coarser
+    level is decimated from the full mesh.
+    :param verts: Vertex coordinates (N x 3)
+    :param faces: Vertex indices of each triangle (M x 3), starting at 0
+    :param normals: Normal of each vertex (N x 3)
+    :param output_file_name: Path to save the full mesh to
+    :param levels_of_detail: Fraction of the (non-degenerate) triangles of
+    the full mesh to keep at each coarser level, e.g. (0.25, 0.05) for
+    levels 1 and 2
+    :param mesh_format: Format of the mesh files (see
+    neuro.visualise.surfaces.MESH_FORMATS). If None, the format is given by
+    the extension of output_file_name.
+    """
+    save_mesh(verts, faces, normals, output_file_name, mesh_format=mesh_format)
+
+    # without any (e.g. marching cubes) degenerate triangles
+    n_faces = len(simplify_mesh(verts, faces)[1])
+    for level, fraction in enumerate(levels_of_detail, start=1):
+        level_file = get_level_of_detail_path(output_file_name, level)
+        ensure_directory_exists(level_file.parent)
+        save_mesh(
+            *simplify_mesh(
+                verts, faces, target_faces=int(round(fraction * n_faces))
+            ),
+            level_file,
+            mesh_format=mesh_format,
+        )
+
 
 def convert_obj_to_br(verts, faces, voxel_size=10):
     if voxel_size != 1:
@@ -147,9 +561,9 @@ def convert_obj_to_br(verts, faces, voxel_size=10):
 
 def visualize_obj(obj_path, *args, color="lightcoral", **kwargs):
     """
-        Uses brainrender to visualize a .obj file registered to the Allen CCF
-        :param obj_path: str, path to a .obj file
-        :param color: str, color of object being rendered
+    Uses brainrender to visualize a .obj file registered to the Allen CCF
+    :param obj_path: str, path to a .obj file
+    :param color: str, color of object being rendered
     """
     print("Visualizing : " + obj_path)
     scene = Scene(add_root=True)
@@ -159,18 +573,24 @@ def visualize_obj(obj_path, *args, color="lightcoral", **kwargs):
 
 
 def load_regions_into_brainrender(
-    scene, list_of_regions, alpha=0.8, shading="flat"
+    scene, list_of_regions, alpha=0.8, shading="flat", level_of_detail=0
 ):
     """
-    Loads a list of .obj files into brainrender
+    Loads a list of mesh files (e.g. .obj) into brainrender
     :param scene: brainrender scene
-    :param list_of_regions: List of .obj files to be loaded
+    :param list_of_regions: List of mesh files to be loaded
     :param alpha: Object transparency
     :param shading: Object shading type ("flat", "giroud" or "phong").
     Defaults to "phong"
+    :param level_of_detail: Level of detail of the meshes to load (see
+    save_levels_of_detail), e.g. a coarse level for overview scenes. If a
+    region wasn't saved at this level, the full mesh is loaded.
     """
     # scene = Scene()
     for obj_file in list_of_regions:
+        level_file = get_level_of_detail_path(obj_file, level_of_detail)
+        if level_file.exists():
+            obj_file = level_file
         load_obj_into_brainrender(
             scene, obj_file, alpha=alpha, shading=shading
         )
@@ -182,9 +602,10 @@ def load_obj_into_brainrender(
     scene, obj_file, color=None, alpha=0.8, shading="phong"
 ):
     """
-    Loads a single obj file into brainrender
+    Loads a single mesh file into brainrender
     :param scene: brainrender scene
-    :param obj_file: obj filepath
+    :param obj_file: Mesh filepath (.obj, or any of
+    neuro.visualise.surfaces.MESH_FORMATS)
     :param color: Object color. If None, a random color is chosen
     :param alpha: Object transparency
     :param shading: Object shading type ("flat", "giroud" or "phong").
@@ -193,7 +614,14 @@ def load_obj_into_brainrender(
     obj_file = str(obj_file)
     if color is None:
         color = get_random_vtkplotter_color()
-    act = scene.add_from_file(obj_file, c=color, alpha=alpha)
+    mesh_format = Path(obj_file).suffix.lstrip(".").lower()
+    if mesh_format in MESH_FORMATS and mesh_format != "obj":
+        # binary formats are read directly into arrays
+        verts, faces, _ = read_mesh(obj_file, mesh_format=mesh_format)
+        act = Mesh([verts, faces], c=color, alpha=alpha)
+        scene.add_vtkactor(act)
+    else:
+        act = scene.add_from_file(obj_file, c=color, alpha=alpha)
 
     if shading == "flat":
         act.GetProperty().SetInterpolationToFlat()
@@ -8,12 +8,14 @@ from neuro.segmentation.manual_segmentation.man_seg_tools import (
     convert_and_save_points,
 )
 from neuro.segmentation.manual_segmentation.man_seg_tools import (
-    save_regions_to_file,
-    analyse_region_brain_areas,
+    analyse_brain_regions,
     summarise_brain_regions,
     analyse_track,
     analyse_track_anatomy,
 )
+from neuro.atlas_tools.array import get_bounding_box
+from neuro.heatmap.incremental import update_heatmap
+from neuro.segmentation.manual_segmentation.save import save_regions
 from neuro.structures.structures_tree import (
     atlas_value_to_name,
     UnknownAtlasValue,
@@ -99,28 +101,38 @@ def region_analysis(
     volumes=True,
     summarise=True,
 ):
+    summarise = summarise and output_csv_file is not None
     if volumes:
         print("Calculating region volume distribution")
         annotations = load_any(annotations_path)
         hemispheres = load_any(hemispheres_path)
 
         print(f"Saving summary volumes to: {regions_directory}")
-        for label_layer in label_layers:
-            analyse_region_brain_areas(
-                label_layer,
-                regions_directory,
-                annotations,
-                hemispheres,
-                structures_df,
-            )
-    if summarise:
-        if output_csv_file is not None:
+        if summarise:
             print("Summarising regions")
-            summarise_brain_regions(label_layers, output_csv_file)
+        # all regions are analysed (and summarised) in a single pass
+        analyse_brain_regions(
+            label_layers,
+            regions_directory,
+            annotations,
+            hemispheres,
+            structures_df,
+            summary_csv_file=output_csv_file if summarise else None,
+        )
+    elif summarise:
+        print("Summarising regions")
+        summarise_brain_regions(label_layers, output_csv_file)
 
     print("Finished!\n")
 
 
+@thread_worker
+def update_cells_heatmap(heatmap_path, cells_file):
+    region = update_heatmap(heatmap_path, cells_file=cells_file)
+    if region is not None:
+        print(f"Updated heatmap: {heatmap_path}")
+
+
 @thread_worker
 def save_all(
     viewer,
@@ -133,8 +145,26 @@ def save_all(
     y_scaling,
     z_scaling,
     track_file_extension=".h5",
+    change_tracker=None,
+    mesh_format="obj",
+    levels_of_detail=None,
 ):
-    save_label_layers(regions_directory, label_layers, image_like)
+    if change_tracker is not None:
+        # only save the layers that have changed since they were last saved
+        label_layers = change_tracker.get_changed(label_layers)
+        points_layers = change_tracker.get_changed(points_layers)
+        if not label_layers and not points_layers:
+            return
+
+    # progress messages are yielded to the GUI as each region is saved
+    yield from save_label_layers(
+        regions_directory,
+        label_layers,
+        image_like,
+        change_tracker=change_tracker,
+        mesh_format=mesh_format,
+        levels_of_detail=levels_of_detail,
+    )
     save_track_layers(
         viewer,
         tracks_directory,
@@ -144,17 +174,62 @@ def save_all(
         z_scaling,
         track_file_extension=track_file_extension,
     )
+    if change_tracker is not None:
+        change_tracker.mark_saved(points_layers)
     print("Finished!\n")
 
 
 def save_label_layers(
-    regions_directory, label_layers, image_like,
+    regions_directory,
+    label_layers,
+    image_like,
+    n_workers=None,
+    change_tracker=None,
+    mesh_format="obj",
+    levels_of_detail=None,
 ):
+    """
+    Saves the regions in parallel, yielding a progress message as each
+    region is saved. If a LayerChangeTracker is given, each region is marked
+    as saved once it has been saved.
+    """
     print(f"Saving regions to: {regions_directory}")
     ensure_directory_exists(regions_directory)
-    for label_layer in label_layers:
-        save_regions_to_file(
-            label_layer, regions_directory, image_like,
+    unsaved_layers = {layer.name: layer for layer in label_layers}
+    n_saved = 0
+    for result in save_regions(
+        label_layers,
+        regions_directory,
+        image_like,
+        n_workers=n_workers,
+        mesh_format=mesh_format,
+        levels_of_detail=levels_of_detail,
+    ):
+        n_saved += 1
+        if result["status"] == "success":
+            message = (
+                f"Saved region {n_saved}: {result['region']} "
+                f"({result['time_s']:.1f}s)"
+            )
+            layer = unsaved_layers.pop(result["region"])
+            if change_tracker is not None:
+                change_tracker.mark_saved([layer])
+        else:
+            message = (
+                f"Failed to save region: {result['region']}. "
+                f"{result['error']}"
+            )
+        print(message)
+        yield message
+
+    if change_tracker is not None:
+        # empty regions aren't saved
+        change_tracker.mark_saved(
+            [
+                layer
+                for layer in unsaved_layers.values()
+                if get_bounding_box(layer.data) is None
+            ]
         )
 
 
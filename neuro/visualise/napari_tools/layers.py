@@ -7,6 +7,9 @@ from vispy.color import Colormap
 from brainio import brainio
 from imlib.general.system import get_sorted_file_paths
 
+from neuro.segmentation.manual_segmentation.chunked_labels import (
+    ChunkedLabels,
+)
 from neuro.visualise.vis_tools import (
     get_image_scales,
     get_most_recent_log,
@@ -178,7 +181,8 @@ def add_new_label_layer(
 ):
     """
     Takes an existing napari viewer, and adds a blank label layer
-    (same shape as base_image)
+    (same shape as base_image). The labels are stored as uint8 chunks, which
+    are only allocated when painted.
     :param viewer: Napari viewer instance
     :param np.array base_image: Underlying image (for the labels to be
     referencing)
@@ -188,7 +192,7 @@ def add_new_label_layer(
     :param int brush_size: Default size of the label brush
     :return label_layer: napari labels layer
     """
-    labels = np.empty_like(base_image)
+    labels = ChunkedLabels(base_image.shape)
     label_layer = viewer.add_labels(labels, num_colors=num_colors, name=name)
     label_layer.selected_label = selected_label
     label_layer.brush_size = brush_size
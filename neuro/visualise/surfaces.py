@@ -0,0 +1,504 @@
+"""
+Saves surfaces (e.g. the output of skimage.measure.marching_cubes) as mesh
+files, and reads them back. ASCII .obj files are written a block of rows at
+a time (rather than line by line). Binary .ply, .stl and .glb (glTF) files
+are smaller, and faster to write and read.
+"""
+
+import json
+import struct
+
+from pathlib import Path
+
+import numpy as np
+
+# rows formatted (and written) at once
+BLOCK_SIZE = 100000
+WRITE_BUFFER_SIZE = 2 ** 22
+
+
+def format_values(values):
+    """
+    Converts an array of numbers to strings, as f"{value}" would for each
+    value (i.e. the shortest repr of the value as a python float or int).
+    Each unique float is only formatted once (marching cubes meshes only have
+    a few distinct coordinates and normals).
+    :param values: Array of numbers
+    :return: List of strings (of the flattened array)
+    """
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        return values.ravel().tolist()
+
+    values = np.ascontiguousarray(values, dtype=np.float64).ravel()
+    # unique bit patterns, so that e.g. -0.0 and 0.0 are formatted separately
+    unique_bits, inverse = np.unique(
+        values.view(np.int64), return_inverse=True
+    )
+    strings = np.array(
+        [repr(value) for value in unique_bits.view(np.float64).tolist()],
+        dtype=object,
+    )
+    return strings[inverse.ravel()].tolist()
+
+
+def write_lines(f, line_format, values, block_size=BLOCK_SIZE):
+    """
+    Writes one line per row of an array
+    :param f: File object
+    :param line_format: Format of a single line, with a "%s" for each value
+    in the row
+    :param values: 2D array
+    :param block_size: Number of rows formatted at once
+    """
+    for start in range(0, len(values), block_size):
+        block = values[start : start + block_size]
+        f.write((line_format * len(block)) % tuple(format_values(block)))
+
+
+def marching_cubes_to_obj(marching_cubes_out, output_file):
+    """
+    Saves the output of skimage.measure.marching_cubes as an .obj file
+    :param marching_cubes_out: tuple
+    :param output_file: str
+    """
+
+    verts, faces, normals, _ = marching_cubes_out
+    with open(output_file, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        write_lines(f, "v %s %s %s\n", np.asarray(verts))
+        write_lines(f, "vn %s %s %s\n", np.asarray(normals))
+        # each face is written as vertex//normal indices
+        write_lines(
+            f,
+            "f %s//%s %s//%s %s//%s\n",
+            np.repeat(np.asarray(faces), 2, axis=1),
+        )
+
+
+MESH_FORMATS = ("obj", "ply", "stl", "glb")
+
+PLY_TYPES = {
+    "char": "i1",
+    "uchar": "u1",
+    "short": "<i2",
+    "ushort": "<u2",
+    "int": "<i4",
+    "uint": "<u4",
+    "float": "<f4",
+    "double": "<f8",
+    "int8": "i1",
+    "uint8": "u1",
+    "int16": "<i2",
+    "uint16": "<u2",
+    "int32": "<i4",
+    "uint32": "<u4",
+    "float32": "<f4",
+    "float64": "<f8",
+}
+
+STL_HEADER_SIZE = 80
+STL_TRIANGLE = np.dtype(
+    [
+        ("normal", "<f4", (3,)),
+        ("vertices", "<f4", (3, 3)),
+        ("attribute", "<u2"),
+    ]
+)
+
+GLB_MAGIC = b"glTF"
+GLB_VERSION = 2
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+GLTF_TRIANGLES = 4
+GLTF_ARRAY_BUFFER = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+GLTF_COMPONENT_TYPES = {
+    5121: np.dtype("u1"),
+    5123: np.dtype("<u2"),
+    5125: np.dtype("<u4"),
+    5126: np.dtype("<f4"),
+}
+GLTF_TYPE_SIZES = {"SCALAR": 1, "VEC3": 3}
+
+
+def get_mesh_format(mesh_file, mesh_format=None):
+    """
+    Finds the format of a mesh file
+    :param mesh_file: Path to the mesh file
+    :param mesh_format: Format of the file (one of MESH_FORMATS). If None,
+    the format is given by the file extension, otherwise it must match the
+    file extension (if there is one).
+    :return: Mesh format (one of MESH_FORMATS)
+    """
+    extension = Path(mesh_file).suffix.lstrip(".").lower()
+    if mesh_format is None:
+        mesh_format = extension
+    mesh_format = mesh_format.lower()
+    if extension and extension != mesh_format:
+        raise ValueError(
+            f"Mesh format: '{mesh_format}' does not match the extension of "
+            f"the mesh file: '{mesh_file}'"
+        )
+    if mesh_format not in MESH_FORMATS:
+        raise ValueError(
+            f"Unrecognised mesh format: '{mesh_format}'. "
+            f"Supported formats are: {', '.join(MESH_FORMATS)}"
+        )
+    return mesh_format
+
+
+def save_mesh(verts, faces, normals, output_file, mesh_format=None):
+    """
+    Saves a triangle mesh (e.g. from skimage.measure.marching_cubes)
+    :param verts: Vertex coordinates (N x 3)
+    :param faces: Vertex indices of each triangle (M x 3), starting at 0
+    :param normals: Normal of each vertex (N x 3)
+    :param output_file: Path to save the mesh to
+    :param mesh_format: Format of the file (one of MESH_FORMATS). If None,
+    the format is given by the file extension.
+    """
+    mesh_format = get_mesh_format(output_file, mesh_format)
+    MESH_WRITERS[mesh_format](
+        np.asarray(verts),
+        np.asarray(faces),
+        np.asarray(normals),
+        str(output_file),
+    )
+
+
+def read_mesh(input_file, mesh_format=None):
+    """
+    Reads a triangle mesh saved by save_mesh
+    :param input_file: Path to the mesh file
+    :param mesh_format: Format of the file (one of MESH_FORMATS). If None,
+    the format is given by the file extension.
+    :return: Tuple of the vertex coordinates (N x 3), the vertex indices of
+    each triangle (M x 3, starting at 0) and the normal of each vertex (N x 3)
+    """
+    mesh_format = get_mesh_format(input_file, mesh_format)
+    return MESH_READERS[mesh_format](str(input_file))
+
+
+def get_vertex_normals(verts, faces):
+    """
+    Estimates the normal of each vertex (for formats that don't store them),
+    as the area weighted mean of the normals of the triangles it is part of
+    :param verts: Vertex coordinates (N x 3)
+    :param faces: Vertex indices of each triangle (M x 3), starting at 0
+    :return: Normal of each vertex (N x 3)
+    """
+    verts = np.asarray(verts, dtype=np.float64)
+    triangles = verts[faces]
+    face_normals = np.cross(
+        triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+    )
+    normals = np.zeros_like(verts)
+    for corner in range(3):
+        np.add.at(normals, faces[:, corner], face_normals)
+    return _normalise(normals).astype(np.float32)
+
+
+def _normalise(vectors):
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(
+        vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0
+    )
+
+
+def write_obj(verts, faces, normals, output_file):
+    marching_cubes_to_obj((verts, faces + 1, normals, None), output_file)
+
+
+def read_obj(input_file):
+    with open(input_file) as f:
+        lines = f.read().splitlines()
+    rows = {"v": [], "vn": [], "f": []}
+    for line in lines:
+        key, _, values = line.partition(" ")
+        if key in rows:
+            rows[key].append(values)
+
+    verts = np.array(" ".join(rows["v"]).split(), dtype=np.float64)
+    normals = np.array(" ".join(rows["vn"]).split(), dtype=np.float64)
+    # faces are written as vertex/texture/normal indices
+    faces = np.array(
+        [index.partition("/")[0] for index in " ".join(rows["f"]).split()],
+        dtype=np.int64,
+    )
+    verts = verts.reshape(-1, 3)
+    faces = faces.reshape(-1, 3) - 1
+    if normals.size:
+        normals = normals.reshape(-1, 3)
+    else:
+        normals = get_vertex_normals(verts, faces)
+    return verts, faces, normals
+
+
+def write_ply(verts, faces, normals, output_file):
+    vertex_data = np.empty(
+        len(verts),
+        dtype=[(name, "<f4") for name in ("x", "y", "z", "nx", "ny", "nz")],
+    )
+    for axis, name in enumerate("xyz"):
+        vertex_data[name] = verts[:, axis]
+        vertex_data["n" + name] = normals[:, axis]
+    face_data = np.empty(
+        len(faces), dtype=[("count", "u1"), ("indices", "<i4", (3,))]
+    )
+    face_data["count"] = 3
+    face_data["indices"] = faces
+
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {len(verts)}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        "property float nx\n"
+        "property float ny\n"
+        "property float nz\n"
+        f"element face {len(faces)}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    )
+    with open(output_file, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(vertex_data.tobytes())
+        f.write(face_data.tobytes())
+
+
+def read_ply(input_file):
+    with open(input_file, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"{input_file} is not a PLY file")
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{input_file} has no PLY end_header")
+            tokens = line.decode("ascii").split()
+            if not tokens or tokens[0] in ("comment", "obj_info"):
+                continue
+            if tokens[0] == "end_header":
+                break
+            if tokens[0] == "format" and tokens[1] != "binary_little_endian":
+                raise ValueError(
+                    f"Only binary little endian PLY files can be read, "
+                    f"not {tokens[1]}"
+                )
+            if tokens[0] == "element":
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == "property":
+                if tokens[1] == "list":
+                    # triangles, i.e. a count followed by three indices
+                    elements[-1][2].append(("count", PLY_TYPES[tokens[2]]))
+                    elements[-1][2].append(
+                        (tokens[4], PLY_TYPES[tokens[3]], (3,))
+                    )
+                else:
+                    elements[-1][2].append((tokens[2], PLY_TYPES[tokens[1]]))
+        data = {}
+        for name, count, properties in elements:
+            dtype = np.dtype(properties)
+            data[name] = np.frombuffer(
+                f.read(dtype.itemsize * count), dtype=dtype, count=count
+            )
+
+    vertex_data = data["vertex"]
+    face_data = data["face"]
+    if not np.all(face_data["count"] == 3):
+        raise ValueError("Only triangle meshes can be read")
+    verts = np.stack([vertex_data[name] for name in "xyz"], axis=1)
+    faces = face_data[face_data.dtype.names[1]].astype(np.int64)
+    if "nx" in vertex_data.dtype.names:
+        normals = np.stack([vertex_data["n" + name] for name in "xyz"], axis=1)
+    else:
+        normals = get_vertex_normals(verts, faces)
+    return verts, faces, normals
+
+
+def write_stl(verts, faces, _, output_file):
+    # STL only stores the normal of each triangle
+    triangles = np.zeros(len(faces), dtype=STL_TRIANGLE)
+    triangles["vertices"] = verts[faces]
+    vertices = triangles["vertices"].astype(np.float64)
+    triangles["normal"] = _normalise(
+        np.cross(
+            vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0]
+        )
+    )
+    with open(output_file, "wb") as f:
+        f.write(b"neuro".ljust(STL_HEADER_SIZE, b" "))
+        f.write(struct.pack("<I", len(faces)))
+        f.write(triangles.tobytes())
+
+
+def read_stl(input_file):
+    with open(input_file, "rb") as f:
+        f.read(STL_HEADER_SIZE)
+        (n_triangles,) = struct.unpack("<I", f.read(4))
+        triangles = np.frombuffer(
+            f.read(STL_TRIANGLE.itemsize * n_triangles),
+            dtype=STL_TRIANGLE,
+            count=n_triangles,
+        )
+    # STL stores the coordinates of each corner of each triangle, so shared
+    # vertices are merged again
+    verts, faces = _merge_vertices(triangles["vertices"].reshape(-1, 3))
+    faces = faces.reshape(-1, 3)
+    return verts, faces, get_vertex_normals(verts, faces)
+
+
+def _merge_vertices(corners):
+    """
+    Finds the unique vertices (as np.unique(..., axis=0), but faster)
+    :param corners: Coordinates (N x 3, float32) of each triangle corner
+    :return: Unique vertex coordinates, and the index of each corner's vertex
+    """
+    corners = np.ascontiguousarray(corners)
+    bits = corners.view(np.uint32)
+    order = np.lexsort((bits[:, 2], bits[:, 1], bits[:, 0]))
+    sorted_bits = bits[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = np.any(sorted_bits[1:] != sorted_bits[:-1], axis=1)
+    indices = np.empty(len(order), dtype=np.int64)
+    indices[order] = np.cumsum(is_new) - 1
+    return corners[order[is_new]], indices
+
+
+def write_glb(verts, faces, normals, output_file):
+    verts = np.ascontiguousarray(verts, dtype="<f4")
+    arrays = [
+        verts,
+        np.ascontiguousarray(normals, dtype="<f4"),
+        np.ascontiguousarray(faces, dtype="<u4"),
+    ]
+    buffer_views = []
+    offset = 0
+    for array, target in zip(
+        arrays,
+        [GLTF_ARRAY_BUFFER, GLTF_ARRAY_BUFFER, GLTF_ELEMENT_ARRAY_BUFFER],
+    ):
+        buffer_views.append(
+            {
+                "buffer": 0,
+                "byteOffset": offset,
+                "byteLength": array.nbytes,
+                "target": target,
+            }
+        )
+        offset += array.nbytes
+
+    position = {
+        "bufferView": 0,
+        "componentType": 5126,
+        "count": len(verts),
+        "type": "VEC3",
+    }
+    if len(verts):
+        position["min"] = verts.min(axis=0).tolist()
+        position["max"] = verts.max(axis=0).tolist()
+    gltf = {
+        "asset": {"version": "2.0", "generator": "neuro"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [
+            {
+                "primitives": [
+                    {
+                        "attributes": {"POSITION": 0, "NORMAL": 1},
+                        "indices": 2,
+                        "mode": GLTF_TRIANGLES,
+                    }
+                ]
+            }
+        ],
+        "buffers": [{"byteLength": offset}],
+        "bufferViews": buffer_views,
+        "accessors": [
+            position,
+            {
+                "bufferView": 1,
+                "componentType": 5126,
+                "count": len(verts),
+                "type": "VEC3",
+            },
+            {
+                "bufferView": 2,
+                "componentType": 5125,
+                "count": faces.size,
+                "type": "SCALAR",
+            },
+        ],
+    }
+
+    # chunks are padded to a multiple of 4 bytes
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk = b"".join(array.tobytes() for array in arrays)
+    bin_chunk += b"\x00" * (-len(bin_chunk) % 4)
+    length = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    with open(output_file, "wb") as f:
+        f.write(GLB_MAGIC + struct.pack("<II", GLB_VERSION, length))
+        f.write(struct.pack("<II", len(json_chunk), GLB_JSON_CHUNK))
+        f.write(json_chunk)
+        f.write(struct.pack("<II", len(bin_chunk), GLB_BIN_CHUNK))
+        f.write(bin_chunk)
+
+
+def read_glb(input_file):
+    with open(input_file, "rb") as f:
+        data = f.read()
+    if data[:4] != GLB_MAGIC:
+        raise ValueError(f"{input_file} is not a GLB file")
+
+    chunks = {}
+    offset = 12
+    while offset < len(data):
+        length, chunk_type = struct.unpack_from("<II", data, offset)
+        chunks[chunk_type] = data[offset + 8 : offset + 8 + length]
+        offset += 8 + length
+    gltf = json.loads(chunks[GLB_JSON_CHUNK].decode("utf-8"))
+    bin_chunk = chunks.get(GLB_BIN_CHUNK, b"")
+
+    def read_accessor(index):
+        accessor = gltf["accessors"][index]
+        buffer_view = gltf["bufferViews"][accessor["bufferView"]]
+        dtype = GLTF_COMPONENT_TYPES[accessor["componentType"]]
+        size = GLTF_TYPE_SIZES[accessor["type"]]
+        array = np.frombuffer(
+            bin_chunk,
+            dtype=dtype,
+            count=accessor["count"] * size,
+            offset=buffer_view.get("byteOffset", 0)
+            + accessor.get("byteOffset", 0),
+        )
+        return array.reshape(-1, size)
+
+    primitive = gltf["meshes"][0]["primitives"][0]
+    if primitive.get("mode", GLTF_TRIANGLES) != GLTF_TRIANGLES:
+        raise ValueError("Only triangle meshes can be read")
+    verts = read_accessor(primitive["attributes"]["POSITION"])
+    faces = read_accessor(primitive["indices"]).reshape(-1, 3)
+    faces = faces.astype(np.int64)
+    if "NORMAL" in primitive["attributes"]:
+        normals = read_accessor(primitive["attributes"]["NORMAL"])
+    else:
+        normals = get_vertex_normals(verts, faces)
+    return verts, faces, normals
+
+
+MESH_WRITERS = {
+    "obj": write_obj,
+    "ply": write_ply,
+    "stl": write_stl,
+    "glb": write_glb,
+}
+MESH_READERS = {
+    "obj": read_obj,
+    "ply": read_ply,
+    "stl": read_stl,
+    "glb": read_glb,
+}
@@ -14,12 +14,18 @@ from qtpy.QtWidgets import (
 from brainio import brainio
 from imlib.source.source_files import get_structures_path
 from imlib.general.system import get_sorted_file_paths
-from imlib.IO.cells import cells_xml_to_df, cells_to_xml
+from imlib.IO.cells import cells_to_xml
 from imlib.cells.cells import Cell
 
-from neuro.structures.IO import load_structures_as_df
+from neuro.cells.IO import load_cell_arrays
+from neuro.heatmap.incremental import has_state
+from neuro.heatmap.ome_zarr import load_ome_zarr
+from neuro.structures.structures_tree import get_structure_lookup
 from neuro.atlas_tools.paths import Paths as registration_paths
-from neuro.visualise.napari_tools.callbacks import display_brain_region_name
+from neuro.visualise.napari_tools.callbacks import (
+    display_brain_region_name,
+    update_cells_heatmap,
+)
 from neuro.visualise.napari_tools.layers import (
     prepare_load_nii,
     display_registration,
@@ -138,7 +144,10 @@ class ViewerWidget(QWidget):
             self.load_raw_data_single_button.setVisible(True)
             self.load_cells_button.setVisible(True)
 
-            if self.heatmap_path.exists():
+            if (
+                self.heatmap_path.exists()
+                or self.heatmap_zarr_path.exists()
+            ):
                 self.load_heatmap_button.setVisible(True)
 
             self.image_scales = self.get_registration_scaling()
@@ -189,6 +198,7 @@ class ViewerWidget(QWidget):
         )
         self.figures_directory = self.cellfinder_directory / "figures"
         self.heatmap_path = self.figures_directory / "heatmap.nii"
+        self.heatmap_zarr_path = self.figures_directory / "heatmap.zarr"
 
         self.initialise_registration_paths()
 
@@ -272,12 +282,12 @@ class ViewerWidget(QWidget):
             self.image_scales,
             memory=memory,
         )
-        self.structures_df = load_structures_as_df(get_structures_path())
+        self.structures = get_structure_lookup(get_structures_path())
         self.status_label.setText("Ready")
 
         @self.region_labels.mouse_move_callbacks.append
         def display_region_name(layer, event):
-            display_brain_region_name(layer, self.structures_df)
+            display_brain_region_name(layer, self.structures)
 
     def load_downsampled_data(self,):
         self.status_label.setText("Loading...")
@@ -322,11 +332,22 @@ class ViewerWidget(QWidget):
 
     def load_heatmap(self):
         self.status_label.setText("Loading...")
-        self.viewer.add_image(
-            prepare_load_nii(self.heatmap_path, memory=memory,),
-            scale=self.image_scales,
-            name="Heatmap",
-        )
+        if self.heatmap_zarr_path.exists():
+            # multiscale, so only the displayed resolution is loaded
+            heatmap = load_ome_zarr(self.heatmap_zarr_path)
+            scale = self.image_scales
+            if heatmap[0].ndim == 4 and scale is not None:
+                # one channel per cell type (or group)
+                scale = (1,) + tuple(scale)
+            self.viewer.add_image(
+                heatmap, multiscale=True, scale=scale, name="Heatmap",
+            )
+        else:
+            self.viewer.add_image(
+                prepare_load_nii(self.heatmap_path, memory=memory,),
+                scale=self.image_scales,
+                name="Heatmap",
+            )
         self.status_label.setText("Ready")
 
     def load_cells(self):
@@ -360,6 +381,20 @@ class ViewerWidget(QWidget):
             self.non_cell_layer.data,
             str(self.classified_cells),
         )
+        if has_state(self.heatmap_path):
+            # updated in the background, so the viewer doesn't freeze
+            self.status_label.setText("Updating heatmap...")
+            self.save_cells_button.setEnabled(False)
+            worker = update_cells_heatmap(
+                self.heatmap_path, str(self.classified_cells)
+            )
+            worker.finished.connect(self.finish_updating_heatmap)
+            worker.start()
+        else:
+            self.status_label.setText("Ready")
+
+    def finish_updating_heatmap(self):
+        self.save_cells_button.setEnabled(True)
         self.status_label.setText("Ready")
 
 
@@ -387,13 +422,12 @@ def cells_df_as_np(cells_df, new_order=[2, 1, 0], type_column="type"):
 
 
 def get_cell_arrays(cells_file):
-    df = cells_xml_to_df(cells_file)
-
-    non_cells = df[df["type"] == Cell.UNKNOWN]
-    cells = df[df["type"] == Cell.CELL]
+    positions, types = load_cell_arrays(cells_file)
+    # napari order (z, y, x)
+    positions = positions[:, ::-1]
 
-    cells = cells_df_as_np(cells)
-    non_cells = cells_df_as_np(non_cells)
+    non_cells = positions[types == Cell.UNKNOWN]
+    cells = positions[types == Cell.CELL]
     return cells, non_cells
 
 
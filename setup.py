@@ -27,7 +27,8 @@ setup(
             "bump2version",
             "pre-commit",
             "flake8",
-        ]
+        ],
+        "zarr": ["zarr"],
     },
     python_requires=">=3.6, <3.8",
     packages=find_namespace_packages(exclude=("docs", "tests*")),
@@ -48,6 +49,9 @@ setup(
             "points_to_brainrender = "
             "neuro.points.points_to_brainrender:main",
             "heatmap = neuro.heatmap.heatmap:cli",
+            "heatmap_batch = neuro.heatmap.batch:cli",
+            "heatmap_update = neuro.heatmap.incremental:cli",
+            "cell_region_counts = neuro.cells.regions:cli",
             "amap_vis = neuro.visualise.amap_vis:main",
             "cellfinder_view = neuro.visualise.viewer:main",
             "fibre_track = "
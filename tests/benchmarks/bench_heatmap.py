@@ -0,0 +1,455 @@
+"""
+Benchmarks each stage of heatmap generation (neuro.heatmap.heatmap) on
+synthetic data: cell clouds of increasing size, a synthetic raw image
+(directory of 2D tiffs), and a synthetic target image (atlas). No external
+data is needed.
+
+The wall time and peak memory usage (RSS) of each stage are measured, and
+saved as json, so that results can be compared between releases.
+
+python tests/benchmarks/bench_heatmap.py --num-cells 100000 1000000 \
+    --output heatmap_benchmark.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+
+from pathlib import Path
+from datetime import datetime
+from timeit import default_timer as timer
+
+import numpy as np
+import psutil
+import tifffile
+from brainio import brainio
+from skimage.filters import gaussian
+from imlib.cells.cells import Cell
+from imlib.image.scale import scale_and_convert_to_16_bits
+from imlib.image.masking import mask_image_threshold
+from imlib.image.size import resize_array
+from imlib.image.shape import convert_shape_dict_to_array_shape
+
+import neuro
+from neuro.cache import get_sidecar_path
+from neuro.heatmap.heatmap import (
+    HeatmapParams,
+    get_cell_location_array,
+    run,
+)
+from neuro.heatmap.binning import bin_cells
+
+XML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    "<CellCounter_Marker_File>\n"
+    "  <Image_Properties>\n"
+    "    <Image_Filename>placeholder.tif</Image_Filename>\n"
+    "  </Image_Properties>\n"
+    "  <Marker_Data>\n"
+    "    <Current_Type>1</Current_Type>\n"
+)
+XML_FOOTER = "  </Marker_Data>\n</CellCounter_Marker_File>\n"
+XML_MARKER = (
+    "      <Marker>\n"
+    "        <MarkerX>{}</MarkerX>\n"
+    "        <MarkerY>{}</MarkerY>\n"
+    "        <MarkerZ>{}</MarkerZ>\n"
+    "      </Marker>\n"
+)
+
+
+class PeakMemory:
+    """
+    Context manager that samples the RSS of this process in a background
+    thread, and records the peak
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+class StageTimer:
+    """
+    Times each stage of the pipeline, and records the results
+    """
+
+    def __init__(self, num_cells):
+        self.num_cells = num_cells
+        self.results = []
+
+    def measure(self, stage, function, *args, **kwargs):
+        start_rss = psutil.Process().memory_info().rss
+        with PeakMemory() as memory:
+            start = timer()
+            result = function(*args, **kwargs)
+            elapsed = timer() - start
+        self.results.append(
+            {
+                "num_cells": self.num_cells,
+                "stage": stage,
+                "time_s": elapsed,
+                "peak_rss_mb": memory.peak / 1e6,
+                "peak_rss_increase_mb": (memory.peak - start_rss) / 1e6,
+            }
+        )
+        print(
+            f"{self.num_cells:>10} cells, {stage:<16} {elapsed:8.3f}s, "
+            f"peak RSS: {memory.peak / 1e6:8.1f}MB"
+        )
+        return result
+
+
+def make_raw_image(directory, raw_shape):
+    """
+    Creates a synthetic raw image (directory of 2D tiffs). Only the first
+    plane is read (to find the image size), so every plane is the same
+    (zlib compressed) blank image, hard linked if possible.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    x, y, z = raw_shape
+    first_plane = directory / "plane_00000.tif"
+    tifffile.imwrite(
+        str(first_plane), np.zeros((y, x), dtype=np.uint16), compression="zlib"
+    )
+    for plane in range(1, z):
+        path = directory / f"plane_{plane:05d}.tif"
+        try:
+            os.link(str(first_plane), str(path))
+        except OSError:
+            shutil.copy(str(first_plane), str(path))
+    return directory
+
+
+def make_target_image(path, target_shape, voxel_size_mm):
+    """
+    Creates a synthetic target image (atlas), an ellipsoid of labels filling
+    most of the volume
+    """
+    grid = np.meshgrid(
+        *[np.linspace(-1, 1, size) for size in target_shape], indexing="ij"
+    )
+    radius = np.sqrt(sum(axis ** 2 for axis in grid))
+    atlas = np.zeros(target_shape, dtype=np.uint16)
+    inside = radius < 0.95
+    atlas[inside] = 1 + (radius[inside] * 100).astype(np.uint16)
+    brainio.to_nii(atlas, str(path), scale=(voxel_size_mm,) * 3)
+    return path
+
+
+def make_cells(num_cells, raw_shape, seed=0):
+    """
+    Generates a synthetic cell cloud (a mixture of gaussian clusters, and a
+    uniform background) within the raw image, and the type of each cell
+    """
+    rng = np.random.RandomState(seed)
+    raw_shape = np.asarray(raw_shape)
+    n_clustered = int(num_cells * 0.8)
+    n_clusters = 20
+    centres = rng.uniform(0.2, 0.8, size=(n_clusters, 3)) * raw_shape
+    spreads = rng.uniform(0.02, 0.1, size=(n_clusters, 3)) * raw_shape
+    cluster = rng.randint(0, n_clusters, size=n_clustered)
+    clustered = rng.normal(centres[cluster], spreads[cluster])
+    background = rng.uniform(0, 1, size=(num_cells - n_clustered, 3))
+    positions = np.concatenate([clustered, background * raw_shape])
+    positions = np.clip(positions, 1, raw_shape - 1).astype(np.int64)
+    types = np.where(
+        rng.uniform(size=num_cells) < 0.7, Cell.CELL, Cell.UNKNOWN
+    )
+    return positions, types
+
+
+def write_cells_xml(path, positions, types, chunk_size=1000000):
+    """
+    Writes cells to a cellfinder xml file, in chunks
+    """
+    with open(str(path), "w") as xml_file:
+        xml_file.write(XML_HEADER)
+        for cell_type in np.unique(types):
+            xml_file.write(
+                f"    <Marker_Type>\n      <Type>{cell_type}</Type>\n"
+            )
+            type_positions = positions[types == cell_type]
+            for start in range(0, len(type_positions), chunk_size):
+                chunk = type_positions[start : start + chunk_size]
+                xml_file.write(
+                    "".join(XML_MARKER.format(*cell) for cell in chunk)
+                )
+            xml_file.write("    </Marker_Type>\n")
+        xml_file.write(XML_FOOTER)
+    return path
+
+
+def benchmark_stages(
+    cells_file,
+    output_filename,
+    raw_image,
+    target_image,
+    args,
+    timer_,
+    cache_directory,
+):
+    """
+    Runs (and times) each stage of neuro.heatmap.heatmap.run separately
+    :param cache_directory: Metadata cache directory to use (and clear) for
+    the benchmark. Must not be the default (~/.neuro) cache.
+    """
+    cache_directory = Path(cache_directory).resolve()
+    if cache_directory == (Path.home() / ".neuro").resolve():
+        raise ValueError(
+            f"Refusing to clear the default metadata cache: {cache_directory}"
+        )
+    os.environ["NEURO_CACHE_DIR"] = str(cache_directory)
+
+    # HeatmapParams, with and without the raw image shape cache
+    shutil.rmtree(str(cache_directory), ignore_errors=True)
+    timer_.measure(
+        "params_cold",
+        HeatmapParams,
+        raw_image,
+        target_image,
+        args.bin_size_um,
+        args.pixel_um,
+        args.pixel_um,
+        args.pixel_um,
+        args.smoothing_um,
+    )
+    params = timer_.measure(
+        "params_warm",
+        HeatmapParams,
+        raw_image,
+        target_image,
+        args.bin_size_um,
+        args.pixel_um,
+        args.pixel_um,
+        args.pixel_um,
+        args.smoothing_um,
+    )
+    target_size = convert_shape_dict_to_array_shape(
+        params.figure_image_shape, type="fiji"
+    )
+    raw_image_shape = convert_shape_dict_to_array_shape(
+        params.raw_image_shape, type="fiji"
+    )
+
+    # parse the xml (no cache), then load from the binary cache
+    cache = get_sidecar_path(cells_file)
+    if cache.exists():
+        cache.unlink()
+    timer_.measure(
+        "parse", get_cell_location_array, cells_file, cells_only=True
+    )
+    cells_array = timer_.measure(
+        "parse_cached", get_cell_location_array, cells_file, cells_only=True
+    )
+
+    heatmap_array = timer_.measure(
+        "bin",
+        bin_cells,
+        cells_array,
+        raw_image_shape,
+        params.bin_size_raw_voxels,
+    )
+    heatmap_array = timer_.measure(
+        "resize",
+        lambda array: resize_array(array.astype(np.uint16), target_size),
+        heatmap_array,
+    )
+    heatmap_array = timer_.measure(
+        "smooth",
+        gaussian,
+        heatmap_array,
+        sigma=params.smoothing_target_voxel,
+    )
+    heatmap_array = timer_.measure(
+        "mask", mask_image_threshold, heatmap_array, params.atlas_data
+    )
+    heatmap_array = timer_.measure(
+        "convert", scale_and_convert_to_16_bits, heatmap_array
+    )
+    timer_.measure(
+        "write",
+        brainio.to_nii,
+        heatmap_array,
+        output_filename,
+        scale=params.atlas_scale,
+        affine_transform=params.transformation_matrix,
+    )
+    del heatmap_array, cells_array
+
+    for stage, kwargs in (
+        ("total", {}),
+        ("total_chunked", {"chunked_processing": True}),
+    ):
+        timer_.measure(
+            stage,
+            run,
+            cells_file,
+            output_filename,
+            params.figure_image_shape,
+            params.raw_image_shape,
+            params.bin_size_raw_voxels,
+            params.transformation_matrix,
+            params.atlas_scale,
+            smoothing=params.smoothing_target_voxel,
+            atlas=params.atlas_data,
+            **kwargs,
+        )
+
+
+def get_metadata(args):
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "neuro_version": neuro.__version__,
+        "numpy_version": np.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "total_memory_mb": psutil.virtual_memory().total / 1e6,
+        "parameters": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+    }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--num-cells",
+        dest="num_cells",
+        type=float,
+        nargs="+",
+        default=[1e5, 1e6, 1e7],
+        help="Number of synthetic cells (one benchmark per value)",
+    )
+    parser.add_argument(
+        "--raw-shape",
+        dest="raw_shape",
+        type=int,
+        nargs=3,
+        default=[6000, 8000, 2500],
+        help="Raw image shape (x, y, z)",
+    )
+    parser.add_argument(
+        "--target-shape",
+        dest="target_shape",
+        type=int,
+        nargs=3,
+        default=[300, 400, 125],
+        help="Target image shape (x, y, z)",
+    )
+    parser.add_argument(
+        "--pixel-um",
+        dest="pixel_um",
+        type=float,
+        default=2,
+        help="Raw image pixel size (um). The target image pixel size is "
+        "derived from the raw and target shapes.",
+    )
+    parser.add_argument(
+        "--bin-size",
+        dest="bin_size_um",
+        type=float,
+        default=100,
+        help="Heatmap bin size (um)",
+    )
+    parser.add_argument(
+        "--heatmap-smoothing",
+        dest="smoothing_um",
+        type=float,
+        default=100,
+        help="Gaussian smoothing sigma (um)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        type=str,
+        default=None,
+        help="Directory for the synthetic data (defaults to a temporary "
+        "directory, which is deleted afterwards)",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default="heatmap_benchmark.json",
+        help="Output json file",
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        work_dir = Path(work_dir)
+
+        print("Generating synthetic images")
+        raw_image = make_raw_image(work_dir / "raw", args.raw_shape)
+        voxel_size_mm = (
+            args.pixel_um * args.raw_shape[0] / args.target_shape[0] / 1000
+        )
+        target_image = make_target_image(
+            work_dir / "atlas.nii", args.target_shape, voxel_size_mm
+        )
+
+        results = []
+        for num_cells in args.num_cells:
+            num_cells = int(num_cells)
+            print(f"Generating {num_cells} synthetic cells")
+            positions, types = make_cells(num_cells, args.raw_shape)
+            cells_file = write_cells_xml(
+                work_dir / f"cells_{num_cells}.xml", positions, types
+            )
+            del positions, types
+
+            timer_ = StageTimer(num_cells)
+            benchmark_stages(
+                cells_file,
+                str(work_dir / "heatmap.nii"),
+                str(raw_image),
+                str(target_image),
+                args,
+                timer_,
+                # don't use (or pollute) the user's cache
+                work_dir / "cache",
+            )
+            results.extend(timer_.results)
+            cells_file.unlink()
+
+    output = {"metadata": get_metadata(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
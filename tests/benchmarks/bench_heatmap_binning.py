@@ -0,0 +1,99 @@
+"""
+Compares the speed of the np.bincount based heatmap binning with the
+previous np.histogramdd implementation, on a synthetic cell cloud.
+
+python tests/benchmarks/bench_heatmap_binning.py --num-cells 5000000
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+from imlib.image.binning import get_bins
+
+from neuro.heatmap.binning import bin_cells
+
+
+def histogramdd(cells_array, image_shape, bin_sizes):
+    histogram, _ = np.histogramdd(
+        cells_array, bins=get_bins(image_shape, bin_sizes)
+    )
+    return histogram
+
+
+def time_function(function, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        result = function(*args)
+        times.append(timer() - start)
+    return min(times), result
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--num-cells",
+        dest="num_cells",
+        type=int,
+        default=5000000,
+        help="Number of synthetic cells",
+    )
+    parser.add_argument(
+        "--image-shape",
+        dest="image_shape",
+        type=int,
+        nargs=3,
+        default=[6000, 8000, 3000],
+        help="Raw image shape (x, y, z)",
+    )
+    parser.add_argument(
+        "--bin-sizes",
+        dest="bin_sizes",
+        type=int,
+        nargs=3,
+        default=[50, 50, 20],
+        help="Bin sizes in raw image voxels (x, y, z)",
+    )
+    parser.add_argument(
+        "--repeats", dest="repeats", type=int, default=3, help="Repeats"
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    np.random.seed(0)
+    cells = np.random.randint(
+        0, args.image_shape, size=(args.num_cells, 3), dtype=np.int64
+    )
+    print(
+        f"Binning {args.num_cells} cells in an image of shape "
+        f"{args.image_shape} with bins of {args.bin_sizes}"
+    )
+
+    histogramdd_time, expected = time_function(
+        histogramdd,
+        cells,
+        args.image_shape,
+        args.bin_sizes,
+        repeats=args.repeats,
+    )
+    bincount_time, result = time_function(
+        bin_cells,
+        cells,
+        args.image_shape,
+        args.bin_sizes,
+        repeats=args.repeats,
+    )
+    assert (expected == result).all(), "Binning results differ"
+
+    print(f"np.histogramdd: {histogramdd_time:.3f}s")
+    print(f"bin_cells:      {bincount_time:.3f}s")
+    print(f"Speedup:        {histogramdd_time / bincount_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Compares the latency of looking up the structure under the mouse (as in
+display_brain_region_name) using the structures dataframe, and using a
+StructureLookup. Also times the batch lookup of an array of atlas values.
+
+python tests/benchmarks/bench_structure_lookup.py --num-lookups 10000
+"""
+
+import argparse
+from pathlib import Path
+from timeit import default_timer as timer
+
+import numpy as np
+
+from neuro.structures.IO import load_structures_as_df
+from neuro.structures.structures_tree import (
+    StructureLookup,
+    UnknownAtlasValue,
+    atlas_value_to_name,
+)
+
+default_structures_file = Path("tests", "data", "structures", "structures.csv")
+
+
+def hover_names(atlas_values, structures):
+    # as in display_brain_region_name
+    names = []
+    for atlas_value in atlas_values:
+        try:
+            names.append(atlas_value_to_name(atlas_value, structures))
+        except UnknownAtlasValue:
+            names.append("Unknown region")
+    return names
+
+
+def time_function(function, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        result = function(*args)
+        times.append(timer() - start)
+    return min(times), result
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--structures-file",
+        dest="structures_file",
+        type=str,
+        default=str(default_structures_file),
+        help="Structures csv file",
+    )
+    parser.add_argument(
+        "--num-lookups",
+        dest="num_lookups",
+        type=int,
+        default=10000,
+        help="Number of single (mouse move) lookups",
+    )
+    parser.add_argument(
+        "--num-batch",
+        dest="num_batch",
+        type=int,
+        default=10000000,
+        help="Number of atlas values in the batch lookup",
+    )
+    parser.add_argument(
+        "--repeats", dest="repeats", type=int, default=3, help="Repeats"
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    structures_df = load_structures_as_df(args.structures_file)
+    np.random.seed(0)
+    # include some values that aren't in the atlas
+    atlas_values = np.random.choice(
+        np.append(structures_df["id"].to_numpy(), [100000, 100001]),
+        size=args.num_lookups,
+    )
+
+    start = timer()
+    lookup = StructureLookup(structures_df)
+    build_time = timer() - start
+
+    df_time, expected = time_function(
+        hover_names, atlas_values, structures_df, repeats=args.repeats
+    )
+    lookup_time, result = time_function(
+        hover_names, atlas_values, lookup, repeats=args.repeats
+    )
+    assert expected == result, "Lookup results differ"
+
+    batch_values = np.random.choice(atlas_values, size=args.num_batch)
+    batch_time, names = time_function(
+        lookup.get_names,
+        batch_values,
+        "Unknown region",
+        repeats=args.repeats,
+    )
+
+    print(f"Building the lookup: {build_time * 1000:.2f}ms")
+    print(
+        f"Per lookup (dataframe):       "
+        f"{df_time / args.num_lookups * 1e6:.1f}us"
+    )
+    print(
+        f"Per lookup (StructureLookup): "
+        f"{lookup_time / args.num_lookups * 1e6:.1f}us"
+    )
+    print(f"Speedup:                      {df_time / lookup_time:.1f}x")
+    print(
+        f"Batch lookup of {args.num_batch} values: {batch_time:.3f}s "
+        f"({batch_time / args.num_batch * 1e9:.1f}ns per value)"
+    )
+
+
+if __name__ == "__main__":
+    main()
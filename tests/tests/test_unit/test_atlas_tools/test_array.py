@@ -0,0 +1,65 @@
+import numpy as np
+from skimage.measure import regionprops_table
+
+from neuro.atlas_tools.array import (
+    count_lateralised_structures,
+    get_bounding_box,
+    lateralise_atlas,
+    offset_region_properties,
+    pad_bounding_box,
+)
+
+
+def test_count_lateralised_structures():
+    rng = np.random.default_rng(0)
+    atlas = rng.choice([0, 5, 10, 600000000], size=(20, 30, 40))
+    hemispheres = rng.choice([0, 1, 2], size=atlas.shape)
+    mask = rng.random(atlas.shape) > 0.5
+
+    atlas_values, left_counts, right_counts = count_lateralised_structures(
+        atlas, hemispheres, mask=mask
+    )
+    atlas_left, atlas_right = lateralise_atlas(atlas * mask, hemispheres)
+    assert atlas_values.tolist() == [5, 10, 600000000]
+    for atlas_value, left, right in zip(
+        atlas_values, left_counts, right_counts
+    ):
+        assert left == (atlas_left == atlas_value).sum()
+        assert right == (atlas_right == atlas_value).sum()
+
+
+def test_count_lateralised_structures_empty():
+    atlas = np.zeros((5, 5, 5), dtype=np.int32)
+    atlas_values, left_counts, right_counts = count_lateralised_structures(
+        atlas, np.ones_like(atlas)
+    )
+    assert len(atlas_values) == len(left_counts) == len(right_counts) == 0
+
+
+def test_pad_bounding_box():
+    bounding_box = (slice(0, 3), slice(5, 7), slice(11, 20))
+    assert pad_bounding_box(bounding_box, (10, 20, 20)) == (
+        slice(0, 4),
+        slice(4, 8),
+        slice(10, 20),
+    )
+    assert pad_bounding_box(
+        bounding_box, (10, 20, 20), padding=2, step_size=2
+    ) == (slice(0, 5), slice(2, 9), slice(8, 20))
+
+
+def test_offset_region_properties():
+    data = np.zeros((20, 30, 40), dtype=np.uint8)
+    data[2:5, 10:20, 30:32] = 1
+    data[8, 12, 35] = 2
+    properties = ["area", "bbox", "centroid"]
+    bounding_box = get_bounding_box(data)
+
+    expected = regionprops_table(data, properties=properties)
+    result = offset_region_properties(
+        regionprops_table(data[bounding_box], properties=properties),
+        [axis.start for axis in bounding_box],
+    )
+    assert result.keys() == expected.keys()
+    for column in expected:
+        np.testing.assert_allclose(result[column], expected[column])
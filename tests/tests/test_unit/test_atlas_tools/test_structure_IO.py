@@ -1,6 +1,10 @@
+import shutil
 from pathlib import Path
 from pandas import Index
+from pandas.testing import assert_frame_equal
 
+import neuro.cache
+from neuro.cache import get_sidecar_path
 from neuro.structures.IO import load_structures_as_df
 
 data_dir = Path("tests", "data")
@@ -32,3 +36,42 @@ def test_load_structures_df():
     assert structures_test[1] == structures_line_100[1]
     assert structures_test[2] == structures_line_100[2]
     assert structures_test[3] == structures_line_100[3]
+
+
+def test_load_structures_df_cache(tmpdir):
+    structures_file = Path(tmpdir) / "structures.csv"
+    shutil.copy(structures_csv, structures_file)
+    cache_file = get_sidecar_path(structures_file)
+
+    expected = load_structures_as_df(structures_file, use_cache=False)
+    assert not cache_file.exists()
+
+    structures = load_structures_as_df(structures_file)
+    assert cache_file.exists()
+    assert_frame_equal(structures, expected)
+
+    # loaded from the cache
+    structures = load_structures_as_df(structures_file)
+    assert_frame_equal(structures, expected)
+
+    # cache is invalidated when the file changes
+    expected = expected[expected["id"] != 100]
+    expected.to_csv(structures_file, index=False)
+    structures = load_structures_as_df(structures_file)
+    assert len(structures) == len(expected)
+    assert 100 not in structures["id"].values
+
+
+def test_load_structures_df_read_only(tmpdir, monkeypatch):
+    structures_file = Path(tmpdir) / "structures.csv"
+    shutil.copy(structures_csv, structures_file)
+    cache_directory = Path(tmpdir) / "cache"
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(cache_directory))
+    monkeypatch.setattr(neuro.cache.os, "access", lambda *args: False)
+
+    expected = load_structures_as_df(structures_file, use_cache=False)
+    structures = load_structures_as_df(structures_file)
+    assert not get_sidecar_path(structures_file).exists()
+    assert len(list(cache_directory.glob("*structures.csv.cache.npz"))) == 1
+    assert_frame_equal(structures, expected)
+    assert_frame_equal(load_structures_as_df(structures_file), expected)
@@ -0,0 +1,95 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+import imlib.IO.cells as cells_io
+
+from neuro.cache import get_sidecar_path
+from neuro.cells.IO import iter_cells_xml, load_cell_arrays, read_cells_xml
+
+data_dir = Path("tests", "data")
+cells_xml = data_dir / "points" / "cellfinder_out.xml"
+
+
+def imlib_cell_arrays(cells_file):
+    cells = cells_io.get_cells(str(cells_file))
+    positions = np.array([[cell.x, cell.y, cell.z] for cell in cells])
+    types = np.array([cell.type for cell in cells])
+    return positions, types
+
+
+def test_iter_cells_xml():
+    positions, types = imlib_cell_arrays(cells_xml)
+    chunks = list(iter_cells_xml(cells_xml, chunk_size=1000))
+    assert len(chunks) == int(np.ceil(len(positions) / 1000))
+    assert (np.concatenate([c[0] for c in chunks]) == positions).all()
+    assert (np.concatenate([c[1] for c in chunks]) == types).all()
+
+
+def write_markers_xml(xml_file, markers, cell_type="<Type>2</Type>"):
+    with open(xml_file, "w") as f:
+        f.write(
+            "<CellCounter_Marker_File><Marker_Data><Marker_Type>"
+            + cell_type
+            + "".join(f"<Marker>{marker}</Marker>" for marker in markers)
+            + "</Marker_Type></Marker_Data></CellCounter_Marker_File>"
+        )
+
+
+def test_read_cells_xml_missing_values(tmpdir):
+    xml_file = Path(tmpdir) / "cells.xml"
+    write_markers_xml(
+        xml_file,
+        [
+            "<MarkerX>8</MarkerX><MarkerY>9</MarkerY><MarkerZ>10</MarkerZ>",
+            "<MarkerX>8</MarkerX><MarkerY>9</MarkerY>",
+        ],
+    )
+    positions, types = read_cells_xml(xml_file)
+    # missing positions default to 1
+    assert (positions == [[8, 9, 10], [8, 9, 1]]).all()
+    assert (types == [2, 2]).all()
+
+    write_markers_xml(xml_file, ["<MarkerX>8</MarkerX>"], cell_type="")
+    with pytest.raises(ValueError):
+        read_cells_xml(xml_file)
+
+    with open(xml_file, "w") as f:
+        f.write(
+            "<Marker_Data><Marker><MarkerX>8</MarkerX></Marker></Marker_Data>"
+        )
+    with pytest.raises(ValueError):
+        read_cells_xml(xml_file)
+
+
+def test_load_cell_arrays_cache(tmpdir):
+    cells_file = Path(tmpdir) / "cells.xml"
+    shutil.copy(cells_xml, cells_file)
+    cache_file = get_sidecar_path(cells_file)
+    expected_positions, expected_types = imlib_cell_arrays(cells_xml)
+
+    positions, types = load_cell_arrays(cells_file, use_cache=False)
+    assert not cache_file.exists()
+    assert (positions == expected_positions).all()
+    assert (types == expected_types).all()
+
+    load_cell_arrays(cells_file)
+    assert cache_file.exists()
+    positions, types = load_cell_arrays(cells_file)
+    assert (positions == expected_positions).all()
+    assert (types == expected_types).all()
+
+    # cache is invalidated when the cells file changes
+    with open(cells_file, "r") as f:
+        xml = f.read()
+    first_marker = xml.index("<Marker>")
+    end = xml.index("</Marker>", first_marker) + len("</Marker>")
+    with open(cells_file, "w") as f:
+        f.write(xml[:first_marker] + xml[end:])
+    os.utime(str(cells_file), ns=(0, 0))
+
+    positions, types = load_cell_arrays(cells_file)
+    assert len(positions) == len(expected_positions) - 1
+    assert (positions == expected_positions[1:]).all()
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import imlib.IO.cells as cells_io
+from pathlib import Path
+from imlib.cells.cells import Cell
+
+from neuro.cells.regions import (
+    count_by_structure,
+    count_cells_in_regions,
+    get_cell_structures,
+)
+
+ATLAS_PIXEL_UM = 50
+RAW_PIXEL_UM = 10
+SHAPE = (8, 10, 12)
+
+
+def make_atlas():
+    rng = np.random.default_rng(0)
+    atlas = rng.choice([0, 5, 10, 15], size=SHAPE).astype(np.int32)
+    hemispheres = np.ones(SHAPE, dtype=np.uint8)
+    hemispheres[SHAPE[0] // 2 :] = 2
+    return atlas, hemispheres
+
+
+def make_registration_directory(directory, atlas, hemispheres):
+    directory = Path(directory)
+    for image, name in (
+        (atlas, "registered_atlas.nii"),
+        (hemispheres, "registered_hemispheres.nii"),
+    ):
+        nib.save(nib.Nifti1Image(image, np.eye(4)), str(directory / name))
+    with open(str(directory / "config.conf"), "w") as f:
+        f.write("[atlas]\n[[pixel_size]]\n")
+        for axis in ("x", "y", "z"):
+            f.write(f"{axis} = {ATLAS_PIXEL_UM}\n")
+
+
+def test_get_cell_structures():
+    atlas, hemispheres = make_atlas()
+    scale = RAW_PIXEL_UM / ATLAS_PIXEL_UM
+    positions = np.array([[0, 0, 0], [39, 49, 59], [40, 0, 0], [-1, 0, 0]])
+    structure_ids, hemisphere_values = get_cell_structures(
+        positions, atlas, hemispheres, [scale] * 3
+    )
+    assert structure_ids.tolist() == [
+        atlas[0, 0, 0],
+        atlas[7, 9, 11],
+        0,
+        0,
+    ]
+    assert hemisphere_values.tolist() == [1, 2, 0, 0]
+
+
+def test_count_by_structure():
+    counts = count_by_structure([5, 5, 10, 5, 0], [1, 2, 1, 1, 0])
+    assert counts.to_dict() == {
+        (0, 0): 1,
+        (5, 1): 2,
+        (5, 2): 1,
+        (10, 1): 1,
+    }
+
+
+def test_count_cells_in_regions(tmpdir):
+    tmpdir = Path(tmpdir)
+    atlas, hemispheres = make_atlas()
+    make_registration_directory(tmpdir, atlas, hemispheres)
+
+    rng = np.random.default_rng(1)
+    raw_shape = np.array(SHAPE) * ATLAS_PIXEL_UM // RAW_PIXEL_UM
+    positions = rng.integers(1, raw_shape, size=(500, 3))
+    types = rng.choice([Cell.CELL, Cell.UNKNOWN], size=len(positions))
+    cells = [Cell(pos, cell_type) for pos, cell_type in zip(positions, types)]
+    cells_file = tmpdir / "cells.xml"
+    cells_io.save_cells(cells, str(cells_file))
+
+    output_file = tmpdir / "summary.csv"
+    summary = count_cells_in_regions(
+        cells_file,
+        tmpdir,
+        RAW_PIXEL_UM,
+        RAW_PIXEL_UM,
+        RAW_PIXEL_UM,
+        output_filename=output_file,
+    )
+    pd.testing.assert_frame_equal(pd.read_csv(output_file), summary)
+
+    voxel_volume_mm3 = (ATLAS_PIXEL_UM / 1000) ** 3
+    summary = summary.set_index("structure_id")
+    assert sorted(summary.index) == [5, 10, 15]
+    for structure_id, row in summary.iterrows():
+        for hemisphere, value in (("left", 2), ("right", 1)):
+            expected = 0
+            for position in positions[types == Cell.CELL]:
+                voxel = tuple(position * RAW_PIXEL_UM // ATLAS_PIXEL_UM)
+                if (
+                    atlas[voxel] == structure_id
+                    and hemispheres[voxel] == value
+                ):
+                    expected += 1
+            volume = voxel_volume_mm3 * np.sum(
+                (atlas == structure_id) & (hemispheres == value)
+            )
+            assert row[f"{hemisphere}_cell_count"] == expected
+            assert np.isclose(row[f"{hemisphere}_volume_mm3"], volume)
+            assert np.isclose(
+                row[f"{hemisphere}_cells_per_mm3"], expected / volume
+            )
+        assert row["total_cell_count"] == (
+            row["left_cell_count"] + row["right_cell_count"]
+        )
+
+
+def test_count_cells_in_regions_roll_up(tmpdir):
+    tmpdir = Path(tmpdir)
+    atlas, hemispheres = make_atlas()
+    # structures in the test structures file, one a parent of the other
+    atlas[atlas == 5] = 313
+    atlas[atlas == 10] = 348
+    atlas[(atlas == 15) | (atlas == 0)] = 100
+    make_registration_directory(tmpdir, atlas, hemispheres)
+    cells = [Cell([x, 1, 1], Cell.CELL) for x in range(1, 40, 3)]
+    cells_file = tmpdir / "cells.xml"
+    cells_io.save_cells(cells, str(cells_file))
+
+    structures_file = Path("tests", "data", "structures", "structures.csv")
+    summary = count_cells_in_regions(
+        cells_file,
+        tmpdir,
+        RAW_PIXEL_UM,
+        RAW_PIXEL_UM,
+        RAW_PIXEL_UM,
+        structures_file=structures_file,
+    ).set_index("structure_id")
+    rolled_up = count_cells_in_regions(
+        cells_file,
+        tmpdir,
+        RAW_PIXEL_UM,
+        RAW_PIXEL_UM,
+        RAW_PIXEL_UM,
+        structures_file=structures_file,
+        roll_up_hierarchy=True,
+    ).set_index("structure_id")
+
+    assert rolled_up.loc[997, "total_cell_count"] == len(cells)
+    assert rolled_up.loc[348, "depth"] == 4
+    assert rolled_up.loc[348, "parent_structure_id"] == 313
+    for column in ("total_cell_count", "total_volume_mm3"):
+        assert np.isclose(rolled_up.loc[313, column], summary[column].sum())
+        assert np.isclose(
+            rolled_up.loc[348, column],
+            summary.loc[348, column] + summary.loc[100, column],
+        )
+    assert np.isclose(
+        rolled_up.loc[313, "total_cells_per_mm3"],
+        len(cells) / summary["total_volume_mm3"].sum(),
+    )
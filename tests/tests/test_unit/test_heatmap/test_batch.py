@@ -0,0 +1,72 @@
+import os
+import pytest
+
+from neuro.heatmap.batch import read_manifest, get_n_workers
+
+defaults = {
+    "bin_size_um": 100,
+    "x_pixel_um": 2,
+    "y_pixel_um": 2,
+    "z_pixel_um": 5,
+    "heatmap_smooth": 100,
+}
+
+
+def test_read_manifest(tmpdir):
+    manifest = os.path.join(str(tmpdir), "manifest.csv")
+    with open(manifest, "w") as f:
+        f.write(
+            "cells_file,output_filename,raw_image,downsampled_image,"
+            "bin_size_um\n"
+            "a/cells.xml,a/heatmap.nii,a/raw,a/atlas.nii,\n"
+            "/b/cells.xml,/b/heatmap.nii,/b/raw,/b/atlas.nii,50\n"
+        )
+    brains = read_manifest(manifest, defaults)
+    assert len(brains) == 2
+    assert brains[0]["cells_file"] == os.path.join(
+        str(tmpdir), "a", "cells.xml"
+    )
+    assert brains[0]["bin_size_um"] == 100
+    assert brains[1]["cells_file"] == "/b/cells.xml"
+    assert brains[1]["bin_size_um"] == 50
+    assert brains[1]["z_pixel_um"] == 5
+
+
+def test_read_manifest_yaml(tmpdir):
+    manifest = os.path.join(str(tmpdir), "manifest.yml")
+    with open(manifest, "w") as f:
+        f.write(
+            "brains:\n"
+            "  - cells_file: cells.xml\n"
+            "    output_filename: heatmap.nii\n"
+            "    raw_image: raw\n"
+            "    downsampled_image: atlas.nii\n"
+            "    heatmap_smooth: 0\n"
+        )
+    brains = read_manifest(manifest, defaults)
+    assert len(brains) == 1
+    assert brains[0]["heatmap_smooth"] == 0
+    assert brains[0]["x_pixel_um"] == 2
+
+
+def test_read_manifest_missing(tmpdir):
+    manifest = os.path.join(str(tmpdir), "manifest.csv")
+    with open(manifest, "w") as f:
+        f.write("cells_file,output_filename,raw_image\na,b,c\n")
+    with pytest.raises(ValueError):
+        read_manifest(manifest, defaults)
+
+    with open(manifest, "w") as f:
+        f.write("cells_file,output_filename,raw_image,downsampled_image\n")
+        f.write("a,b,c,d\n")
+    with pytest.raises(ValueError):
+        read_manifest(manifest, dict(defaults, x_pixel_um=None))
+
+
+def test_get_n_workers():
+    estimates = [4e9, 1e9, 3e9, 2e9]
+    assert get_n_workers(estimates, 8, None) == 8
+    assert get_n_workers(estimates, 8, 8e9) == 2
+    assert get_n_workers(estimates, 8, 10e9) == 4
+    assert get_n_workers(estimates, 2, 100e9) == 2
+    assert get_n_workers(estimates, 8, 1e9) == 1
@@ -0,0 +1,147 @@
+import numpy as np
+
+from imlib.image.binning import get_bins
+
+from neuro.heatmap.binning import (
+    bin_cells,
+    bin_cells_target_space,
+    get_number_of_bins,
+    rebin_cells,
+)
+
+image_shape = (230, 170, 95)
+bin_sizes = (10, 7, 5)
+
+
+def histogramdd(cells_array, shape=image_shape, sizes=bin_sizes):
+    histogram, _ = np.histogramdd(cells_array, bins=get_bins(shape, sizes))
+    return histogram
+
+
+def test_get_number_of_bins():
+    assert get_number_of_bins(image_shape, bin_sizes) == (22, 24, 18)
+    assert get_number_of_bins((10, 10, 3), (5, 5, 5)) == (1, 1, 0)
+
+
+def test_bin_cells_matches_histogramdd():
+    np.random.seed(0)
+    cells = np.random.randint(-10, 240, size=(20000, 3))
+    # include cells exactly on the bin edges
+    edges = np.array(get_number_of_bins(image_shape, bin_sizes)) * np.array(
+        bin_sizes
+    )
+    cells = np.concatenate([cells, [edges, edges - 1, [0, 0, 0]]])
+
+    counts = bin_cells(cells, image_shape, bin_sizes)
+    assert counts.shape == histogramdd(cells).shape
+    assert (counts == histogramdd(cells)).all()
+
+
+def test_bin_cells_float_positions():
+    np.random.seed(1)
+    cells = np.random.uniform(-5, 235, size=(5000, 3))
+    assert (
+        bin_cells(cells, image_shape, bin_sizes) == histogramdd(cells)
+    ).all()
+
+
+def test_bin_cells_empty():
+    cells = np.empty((0, 3))
+    assert bin_cells(cells, image_shape, bin_sizes).sum() == 0
+    assert bin_cells([[1, 1, 1]], (10, 10, 3), (5, 5, 5)).shape == (1, 1, 0)
+
+
+def test_bin_cells_target_space():
+    np.random.seed(2)
+    raw_shape = (200, 100, 60)
+    target_shape = (20, 10, 6)
+    cells = np.random.randint(0, 60, size=(10000, 3))
+
+    # with an integer scale factor, this is the same as binning in raw space
+    counts = bin_cells_target_space(
+        cells, raw_shape, target_shape, chunk_size=999
+    )
+    expected = histogramdd(cells, shape=(210, 110, 70), sizes=(10, 10, 10))
+    assert counts.shape == target_shape
+    assert counts.dtype == np.uint32
+    assert (counts == expected).all()
+
+
+def test_bin_cells_target_space_trilinear():
+    np.random.seed(3)
+    raw_shape = (200, 100, 60)
+    target_shape = (20, 10, 6)
+    # keep away from the edges, so no weight is lost
+    cells = np.random.uniform(5, 50, size=(1000, 3))
+
+    densities = bin_cells_target_space(
+        cells, raw_shape, target_shape, trilinear=True
+    )
+    assert densities.dtype == np.float32
+    assert np.isclose(densities.sum(), len(cells))
+
+    # a cell at a voxel centre is not split
+    densities = bin_cells_target_space(
+        [[14.5, 24.5, 34.5]], raw_shape, target_shape, trilinear=True
+    )
+    assert densities[1, 2, 3] == 1
+    assert densities.sum() == 1
+
+
+def test_bin_cells_groups():
+    np.random.seed(3)
+    cells = np.random.randint(0, 230, size=(5000, 3))
+    groups = np.random.randint(0, 3, size=len(cells))
+    counts = bin_cells(
+        cells, image_shape, bin_sizes, groups=groups, n_groups=3
+    )
+    assert counts.shape == (3,) + get_number_of_bins(image_shape, bin_sizes)
+    for group in range(3):
+        assert (counts[group] == histogramdd(cells[groups == group])).all()
+
+    target_shape = (46, 34, 19)
+    for trilinear in (False, True):
+        heatmaps = bin_cells_target_space(
+            cells,
+            image_shape,
+            target_shape,
+            trilinear=trilinear,
+            groups=groups,
+            n_groups=3,
+        )
+        for group in range(3):
+            heatmap = bin_cells_target_space(
+                cells[groups == group],
+                image_shape,
+                target_shape,
+                trilinear=trilinear,
+            )
+            assert np.allclose(heatmaps[group], heatmap)
+
+
+def test_rebin_cells():
+    np.random.seed(4)
+    shape = (233, 171, 97)
+    fine_sizes = (4, 3, 2)
+    cells = np.random.randint(-5, 240, size=(20000, 3))
+    for factors in [(1, 1, 1), (2, 3, 5), (5, 4, 3), (7, 7, 7)]:
+        coarse_sizes = [s * f for s, f in zip(fine_sizes, factors)]
+        # include cells exactly on the coarse and fine bin edges
+        edges = np.array(get_number_of_bins(shape, coarse_sizes)) * np.array(
+            coarse_sizes
+        )
+        fine_edges = np.array(
+            get_number_of_bins(shape, fine_sizes)
+        ) * np.array(fine_sizes)
+        edge_cells = np.concatenate(
+            [
+                cells,
+                [edges, fine_edges, [edges[0], 3, fine_edges[2]]],
+                [[edges[0], 10, 10], [10, edges[1], 10], [10, 10, edges[2]]],
+            ]
+        )
+        fine = bin_cells(edge_cells, shape, fine_sizes)
+        expected = bin_cells(edge_cells, shape, coarse_sizes)
+        coarse = rebin_cells(fine, edge_cells, shape, fine_sizes, coarse_sizes)
+        assert (coarse == expected).all()
+        assert (coarse == histogramdd(edge_cells, shape, coarse_sizes)).all()
@@ -0,0 +1,51 @@
+import numpy as np
+
+from skimage.filters import gaussian
+
+from neuro.heatmap.chunked import (
+    convert_to_16_bits,
+    get_chunk_shape,
+    get_halo,
+    smooth_and_mask,
+)
+
+sigma = 2
+
+
+def test_get_chunk_shape():
+    shape = (50, 40, 30)
+    halo = get_halo(sigma)
+    assert halo == 8
+    assert get_chunk_shape(shape, halo, 1e9) == shape
+
+    chunk_shape = get_chunk_shape(shape, halo, 66 * 56 * 26 * 16)
+    assert chunk_shape == (50, 40, 10)
+
+    # blocks are never smaller than the halo
+    chunk_shape = get_chunk_shape(shape, halo, 66 * 56 * 20 * 16)
+    assert chunk_shape == (50, 40, 8)
+
+
+def test_smooth_and_mask():
+    np.random.seed(0)
+    heatmap = np.random.randint(0, 10, size=(50, 40, 30)).astype(np.uint16)
+    atlas = np.random.randint(0, 3, size=heatmap.shape)
+
+    output = np.zeros(heatmap.shape, dtype=np.float32)
+    # small budget, to force processing in many blocks
+    smooth_and_mask(
+        heatmap, output, smoothing=sigma, atlas=atlas, memory_budget=1e6
+    )
+
+    expected = gaussian(heatmap.astype(np.float64), sigma=sigma)
+    expected[atlas == 0] = 0
+    assert np.allclose(output, expected, atol=1e-4)
+
+
+def test_convert_to_16_bits():
+    np.random.seed(1)
+    image = np.random.random((20, 20, 20)).astype(np.float32)
+    output = np.zeros(image.shape, dtype=np.uint16)
+    convert_to_16_bits(image, output, memory_budget=1e4)
+    expected = (image / image.max()) * (2 ** 16 - 1)
+    assert (output == expected.astype(np.uint16)).all()
@@ -0,0 +1,83 @@
+from pathlib import Path
+
+import pytest
+from brainio import brainio
+
+from neuro.heatmap.heatmap import main, get_group_filename
+
+data_dir = Path("tests", "data", "heatmap")
+cells_file = str(data_dir / "cells.xml")
+raw_image = str(data_dir / "raw")
+target_image = str(data_dir / "heatmap.nii")
+
+
+def run_heatmap(cells, output, **kwargs):
+    main(
+        cells,
+        output,
+        raw_image,
+        target_image,
+        250,
+        50,
+        50,
+        50,
+        250,
+        True,
+        **kwargs
+    )
+
+
+def test_get_group_filename():
+    assert get_group_filename("/a/heatmap.nii", "cells") == str(
+        Path("/a/heatmap_cells.nii")
+    )
+    assert get_group_filename("heatmap.nii.gz", "x") == "heatmap_x.nii.gz"
+
+
+@pytest.mark.parametrize("chunked_processing", [False, True])
+def test_group_by_type(tmpdir, monkeypatch, chunked_processing):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    output = str(tmpdir / "heatmap.nii")
+
+    run_heatmap(cells_file, output, chunked_processing=chunked_processing)
+    single = brainio.load_nii(output, as_array=True)
+
+    run_heatmap(
+        cells_file,
+        output,
+        group_by_type=True,
+        chunked_processing=chunked_processing,
+    )
+    cells = brainio.load_nii(str(tmpdir / "heatmap_cells.nii"), as_array=True)
+    non_cells = brainio.load_nii(
+        str(tmpdir / "heatmap_non_cells.nii"), as_array=True
+    )
+    assert (cells == single).all()
+    assert non_cells.shape == single.shape
+
+    run_heatmap(
+        cells_file,
+        output,
+        group_by_type=True,
+        output_4d=True,
+        chunked_processing=chunked_processing,
+    )
+    heatmaps = brainio.load_nii(output, as_array=True)
+    assert heatmaps.shape == single.shape + (2,)
+    assert (heatmaps[..., 0] == cells).all()
+    assert (heatmaps[..., 1] == non_cells).all()
+
+
+def test_multiple_files(tmpdir, monkeypatch):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    output = str(tmpdir / "heatmap.nii")
+    run_heatmap(cells_file, output)
+    single = brainio.load_nii(output, as_array=True)
+
+    run_heatmap([cells_file, cells_file], output, output_4d=True)
+    heatmaps = brainio.load_nii(output, as_array=True)
+    assert heatmaps.shape == single.shape + (2,)
+    assert (heatmaps[..., 0] == single).all()
+    assert (heatmaps[..., 1] == single).all()
@@ -0,0 +1,38 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+from brainio import brainio
+
+from neuro.heatmap.heatmap import HeatmapParams, get_raw_image_shape
+
+data_dir = Path("tests", "data", "heatmap")
+raw_image = data_dir / "raw"
+target_image = data_dir / "heatmap.nii"
+
+
+def test_get_raw_image_shape_cache(tmpdir, monkeypatch):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir / "cache"))
+    raw_copy = tmpdir / "raw"
+    shutil.copytree(str(raw_image), str(raw_copy))
+
+    shape = brainio.get_size_image_from_file_paths(str(raw_image))
+    assert get_raw_image_shape(raw_copy) == shape
+    assert (tmpdir / "cache" / "raw_image_shape.json").exists()
+    assert get_raw_image_shape(raw_copy) == shape
+
+    # adding a plane changes the directory listing
+    planes = sorted(raw_copy.glob("*.tif"))
+    shutil.copy(str(planes[-1]), str(raw_copy / "zzz_extra.tif"))
+    shape["z"] += 1
+    assert get_raw_image_shape(raw_copy) == shape
+
+
+def test_heatmap_params_lazy_atlas(tmpdir, monkeypatch):
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    params = HeatmapParams(raw_image, target_image, 250, 50, 50, 50, 250)
+    assert params._atlas_data is None
+    atlas = brainio.load_nii(str(target_image), as_array=True)
+    assert (params.atlas_data == atlas).all()
+    assert isinstance(params.atlas_data, np.memmap)
@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+from brainio import brainio
+
+from neuro.heatmap.heatmap import main
+
+data_dir = Path("tests", "data", "heatmap")
+cells_file = str(data_dir / "cells.xml")
+raw_image = str(data_dir / "raw")
+target_image = str(data_dir / "heatmap.nii")
+
+
+def run_heatmap(output, bin_size, smoothing, **kwargs):
+    main(
+        cells_file,
+        output,
+        raw_image,
+        target_image,
+        bin_size,
+        50,
+        50,
+        50,
+        smoothing,
+        True,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("bin_in_target_space", [False, True])
+def test_sweep(tmpdir, monkeypatch, bin_in_target_space):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    bin_sizes = [250, 500, 750, 400]
+    smoothings = [250, 100, 0]
+    run_heatmap(
+        str(tmpdir / "sweep.nii"),
+        bin_sizes,
+        smoothings,
+        bin_in_target_space=bin_in_target_space,
+    )
+
+    for bin_size in bin_sizes:
+        for smoothing in smoothings:
+            output = str(tmpdir / "single.nii")
+            run_heatmap(
+                output,
+                bin_size,
+                smoothing,
+                bin_in_target_space=bin_in_target_space,
+            )
+            name = f"smooth{smoothing}"
+            if not bin_in_target_space:
+                name = f"bin{bin_size}_{name}"
+            sweep = brainio.load_nii(
+                str(tmpdir / f"sweep_{name}.nii"), as_array=True
+            )
+            single = brainio.load_nii(output, as_array=True)
+            assert (sweep == single).all()
+
+
+def test_sweep_groups(tmpdir):
+    with pytest.raises(ValueError):
+        run_heatmap(
+            str(tmpdir / "sweep.nii"), [250, 500], 250, group_by_type=True
+        )
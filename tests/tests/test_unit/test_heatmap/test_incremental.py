@@ -0,0 +1,90 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from brainio import brainio
+from imlib.cells.cells import Cell
+from imlib.IO.cells import get_cells, save_cells
+
+from neuro.heatmap.heatmap import main
+from neuro.heatmap.incremental import has_state, update_heatmap
+
+data_dir = Path("tests", "data", "heatmap")
+cells_file = str(data_dir / "cells.xml")
+
+
+def run_heatmap(cells, output, **kwargs):
+    main(
+        cells,
+        output,
+        str(data_dir / "raw"),
+        str(data_dir / "heatmap.nii"),
+        250,
+        50,
+        50,
+        50,
+        250,
+        True,
+        **kwargs,
+    )
+
+
+def edit_cells(output):
+    np.random.seed(0)
+    cells = get_cells(cells_file)
+    # remove some cells, reclassify some, and add some in one corner
+    cells = cells[20:]
+    for cell in cells[:30]:
+        cell.type = Cell.UNKNOWN if cell.type == Cell.CELL else Cell.CELL
+    for position in np.random.randint(5, 60, size=(20, 3)):
+        cells.append(Cell(position, Cell.CELL))
+    save_cells(cells, output)
+    return output
+
+
+@pytest.mark.parametrize("bin_in_target_space", [False, True])
+def test_update_heatmap(tmpdir, monkeypatch, bin_in_target_space):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    output = str(tmpdir / "heatmap.nii")
+    run_heatmap(
+        cells_file,
+        output,
+        save_counts=True,
+        bin_in_target_space=bin_in_target_space,
+    )
+    assert has_state(output)
+
+    edited_cells = edit_cells(str(tmpdir / "edited.xml"))
+    region = update_heatmap(output, cells_file=edited_cells)
+    assert region is not None
+    updated = brainio.load_nii(output, as_array=True)
+
+    expected_output = str(tmpdir / "expected.nii")
+    run_heatmap(
+        edited_cells, expected_output, bin_in_target_space=bin_in_target_space
+    )
+    expected = brainio.load_nii(expected_output, as_array=True)
+    assert (updated == expected).all()
+
+    # no change
+    assert update_heatmap(output, cells_file=edited_cells) is None
+
+
+def test_update_heatmap_changes(tmpdir, monkeypatch):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    output = str(tmpdir / "heatmap.nii")
+    run_heatmap(cells_file, output, save_counts=True)
+    original = np.array(brainio.load_nii(output, as_array=True))
+
+    added = np.array([[100, 100, 100], [101, 100, 100], [30, 40, 20]])
+    update_heatmap(output, added_cells=added)
+    assert not (brainio.load_nii(output, as_array=True) == original).all()
+    update_heatmap(output, removed_cells=added)
+    assert (brainio.load_nii(output, as_array=True) == original).all()
+
+
+def test_update_heatmap_no_state(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        update_heatmap(str(Path(str(tmpdir), "heatmap.nii")), cells_file)
@@ -0,0 +1,80 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from brainio import brainio
+
+from neuro.heatmap.heatmap import main
+from neuro.heatmap.ome_zarr import (
+    downsample_mean,
+    get_pyramid_shapes,
+    load_ome_zarr,
+    save_ome_zarr,
+)
+
+pytest.importorskip("zarr")
+
+data_dir = Path("tests", "data", "heatmap")
+
+
+def test_get_pyramid_shapes():
+    assert get_pyramid_shapes((100, 64, 20), chunk_size=64) == [
+        (100, 64, 20),
+        (50, 32, 10),
+    ]
+    assert get_pyramid_shapes((10, 10, 10), chunk_size=64) == [(10, 10, 10)]
+
+
+def test_downsample_mean():
+    image = np.arange(27, dtype=np.float32).reshape(3, 3, 3)
+    downsampled = downsample_mean(image)
+    assert downsampled.shape == (2, 2, 2)
+    assert downsampled[0, 0, 0] == image[:2, :2, :2].mean()
+    assert downsampled[1, 1, 1] == image[2, 2, 2]
+
+
+@pytest.mark.parametrize("shape", [(53, 40, 77), (30, 21, 45, 2)])
+def test_save_ome_zarr(tmpdir, shape):
+    np.random.seed(0)
+    image = np.random.randint(0, 2 ** 16, size=shape).astype(np.uint16)
+    output = str(Path(str(tmpdir), "image.zarr"))
+    save_ome_zarr(image, output, (0.05, 0.05, 0.05), chunk_size=8)
+
+    levels = load_ome_zarr(output)
+    axes_order = (2, 1, 0) if len(shape) == 3 else (3, 2, 1, 0)
+    expected = image
+    assert len(levels) == len(get_pyramid_shapes(shape[:3], chunk_size=8))
+    for level in levels:
+        assert (level.compute() == expected.transpose(axes_order)).all()
+        expected = downsample_mean(expected)
+
+
+def test_heatmap_ome_zarr(tmpdir, monkeypatch):
+    tmpdir = Path(str(tmpdir))
+    monkeypatch.setenv("NEURO_CACHE_DIR", str(tmpdir))
+    args = [
+        str(data_dir / "raw"),
+        str(data_dir / "heatmap.nii"),
+        250,
+        50,
+        50,
+        50,
+        250,
+        True,
+    ]
+    for chunked_processing in (False, True):
+        main(
+            str(data_dir / "cells.xml"),
+            str(tmpdir / "heatmap.nii"),
+            *args,
+            chunked_processing=chunked_processing,
+        )
+        main(
+            str(data_dir / "cells.xml"),
+            str(tmpdir / "heatmap.zarr"),
+            *args,
+            chunked_processing=chunked_processing,
+        )
+        heatmap = brainio.load_nii(str(tmpdir / "heatmap.nii"), as_array=True)
+        levels = load_ome_zarr(tmpdir / "heatmap.zarr")
+        assert (levels[0].compute() == np.swapaxes(heatmap, 2, 0)).all()
@@ -0,0 +1,79 @@
+import numpy as np
+
+from neuro.segmentation.manual_segmentation.autosave import (
+    LayerChangeTracker,
+    get_layer_fingerprint,
+)
+from neuro.segmentation.manual_segmentation.chunked_labels import (
+    ChunkedLabels,
+)
+
+
+class Layer:
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+
+
+def test_chunk_hashes():
+    labels = ChunkedLabels((20, 30, 40), chunk_shape=(10, 10, 10))
+    assert labels.get_chunk_hashes() == {}
+    labels[1, 2, 3] = 1
+    labels[15, 25, 35] = 2
+    hashes = labels.get_chunk_hashes()
+    assert set(hashes) == {(0, 0, 0), (1, 2, 3)}
+
+    # only changed chunks are hashed again
+    labels[1, 2, 3] = 1
+    assert labels.get_chunk_hashes() == hashes
+    np.swapaxes(labels, 2, 0)[35, 25, 15] = 3
+    new_hashes = labels.get_chunk_hashes()
+    assert new_hashes[(0, 0, 0)] == hashes[(0, 0, 0)]
+    assert new_hashes[(1, 2, 3)] != hashes[(1, 2, 3)]
+
+    # erased chunks are the same as unpainted ones
+    labels[15, 25, 35] = 0
+    assert set(labels.get_chunk_hashes()) == {(0, 0, 0)}
+    assert labels.copy().get_chunk_hashes() == labels.get_chunk_hashes()
+
+
+def test_layer_fingerprint():
+    labels = ChunkedLabels((20, 30, 40))
+    labels[1, 2, 3] = 1
+    fingerprint = get_layer_fingerprint(Layer(labels, "region_0"))
+    assert fingerprint == get_layer_fingerprint(
+        Layer(ChunkedLabels.from_array(np.asarray(labels)), "region_0")
+    )
+    assert fingerprint != get_layer_fingerprint(Layer(labels, "region_1"))
+
+    points = Layer(np.array([[1.0, 2.0, 3.0]]), "track_0")
+    fingerprint = get_layer_fingerprint(points)
+    points.data = np.array([[1.0, 2.0, 4.0]])
+    assert get_layer_fingerprint(points) != fingerprint
+
+
+def test_layer_change_tracker():
+    tracker = LayerChangeTracker()
+    loaded = Layer(ChunkedLabels((20, 30, 40)), "region_0")
+    loaded.data[5, 5, 5] = 1
+    new = Layer(ChunkedLabels((20, 30, 40)), "region_1")
+    points = Layer(np.zeros((0, 3)), "track_0")
+    tracker.set_saved([loaded])
+
+    layers = [loaded, new, points]
+    assert tracker.get_changed(layers) == [new, points]
+    tracker.mark_saved([new])
+    # not saved yet
+    assert tracker.get_changed(layers) == [points]
+
+    # changed while saving
+    assert tracker.get_changed(layers) == [points]
+    points.data = np.ones((1, 3))
+    tracker.mark_saved([points])
+    assert tracker.get_changed(layers) == [points]
+    tracker.mark_saved([points])
+    assert tracker.get_changed(layers) == []
+
+    loaded.data[5, 5, 5] = 0
+    new.name = "region_2"
+    assert tracker.get_changed(layers) == [loaded, new]
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from skimage.measure import regionprops_table
+
+from neuro.atlas_tools.array import lateralise_atlas
+from neuro.structures.IO import load_structures_as_df
+from neuro.segmentation.manual_segmentation.brain_areas import (
+    BRAIN_AREA_COLUMNS,
+    analyse_regions,
+    get_bounding_box,
+    get_brain_area_table,
+    get_brain_area_volumes,
+)
+
+data_dir = Path("tests", "data")
+structures_csv = data_dir / "structures" / "structures.csv"
+
+
+def test_get_bounding_box():
+    data = np.zeros((10, 20, 30), dtype=np.uint16)
+    assert get_bounding_box(data) is None
+    data[2, 5:7, 10] = 3
+    data[4, 6, 20] = 1
+    assert get_bounding_box(data) == (
+        slice(2, 5),
+        slice(5, 7),
+        slice(10, 21),
+    )
+
+
+def test_get_brain_area_volumes(capsys):
+    structures_df = load_structures_as_df(structures_csv)
+    rng = np.random.default_rng(0)
+    shape = (30, 40, 50)
+    atlas_values = np.append(structures_df["id"][:10], [0, 100000])
+    annotations = rng.choice(atlas_values, size=shape)
+    hemispheres = np.ones(shape, dtype=np.uint8)
+    hemispheres[15:] = 2
+    # only in the right hemisphere
+    annotations[15:][annotations[15:] == atlas_values[0]] = atlas_values[1]
+    region = np.zeros(shape, dtype=np.uint16)
+    region[5:25, 10:30, 20:35] = 1
+    voxel_volume = 0.001
+
+    df = get_brain_area_volumes(
+        region, annotations, hemispheres, structures_df, voxel_volume
+    )
+    assert list(df.columns) == BRAIN_AREA_COLUMNS
+    assert "100000 is not in the atlas" in capsys.readouterr().out
+
+    # as in previous versions, using lateralise_atlas and np.unique
+    annotations_left, annotations_right = lateralise_atlas(
+        region.astype(bool) * annotations, hemispheres
+    )
+    total = (annotations_left != 0).sum() + (annotations_right != 0).sum()
+    names = structures_df.set_index("id")["name"]
+    expected_ids = list(np.unique(annotations_left[annotations_left != 0]))
+    expected_ids += [
+        i
+        for i in np.unique(annotations_right[annotations_right != 0])
+        if i not in expected_ids
+    ]
+    expected_ids.remove(100000)
+    assert list(df["structure_name"]) == list(names[expected_ids])
+
+    for atlas_value, (_, row) in zip(expected_ids, df.iterrows()):
+        left = (annotations_left == atlas_value).sum()
+        right = (annotations_right == atlas_value).sum()
+        assert row["left_volume_mm3"] == left * voxel_volume
+        assert row["right_volume_mm3"] == right * voxel_volume
+        assert row["left_percentage_of_total"] == 100 * (left / total)
+        assert row["right_percentage_of_total"] == 100 * (right / total)
+        assert np.isclose(row["total_volume_mm3"], (left + right) * 0.001)
+        assert np.isclose(
+            row["percentage_of_total"], 100 * (left + right) / total
+        )
+
+
+def test_get_brain_area_volumes_empty():
+    structures_df = load_structures_as_df(structures_csv)
+    shape = (10, 10, 10)
+    df = get_brain_area_volumes(
+        np.zeros(shape),
+        np.ones(shape, dtype=np.int32),
+        np.ones(shape, dtype=np.uint8),
+        structures_df,
+        0.001,
+    )
+    assert len(df) == 0
+    assert list(df.columns) == BRAIN_AREA_COLUMNS
+    assert isinstance(df, pd.DataFrame)
+
+
+def test_analyse_regions():
+    structures_df = load_structures_as_df(structures_csv)
+    rng = np.random.default_rng(1)
+    shape = (30, 40, 50)
+    annotations = rng.choice(structures_df["id"][:10], size=shape)
+    hemispheres = rng.choice([0, 1, 2], size=shape)
+
+    regions = [np.zeros(shape, dtype=np.uint16) for _ in range(4)]
+    regions[0][5:25, 10:30, 20:35] = 1
+    # overlapping, with several labels
+    regions[1][10:20, 5:15, 3:45] = 1
+    regions[1][12:14, 20:22, 30:33] = 3
+    # a single voxel
+    regions[2][29, 39, 49] = 1
+    # regions[3] is empty
+
+    results = analyse_regions(
+        regions, annotations, hemispheres, slab_size=4, n_threads=2
+    )
+    assert results[3] is None
+    for region, result in zip(regions[:3], results[:3]):
+        structure_counts, label_statistics = result
+        expected_counts = get_brain_area_volumes(
+            region, annotations, hemispheres, structures_df, 1
+        )
+        df = get_brain_area_table(*structure_counts, structures_df, 1)
+        pd.testing.assert_frame_equal(df, expected_counts)
+
+        expected_statistics = pd.DataFrame(
+            regionprops_table(region, properties=["area", "bbox", "centroid"])
+        )
+        assert list(label_statistics.columns) == list(
+            expected_statistics.columns
+        )
+        assert np.array_equal(
+            label_statistics.to_numpy(), expected_statistics.to_numpy()
+        )
+
+
+def test_analyse_regions_without_annotations():
+    region = np.zeros((10, 10, 10), dtype=np.uint8)
+    region[2:4, 3:5, 6:9] = 2
+    (result,) = analyse_regions([region])
+    assert result[0] is None
+    assert result[1]["area"].tolist() == [12]
+    assert result[1]["centroid-2"].tolist() == [7]
+
+
+def test_analyse_regions_hemisphere_values():
+    annotations = np.full((10, 10, 10), 5, dtype=np.int32)
+    hemispheres = np.ones((10, 10, 10), dtype=np.uint8)
+    hemispheres[5:] = 2
+    region = np.zeros((10, 10, 10), dtype=np.uint8)
+    region[2:8, 3:5, 6:9] = 1
+
+    (result,) = analyse_regions([region], annotations, hemispheres)
+    atlas_values, left_counts, right_counts = result[0]
+    assert atlas_values.tolist() == [5]
+    assert left_counts.tolist() == [18]
+    assert right_counts.tolist() == [18]
+
+    (result,) = analyse_regions(
+        [region],
+        annotations,
+        hemispheres * 3,
+        left_hemisphere_value=6,
+        right_hemisphere_value=0,
+    )
+    _, left_counts, right_counts = result[0]
+    assert left_counts.tolist() == [18]
+    assert right_counts.tolist() == [0]
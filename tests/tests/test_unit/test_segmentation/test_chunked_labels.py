@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from neuro.atlas_tools.array import get_bounding_box
+from neuro.segmentation.manual_segmentation.brain_areas import analyse_regions
+from neuro.segmentation.manual_segmentation.chunked_labels import (
+    ChunkedLabels,
+)
+
+shape = (30, 40, 50)
+chunk_shape = (8, 16, 10)
+
+
+def get_labels():
+    labels = ChunkedLabels(shape, chunk_shape=chunk_shape)
+    expected = np.zeros(shape, dtype=np.uint8)
+    for data in (labels, expected):
+        data[2:12, 5:20, 30] = 1
+        data[20, 35:, ::3] = 2
+        data[-1, -1, -1] = 3
+    return labels, expected
+
+
+def test_chunked_labels_empty():
+    labels = ChunkedLabels(shape)
+    assert labels.shape == shape
+    assert labels.dtype == np.uint8
+    assert len(labels) == shape[0]
+    assert labels.nbytes == 0
+    assert not labels.any()
+    assert labels.get_bounding_box() is None
+    assert labels[1, 2, 3] == 0
+    assert np.array_equal(labels[5], np.zeros(shape[1:]))
+
+    # erasing doesn't allocate chunks
+    labels[:10, :10, :10] = 0
+    assert labels.nbytes == 0
+
+
+def test_chunked_labels_indexing():
+    labels, expected = get_labels()
+    assert 0 < labels.nbytes < expected.nbytes
+    assert np.array_equal(np.asarray(labels), expected)
+    for key in [
+        (20, 35, 3),
+        (5,),
+        (slice(None), 10),
+        (Ellipsis, 30),
+        (slice(1, 25, 4), slice(None, None, -3), slice(29, 52)),
+        (-1, slice(-5, None), -1),
+    ]:
+        assert np.array_equal(labels[key], expected[key])
+
+    with pytest.raises(IndexError):
+        labels[shape[0]]
+
+
+def test_chunked_labels_set():
+    labels, expected = get_labels()
+    value = np.arange(15 * 20).reshape(15, 20) % 7
+    for data in (labels, expected):
+        data[4, 10:25, 20:40] = value
+        data[data == 2] = 4
+    assert np.array_equal(np.asarray(labels), expected)
+
+    # as napari, when preserving labels
+    for data in (labels, expected):
+        keep = data[0:10, 0:10, 30] == 0
+        data[0:10, 0:10, 30][keep] = 5
+    assert np.array_equal(np.asarray(labels), expected)
+
+    # regions taken with negative steps
+    for data in (labels, expected):
+        region = data[::-1]
+        region[0] = 6
+        region = data[5, 30:2:-3]
+        region[1:3] = 7
+    assert np.array_equal(np.asarray(labels), expected)
+
+
+def test_chunked_labels_transpose():
+    labels, expected = get_labels()
+    view = np.swapaxes(labels, 2, 0)
+    assert view.shape == (50, 40, 30)
+    assert np.array_equal(np.asarray(view), np.swapaxes(expected, 2, 0))
+    assert get_bounding_box(view) == get_bounding_box(
+        np.swapaxes(expected, 2, 0)
+    )
+
+    # views share the chunks
+    view[1:3, 4, 5:7] = 6
+    expected[5:7, 4, 1:3] = 6
+    assert np.array_equal(np.asarray(labels), expected)
+    assert np.array_equal(np.asarray(labels.T), expected.T)
+
+
+def test_chunked_labels_from_array():
+    _, expected = get_labels()
+    labels = ChunkedLabels.from_array(expected, chunk_shape=chunk_shape)
+    assert np.array_equal(np.asarray(labels), expected)
+    assert labels.get_bounding_box() == get_bounding_box(expected)
+
+    with pytest.raises(ValueError):
+        ChunkedLabels.from_array(expected.astype(np.int16) * 100)
+
+
+def test_analyse_chunked_labels():
+    labels, expected = get_labels()
+    results = analyse_regions(
+        [np.swapaxes(labels, 2, 0)], slab_size=7, n_threads=2
+    )
+    expected_results = analyse_regions(
+        [np.swapaxes(expected, 2, 0)], slab_size=7, n_threads=2
+    )
+    assert results[0][1].equals(expected_results[0][1])
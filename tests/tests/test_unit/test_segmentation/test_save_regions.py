@@ -0,0 +1,59 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from neuro.segmentation.manual_segmentation.chunked_labels import (
+    ChunkedLabels,
+)
+from neuro.segmentation.manual_segmentation.save import (
+    _run_in_executor,
+    _run_in_pool,
+    load_shared_region,
+    run_in_workers,
+    share_region,
+)
+
+
+def test_share_chunked_region(tmpdir):
+    labels = ChunkedLabels((20, 30, 40))
+    labels[5:10, 3, 20:30] = 2
+    view = np.swapaxes(labels, 2, 0)
+
+    shared = share_region(view, tmpdir, 0)
+    # later edits aren't saved
+    view[0, 0, 0] = 1
+    region = load_shared_region(shared)
+    assert region.shape == view.shape
+    assert region[0, 0, 0] == 0
+    assert np.array_equal(region[:, 3], np.asarray(view)[:, 3])
+    assert len(tmpdir.listdir()) == 0
+
+
+def test_share_array_region(tmpdir):
+    labels = np.zeros((20, 30, 40), dtype=np.int16)
+    labels[5:10, 3, 20:30] = 2
+
+    shared = share_region(labels, tmpdir, 3)
+    labels[0, 0, 0] = 1
+    region = load_shared_region(shared)
+    assert isinstance(region, np.memmap)
+    assert region[0, 0, 0] == 0
+    assert (region == 2).sum() == 50
+    assert len(tmpdir.listdir()) == 1
+
+
+@pytest.mark.parametrize(
+    "run", [run_in_workers, _run_in_executor, _run_in_pool]
+)
+def test_run_in_workers(run):
+    def run_tasks(tasks):
+        if run is run_in_workers:
+            return list(run(int, tasks, 2))
+        context = multiprocessing.get_context("spawn")
+        return list(run(int, tasks, 2, context))
+
+    tasks = [((str(n),), {}) for n in range(5)] + [(("11",), {"base": 2})]
+    assert sorted(run_tasks(tasks)) == [0, 1, 2, 3, 3, 4]
+    with pytest.raises(ValueError):
+        run_tasks(tasks + [(("x",), {})])
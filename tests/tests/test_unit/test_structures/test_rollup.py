@@ -0,0 +1,69 @@
+import pytest
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from neuro.structures.IO import load_structures_as_df
+from neuro.structures.rollup import (
+    get_ancestor_matrix,
+    roll_up,
+)
+from neuro.structures.structures_tree import UnknownAtlasValue
+
+data_dir = Path("tests", "data")
+structures_csv = data_dir / "structures" / "structures.csv"
+
+
+def test_get_ancestor_matrix():
+    structures_df = load_structures_as_df(structures_csv)
+    ids, matrix, depth, parents = get_ancestor_matrix(structures_df)
+    assert (np.diff(ids) > 0).all()
+    assert matrix.shape == (len(ids), len(ids))
+
+    idx = np.searchsorted(ids, 100)
+    ancestors = ids[matrix[idx].nonzero()[1]]
+    assert sorted(ancestors) == sorted([997, 8, 343, 313, 348, 165, 100])
+    assert depth[idx] == 6
+    assert parents[idx] == 165
+    assert np.isnan(parents[np.searchsorted(ids, 997)])
+
+
+def test_roll_up():
+    structures_df = load_structures_as_df(structures_csv)
+    rng = np.random.default_rng(0)
+    leaf_ids = rng.choice(structures_df["id"], size=50, replace=False)
+    table = pd.DataFrame(
+        {
+            "structure_id": np.concatenate([leaf_ids, leaf_ids[:5]]),
+            "cell_count": rng.integers(0, 100, size=55),
+            "volume_mm3": rng.random(55),
+        }
+    )
+    result = roll_up(table, structures_df).set_index("structure_id")
+    assert result["cell_count"].dtype == table["cell_count"].dtype
+    assert result.loc[997, "cell_count"] == table["cell_count"].sum()
+
+    paths = structures_df.set_index("id")["structure_id_path"]
+    for structure_id, row in result.iterrows():
+        descendants = [
+            i for i in table["structure_id"] if f"/{structure_id}/" in paths[i]
+        ]
+        assert len(descendants) > 0
+        rows = table[table["structure_id"].isin(descendants)]
+        assert row["cell_count"] == rows["cell_count"].sum()
+        assert np.isclose(row["volume_mm3"], rows["volume_mm3"].sum())
+        assert (
+            row["depth"] == len(paths[structure_id].strip("/").split("/")) - 1
+        )
+
+    n_expected = len(
+        {i for leaf in leaf_ids for i in paths[leaf].strip("/").split("/")}
+    )
+    assert len(result) == n_expected
+
+
+def test_roll_up_unknown_structure():
+    structures_df = load_structures_as_df(structures_csv)
+    table = pd.DataFrame({"structure_id": [100, 100000], "cell_count": [1, 2]})
+    with pytest.raises(UnknownAtlasValue):
+        roll_up(table, structures_df)
@@ -1,4 +1,7 @@
+import os
+import shutil
 import pytest
+import numpy as np
 from pathlib import Path
 
 from neuro.structures.IO import load_structures_as_df
@@ -28,3 +31,99 @@ def test_atlas_value_to_name():
 
     with pytest.raises(structures_tree.UnknownAtlasValue):
         structures_tree.atlas_value_to_name(100000, structure_df)
+
+
+def test_structure_tree():
+    structure_df = load_structures_as_df(structures_csv)
+    tree = structures_tree.StructureTree(structure_df)
+    assert len(tree) == len(structure_df)
+    assert 100 in tree
+    assert 100000 not in tree
+
+    assert tree.get_parent(100) == 165
+    assert tree.get_ancestors(100) == [997, 8, 343, 313, 348, 165]
+    assert tree.get_ancestors(100, root_id=343) == [343, 313, 348, 165]
+    assert tree.get_path_string(100) == structure_id_100
+    assert tree.get_children(165) == [12, 100, 197, 591, 872]
+    assert tree.is_descendant(100, 343)
+    assert not tree.is_descendant(343, 100)
+
+    paths = structure_df.set_index("id")["structure_id_path"]
+    for structure_id in (997, 8, 343, 165):
+        expected = [
+            i
+            for i in structure_df["id"]
+            if i != structure_id and f"/{structure_id}/" in paths[i]
+        ]
+        assert tree.get_descendants(structure_id) == expected
+
+    for structure_id in structure_df["id"]:
+        assert tree.get_path_string(structure_id) == paths[structure_id]
+
+    with pytest.raises(structures_tree.UnknownAtlasValue):
+        tree.get_ancestors(100000)
+
+
+def test_structure_tree_from_paths():
+    structure_df = load_structures_as_df(structures_csv)
+    tree = structures_tree.StructureTree(
+        structure_df.drop(columns="parent_structure_id")
+    )
+    assert tree.get_ancestors(100) == [997, 8, 343, 313, 348, 165]
+    assert tree.get_children(165) == [12, 100, 197, 591, 872]
+
+
+def test_structure_lookup():
+    structure_df = load_structures_as_df(structures_csv)
+    lookup = structures_tree.StructureLookup(structure_df)
+    assert len(lookup) == len(structure_df)
+    assert 100 in lookup
+    assert 100000 not in lookup
+
+    for atlas_value in structure_df["id"]:
+        assert structures_tree.atlas_value_to_name(
+            atlas_value, lookup
+        ) == structures_tree.atlas_value_to_name(atlas_value, structure_df)
+        assert structures_tree.atlas_value_to_structure_id(
+            atlas_value, lookup
+        ) == structures_tree.atlas_value_to_structure_id(
+            atlas_value, structure_df
+        )
+    assert lookup.get_name(np.uint32(100)) == "Interpeduncular nucleus"
+
+    with pytest.raises(structures_tree.UnknownAtlasValue):
+        structures_tree.atlas_value_to_name(100000, lookup)
+    with pytest.raises(structures_tree.UnknownAtlasValue):
+        structures_tree.atlas_value_to_structure_id(100000, lookup)
+
+
+def test_structure_lookup_get_names():
+    structure_df = load_structures_as_df(structures_csv)
+    lookup = structures_tree.StructureLookup(structure_df)
+    atlas_values = np.array([[100, 997], [8, 100000]])
+    names = lookup.get_names(atlas_values, unknown_name="Unknown region")
+    assert names.shape == atlas_values.shape
+    assert names.tolist() == [
+        ["Interpeduncular nucleus", "root"],
+        ["Basic cell groups and regions", "Unknown region"],
+    ]
+    with pytest.raises(structures_tree.UnknownAtlasValue):
+        lookup.get_names(atlas_values)
+
+
+def test_get_structure_lookup(tmpdir):
+    structures_file = Path(tmpdir) / "structures.csv"
+    shutil.copy(structures_csv, structures_file)
+    lookup = structures_tree.get_structure_lookup(structures_file)
+    assert structures_tree.get_structure_lookup(structures_file) is lookup
+
+    structure_df = load_structures_as_df(structures_file)
+    structure_df.loc[structure_df["id"] == 100, "name"] = "Renamed"
+    structure_df.to_csv(structures_file, index=False)
+    # ensure the modification time changes
+    stat = os.stat(structures_file)
+    mtime_ns = stat.st_mtime_ns + 1000000000
+    os.utime(structures_file, ns=(stat.st_atime_ns, mtime_ns))
+    new_lookup = structures_tree.get_structure_lookup(structures_file)
+    assert new_lookup is not lookup
+    assert new_lookup.get_name(100) == "Renamed"
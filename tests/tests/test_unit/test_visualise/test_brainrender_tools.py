@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from pathlib import Path
+from skimage import measure
+
+from neuro.visualise.surfaces import read_mesh
+
+pytest.importorskip("brainrender")
+
+from neuro.visualise.brainrender_tools import (  # noqa: E402
+    get_decimation_error,
+    get_level_of_detail_path,
+    mesh_to_polydata,
+    save_levels_of_detail,
+    simplify_mesh,
+)
+
+# marching_cubes_lewiner (used by neuro) was removed in scikit-image 0.19
+if hasattr(measure, "marching_cubes_lewiner"):
+    marching_cubes = measure.marching_cubes_lewiner
+else:
+    marching_cubes = measure.marching_cubes
+
+
+def get_sphere():
+    z, y, x = np.ogrid[:60, :60, :60]
+    image = (z - 30) ** 2 + (y - 30) ** 2 + (x - 30) ** 2 < 20 ** 2
+    verts, faces, normals, _ = marching_cubes(image.astype(np.uint8), 0)
+    return verts * 10, faces, normals
+
+
+def test_simplify_mesh():
+    verts, faces, _ = get_sphere()
+    decimated = simplify_mesh(verts, faces, target_faces=1000)
+    assert len(decimated[1]) == 1000
+    assert decimated[1].max() < len(decimated[0])
+    assert np.allclose(np.linalg.norm(decimated[2], axis=1), 1)
+
+    decimated = simplify_mesh(verts, faces, max_error=5)
+    assert len(decimated[1]) < len(faces)
+    error = get_decimation_error(
+        mesh_to_polydata(verts, faces), mesh_to_polydata(*decimated[:2])
+    )
+    assert error <= 5
+
+    smoothed = simplify_mesh(verts, faces, smoothing_iterations=10)
+    assert len(smoothed[0]) == len(np.unique(verts, axis=0))
+
+
+def test_save_levels_of_detail(tmpdir):
+    verts, faces, normals = get_sphere()
+    mesh_file = Path(tmpdir) / "region.ply"
+    save_levels_of_detail(verts, faces, normals, mesh_file, (0.25, 0.05))
+
+    assert get_level_of_detail_path(mesh_file, 0) == mesh_file
+    assert np.array_equal(read_mesh(mesh_file)[1], faces)
+    n_faces = len(simplify_mesh(verts, faces)[1])
+    for level, fraction in [(1, 0.25), (2, 0.05)]:
+        level_file = get_level_of_detail_path(mesh_file, level)
+        assert level_file == Path(tmpdir) / f"lod{level}" / "region.ply"
+        assert len(read_mesh(level_file)[1]) == round(fraction * n_faces)
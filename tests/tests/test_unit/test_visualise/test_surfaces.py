@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from skimage import measure
+
+from neuro.visualise.surfaces import (
+    MESH_FORMATS,
+    get_mesh_format,
+    marching_cubes_to_obj,
+    read_mesh,
+    save_mesh,
+)
+
+# marching_cubes_lewiner (used by neuro) was removed in scikit-image 0.19
+if hasattr(measure, "marching_cubes_lewiner"):
+    marching_cubes = measure.marching_cubes_lewiner
+else:
+    marching_cubes = measure.marching_cubes
+
+
+def write_obj_lines(marching_cubes_out, output_file):
+    # one line at a time, as marching_cubes_to_obj was originally written
+    verts, faces, normals, _ = marching_cubes_out
+    with open(output_file, "w") as f:
+        for item in verts:
+            f.write(f"v {item[0]} {item[1]} {item[2]}\n")
+        for item in normals:
+            f.write(f"vn {item[0]} {item[1]} {item[2]}\n")
+        for item in faces:
+            f.write(
+                f"f {item[0]}//{item[0]} {item[1]}//{item[1]} "
+                f"{item[2]}//{item[2]}\n"
+            )
+
+
+def get_marching_cubes_out():
+    image = np.zeros((20, 30, 25), dtype=np.uint8)
+    image[3:15, 5:25, 4:12] = 1
+    image[10:18, 12:16, 8:22] = 1
+    return marching_cubes(image, 0, step_size=2)
+
+
+def test_marching_cubes_to_obj(tmpdir):
+    marching_cubes_out = get_marching_cubes_out()
+    verts, faces, normals, values = marching_cubes_out
+
+    for out in [
+        marching_cubes_out,
+        (verts.astype(np.float64) * 10 / 3, faces, normals, values),
+        (
+            np.array([[0.0, -0.0, 1e-20], [np.nan, np.inf, 1e20]]),
+            np.array([[0, 1, 1]], dtype=np.int64),
+            np.array([[-0.0, 0.1, 1 / 3]], dtype=np.float32),
+            None,
+        ),
+    ]:
+        obj_file = str(tmpdir.join("region.obj"))
+        expected_obj_file = str(tmpdir.join("expected.obj"))
+        marching_cubes_to_obj(out, obj_file)
+        write_obj_lines(out, expected_obj_file)
+        with open(obj_file, "rb") as f, open(expected_obj_file, "rb") as g:
+            assert f.read() == g.read()
+
+
+@pytest.mark.parametrize("mesh_format", MESH_FORMATS)
+def test_save_and_read_mesh(tmpdir, mesh_format):
+    verts, faces, normals, _ = get_marching_cubes_out()
+    verts = verts * 10
+    mesh_file = str(tmpdir.join("region." + mesh_format))
+    save_mesh(verts, faces, normals, mesh_file)
+    mesh = read_mesh(mesh_file)
+
+    # the binary formats store 32 bit floats
+    if mesh_format == "stl":
+        # vertices are stored for each triangle, and merged again when read
+        assert len(mesh[0]) == len(
+            np.unique(verts[faces].reshape(-1, 3), axis=0)
+        )
+        assert np.allclose(
+            np.sort(mesh[0][mesh[1]], axis=0), np.sort(verts[faces], axis=0)
+        )
+    else:
+        assert np.allclose(mesh[0], verts)
+        assert np.array_equal(mesh[1], faces)
+        assert np.allclose(mesh[2], normals)
+
+
+def test_get_mesh_format():
+    assert get_mesh_format("region.PLY") == "ply"
+    assert get_mesh_format("region", mesh_format="glb") == "glb"
+    assert get_mesh_format("region.ply", mesh_format="PLY") == "ply"
+    with pytest.raises(ValueError):
+        get_mesh_format("region.obj", mesh_format="ply")
+    with pytest.raises(ValueError):
+        get_mesh_format("region.vtk")